@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+"""Listening statistics computed from playlogs."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from os.path import abspath, basename, dirname, join
+from datetime import datetime, timedelta
+from itertools import islice
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from pstorytime.columnar import ColumnStore
+from pstorytime.playlog import segment_files
+
+__all__ = [
+  'Analytics',
+  'read_chunks',
+  ]
+
+CHUNK = 1<<20
+"""Number of entries to read at a time. """
+
+MAX_SESSION = 24*3600
+"""Sessions longer than this in seconds are taken to be missing their end and
+are ignored. """
+
+STARTS = ("start",)
+"""Events that start a session. """
+
+ENDS = ("stop", "seekfrom", "eob", "loadfail", "auto")
+"""Events that end a session. """
+
+# Edges of the histogram of session lengths, in seconds.
+_EDGES = numpy.logspace(0, 6, 601) if numpy != None else None
+
+def read_chunks(playlog_file,size=CHUNK):
+  """Read a playlog, including its sealed segments, a chunk at a time.
+
+  Arguments:
+    playlog_file  Path to the playlog.
+    size          Largest number of lines in a chunk. (Optional, defaults to
+                  CHUNK.)
+
+  Returns:        Iterator over ColumnStore objects, in order.
+  """
+  paths = [path for (_,path) in segment_files(playlog_file)] + [playlog_file]
+  for path in paths:
+    try:
+      f = open(path,'rb')
+    except IOError:
+      continue
+    with f:
+      while True:
+        lines = list(islice(f,size))
+        if len(lines)==0:
+          break
+        yield ColumnStore.from_lines(lines)
+
+def _codes(names,wanted):
+  """Get the codes of the names that are wanted. """
+  return numpy.array([i for (i,name) in enumerate(names) if name in wanted],
+                     dtype=numpy.int32)
+
+class Analytics(object):
+  """Listening sessions of one or more playlogs, aggregated by day, hour of
+  the week, file and book.
+
+  A session starts at a start entry, or a seekto entry right after a seekfrom
+  entry, and ends at the next entry that ends playback. Its length is the
+  walltime between them, and all of it is counted at the walltime and in the
+  file where it started. Times are in UTC, like in the playlog.
+
+  Entries are added a chunk at a time, and everything is computed with
+  vectorized NumPy operations over the columns of the chunk. Only the
+  aggregates are kept, so memory use does not grow with the size of the
+  playlogs.
+  """
+  def __init__(self):
+    """Create empty statistics.
+
+    Exceptions:
+      ImportError   If NumPy is not available.
+    """
+    if numpy == None:
+      raise ImportError("NumPy is needed for listening statistics.")
+    self.total = 0.0
+    self.sessions = 0
+    self.entries = 0
+    self.days = {}
+    self.week = numpy.zeros(168)
+    self.files = {}
+    self.books = {}
+    self._histogram = numpy.zeros(len(_EDGES)-1, dtype=numpy.int64)
+    self._book = None
+    self._carry = None
+    self._after_seekfrom = False
+
+  def add_playlog(self,playlog_file,book=None,size=CHUNK):
+    """Add all entries of a playlog.
+
+    Arguments:
+      playlog_file  Path to the playlog.
+      book          Name of the audiobook, or None to use the name of the
+                    directory of the playlog. (Optional, defaults to None.)
+      size          Number of entries to handle at a time. (Optional, defaults
+                    to CHUNK.)
+    """
+    if book == None:
+      book = basename(dirname(abspath(playlog_file)))
+    self.begin(book)
+    for store in read_chunks(playlog_file,size):
+      self.add(store)
+
+  def begin(self,book):
+    """Start adding the entries of a new playlog.
+
+    Arguments:
+      book  Name of the audiobook.
+    """
+    self._book = book
+    self._carry = None
+    self._after_seekfrom = False
+
+  def add(self,store):
+    """Add the next chunk of entries of the current playlog.
+
+    Arguments:
+      store   ColumnStore with the entries.
+    """
+    if len(store)==0:
+      return
+    self.entries += len(store)
+    walltimes = numpy.frombuffer(store.walltimes, dtype=numpy.float64)
+    events = numpy.frombuffer(store.events, dtype=numpy.int32)
+    filenames = numpy.frombuffer(store.filenames, dtype=numpy.int32)
+    names = store.event_names.values
+    self.add_columns(walltimes, events, filenames, names,
+                     store.filename_names.values)
+
+  def add_columns(self,walltimes,events,filenames,event_names,filename_names):
+    """Add the next chunk of entries of the current playlog, given as columns.
+
+    Arguments:
+      walltimes       Array of walltimes.
+      events          Array of event codes.
+      filenames       Array of filename codes.
+      event_names     List of event names by code.
+      filename_names  List of filenames by code.
+    """
+    if len(walltimes)==0:
+      return
+    seekfrom = numpy.in1d(events, _codes(event_names,("seekfrom",)))
+    after_seekfrom = numpy.empty(len(events), dtype=bool)
+    after_seekfrom[0] = self._after_seekfrom
+    after_seekfrom[1:] = seekfrom[:-1]
+    self._after_seekfrom = bool(seekfrom[-1])
+
+    opens = (numpy.in1d(events, _codes(event_names,STARTS)) |
+             (numpy.in1d(events, _codes(event_names,("seekto",))) & after_seekfrom))
+    ends = numpy.in1d(events, _codes(event_names,ENDS))
+
+    # Entries where sessions start or end, in order.
+    marks = numpy.flatnonzero(opens|ends)
+    if len(marks)==0:
+      return
+    is_open = opens[marks]
+
+    # A session started in an earlier chunk.
+    if self._carry != None and not is_open[0]:
+      (walltime,filename) = self._carry
+      self._sessions(numpy.array([walltimes[marks[0]]-walltime]),
+                     numpy.array([walltime]),
+                     numpy.array([0], dtype=numpy.int32),
+                     [filename])
+    if is_open[-1]:
+      self._carry = (walltimes[marks[-1]], filename_names[filenames[marks[-1]]])
+    else:
+      self._carry = None
+
+    # Sessions within this chunk are an open followed by an end.
+    pairs = numpy.flatnonzero(is_open[:-1] & ~is_open[1:])
+    first = marks[pairs]
+    last = marks[pairs+1]
+    self._sessions(walltimes[last]-walltimes[first],
+                   walltimes[first],
+                   filenames[first],
+                   filename_names)
+
+  def _sessions(self,lengths,starts,filenames,filename_names):
+    """Add sessions to the aggregates.
+
+    Arguments:
+      lengths         Array of lengths in seconds.
+      starts          Array of walltimes when they started.
+      filenames       Array of filename codes of where they started.
+      filename_names  List of filenames by code.
+    """
+    valid = (lengths >= 0) & (lengths <= MAX_SESSION)
+    lengths = lengths[valid]
+    starts = starts[valid]
+    filenames = filenames[valid]
+    if len(lengths)==0:
+      return
+
+    total = float(lengths.sum())
+    self.total += total
+    self.sessions += len(lengths)
+    self.books[self._book] = self.books.get(self._book,0.0) + total
+    self._histogram += numpy.histogram(numpy.clip(lengths,_EDGES[0],_EDGES[-1]),
+                                       bins=_EDGES)[0]
+
+    days = numpy.floor(starts/86400).astype(numpy.int64)
+    (unique,inverse) = numpy.unique(days, return_inverse=True)
+    for (day,length) in zip(unique, numpy.bincount(inverse, weights=lengths)):
+      self.days[int(day)] = self.days.get(int(day),0.0) + length
+
+    # The epoch was a thursday, so shift the hours to start the week on monday.
+    hours = (numpy.floor(starts/3600).astype(numpy.int64) + 72) % 168
+    self.week += numpy.bincount(hours, weights=lengths, minlength=168)
+
+    perfile = numpy.bincount(filenames, weights=lengths, minlength=len(filename_names))
+    for code in numpy.flatnonzero(perfile):
+      filename = filename_names[code]
+      self.files[filename] = self.files.get(filename,0.0) + perfile[code]
+
+  def session_percentile(self,q):
+    """Get a percentile of the session lengths. It is estimated from a
+    histogram with a hundred bins per factor of ten, so the bins are about
+    2.3 percent apart.
+
+    Arguments:
+      q   The percentile, between 0 and 100.
+
+    Returns:  Length in seconds, or None if there are no sessions.
+    """
+    count = self._histogram.sum()
+    if count==0:
+      return None
+    i = numpy.searchsorted(numpy.cumsum(self._histogram), q/100.0*count)
+    return float(_EDGES[min(i+1,len(_EDGES)-1)])
+
+  def day_percentile(self,q):
+    """Get a percentile of the time listened per day, for days with any.
+
+    Arguments:
+      q   The percentile, between 0 and 100.
+
+    Returns:  Length in seconds, or None if there are no sessions.
+    """
+    if len(self.days)==0:
+      return None
+    return float(numpy.percentile(numpy.array(self.days.values()), q))
+
+def _format(seconds):
+  """Format a length in seconds. """
+  if seconds == None:
+    return "-"
+  return str(timedelta(seconds=int(round(seconds))))
+
+_WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+def report(analytics,out=sys.stdout,top=10):
+  """Print the statistics.
+
+  Arguments:
+    analytics   The statistics.
+    out         Where to print. (Optional, defaults to stdout.)
+    top         Number of files and days to list. (Optional, defaults to 10.)
+  """
+  a = analytics
+  out.write("Entries:  {0}\n".format(a.entries))
+  out.write("Sessions: {0}\n".format(a.sessions))
+  out.write("Total:    {0}\n".format(_format(a.total)))
+  out.write("Days:     {0}\n".format(len(a.days)))
+  out.write("\nPercentile   session     per day\n")
+  for q in (50, 90, 99):
+    out.write("{0:>10}  {1:>8}  {2:>10}\n".format(
+      q, _format(a.session_percentile(q)), _format(a.day_percentile(q))))
+
+  out.write("\nBooks:\n")
+  for (book,seconds) in sorted(a.books.items(), key=lambda i: -i[1]):
+    out.write("  {0:>10}  {1}\n".format(_format(seconds),book))
+
+  out.write("\nFiles:\n")
+  for (filename,seconds) in sorted(a.files.items(), key=lambda i: -i[1])[:top]:
+    out.write("  {0:>10}  {1}\n".format(_format(seconds),filename))
+
+  out.write("\nDays:\n")
+  for (day,seconds) in sorted(a.days.items(), key=lambda i: -i[1])[:top]:
+    date = datetime.utcfromtimestamp(day*86400).strftime("%Y-%m-%d")
+    out.write("  {0:>10}  {1}\n".format(_format(seconds),date))
+
+  out.write("\nHours of the week:\n")
+  for (d,name) in enumerate(_WEEKDAYS):
+    hours = a.week[d*24:(d+1)*24]/60
+    out.write("  {0}  {1}\n".format(name," ".join("{0:3.0f}".format(m) for m in hours)))
+
+def write_synthetic(playlog_file,entries,size=CHUNK):
+  """Write a synthetic playlog with random entries.
+
+  Arguments:
+    playlog_file  Path of the playlog to write.
+    entries       Number of entries.
+    size          Number of entries to generate at a time. (Optional,
+                  defaults to CHUNK.)
+  """
+  event_names = ["start", "stop", "seekfrom", "seekto", "*"]
+  filename_names = ["{0:03d}.mp3".format(i) for i in xrange(0,100)]
+  random = numpy.random.RandomState(0)
+  walltime = 1.3e9
+  done = 0
+  with open(playlog_file,'wb') as f:
+    while done < entries:
+      n = min(size, entries-done)
+      walltimes = walltime + numpy.cumsum(random.exponential(600, n))
+      events = random.randint(0, len(event_names), n)
+      filenames = numpy.sort(random.randint(0, len(filename_names), n))
+      positions = random.randint(0, 3600, n)
+      f.write("".join("{0} {1} {2} {3}000000000 3600000000000\n".format(
+                        int(w), event_names[e], filename_names[c], p)
+                      for (w,e,c,p) in zip(walltimes,events,filenames,positions)))
+      walltime = walltimes[-1]
+      done += n
+
+def benchmark(entries,size=CHUNK,out=sys.stdout,playlog_file=None):
+  """Time the statistics on a playlog on disk, including reading and parsing
+  it, which takes most of the time.
+
+  Arguments:
+    entries       Number of entries in the synthetic playlog.
+    size          Number of entries in each chunk. (Optional, defaults to
+                  CHUNK.)
+    out           Where to print. (Optional, defaults to stdout.)
+    playlog_file  Playlog to use instead of a synthetic one, or None.
+                  (Optional, defaults to None.)
+
+  Returns:    The statistics.
+  """
+  directory = None
+  if playlog_file == None:
+    directory = tempfile.mkdtemp(prefix="pstorytime-analytics-")
+    playlog_file = join(directory,".playlog")
+    write_synthetic(playlog_file,entries,size)
+  try:
+    analytics = Analytics()
+    analytics.begin("benchmark")
+    parsing = 0.0
+    computing = 0.0
+    chunks = read_chunks(playlog_file,size)
+    while True:
+      start = time.time()
+      store = next(chunks,None)
+      parsing += time.time() - start
+      if store == None:
+        break
+      start = time.time()
+      analytics.add(store)
+      computing += time.time() - start
+  finally:
+    if directory != None:
+      shutil.rmtree(directory, ignore_errors=True)
+
+  elapsed = parsing + computing
+  out.write("{0} entries in {1:.2f} s, {2:.0f} entries/s\n".format(
+    analytics.entries, elapsed, analytics.entries/max(elapsed,1e-9)))
+  out.write("Reading and parsing: {0:.2f} s, statistics: {1:.2f} s\n".format(
+    parsing, computing))
+  return analytics
+
+def main(argv=None):
+  """Command line interface. """
+  parser = argparse.ArgumentParser(
+    prog="pstorytime-analytics",
+    description="%(prog)s prints listening statistics of pstorytime playlogs.")
+  sub = parser.add_subparsers(dest="command")
+
+  rep = sub.add_parser("report", help="Print statistics of playlogs.")
+  rep.add_argument("playlog", nargs="+", help="Path to a playlog, such as ~/.pstorytime/logs/book/.playlog")
+  rep.add_argument("--top", type=int, default=10, help="Number of files and days to list. (Default: %(default)s)")
+
+  bench = sub.add_parser("benchmark", help="Time reading a playlog and computing its statistics.")
+  bench.add_argument("--entries", type=int, default=10000000, help="Number of entries of the synthetic playlog. (Default: %(default)s)")
+  bench.add_argument("--chunk", type=int, default=CHUNK, help="Entries per chunk. (Default: %(default)s)")
+  bench.add_argument("--playlog", default=None, help="Time an existing playlog instead of a synthetic one.")
+
+  conf = parser.parse_args(argv)
+  if numpy == None:
+    print("Error: NumPy is needed for listening statistics.")
+    sys.exit(1)
+
+  if conf.command == "report":
+    analytics = Analytics()
+    for playlog_file in conf.playlog:
+      analytics.add_playlog(playlog_file)
+    report(analytics,top=conf.top)
+  else:
+    report(benchmark(conf.entries,conf.chunk,playlog_file=conf.playlog),top=0)
+
+if __name__ == '__main__':
+  main()
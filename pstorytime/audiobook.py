@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-"""Audiobook playing abstraction that uses gstreamer as backend.
+"""Audiobook playing abstraction that uses gstreamer, or another player
+backend.
 """
 
 #
@@ -32,7 +33,10 @@ import mimetypes
 import gobject
 
 from pstorytime.log import Log
-import pstorytime.player
+from pstorytime.fileindex import FileIndex
+from pstorytime.durations import DurationTable
+from pstorytime.timer import Timer
+import pstorytime.backend
 from pstorytime.misc import withdoc
 
 class AudioBook(gobject.GObject):
@@ -42,6 +46,9 @@ class AudioBook(gobject.GObject):
   python gobject (or GTK if appropriate) bindings if unsure on how to use them.
   
   Signals:
+    appended          Entries were added to the playlog. Contains the index of
+                      the first new entry and the number of new entries.
+
     error             Contains error messages as strings.
 
     position          Contains no additional information, but signals that it
@@ -55,15 +62,19 @@ class AudioBook(gobject.GObject):
 
     notify::playing   playing property updated.
 
-    notify::playlog   playlog property updated.
+    notify::playlog   playlog property updated. The new playlog has a higher
+                      version number.
 
   """
 
-  SECOND = pstorytime.player.Player.SECOND
+  SECOND = pstorytime.backend.SECOND
   """Time unit of a second according to gstreamer.
   """
 
   __gsignals__ = {
+    'appended' : (gobject.SIGNAL_RUN_LAST,
+                  gobject.TYPE_NONE,
+                  (gobject.TYPE_INT,gobject.TYPE_INT)),
     'error' : ( gobject.SIGNAL_RUN_LAST,
                 gobject.TYPE_NONE,
                 (gobject.TYPE_STRING,)),
@@ -77,15 +88,14 @@ class AudioBook(gobject.GObject):
 
   @withdoc(gobject.property)
   def playing(self):
-    """True if the audiobook is playing. """
-    with self._lock:
-      return self._playing
+    """True if the audiobook is playing. Reading it does not take any locks. """
+    return self._playing
 
   @withdoc(gobject.property)
   def eob(self):
-    """True if the audiobook player is currently at the end of the book. """
-    with self._lock:
-      return self._eob
+    """True if the audiobook player is currently at the end of the book.
+    Reading it does not take any locks. """
+    return self._eob
 
   @withdoc(gobject.property)
   def filename(self):
@@ -96,9 +106,9 @@ class AudioBook(gobject.GObject):
   @withdoc(gobject.property)
   def playlog(self):
     """The current playlog containing walltime, event type, filename and
-    position. """
-    with self._lock:
-      return self._log.playlog
+    position. It is a read-only view that does not change when entries are
+    added, and reading it does not take any locks. """
+    return self._log.playlog
 
   def __init__(self,conf,directory):
     """ Create the audiobook playing abstraction.
@@ -117,23 +127,66 @@ class AudioBook(gobject.GObject):
 
       self._conf = conf
       self._directory = normcase(expanduser(directory))
+      self._files = FileIndex(self._directory, self._is_audio_file)
       
-      self._player = pstorytime.player.Player(self,self._directory)
+      if self._conf.gapless:
+        # Called from a gstreamer thread, so it must not take any locks. The
+        # index is kept up to date by the main thread.
+        next_file = lambda filename: self._files.peek(filename,1)
+      else:
+        next_file = None
+      timeouts = { "load" : self._conf.load_timeout,
+                   "play" : self._conf.state_timeout,
+                   "pause" : self._conf.state_timeout,
+                   "seek" : self._conf.seek_timeout }
+      if self._conf.player_process:
+        from pstorytime.remoteplayer import RemotePlayer
+        create = lambda *args: RemotePlayer(*args, backend=self._conf.backend)
+      else:
+        create = pstorytime.backend.factory(self._conf.backend)
+      self._player = create(self,
+                            self._directory,
+                            next_file,
+                            self._conf.pool_size,
+                            timeouts,
+                            self._conf.async_state)
       self._player.connect("notify::eos",self._on_eos)
+      self._player.connect("switched",self._on_switched)
+      self._player.connect("stopped",self._on_stopped)
+
+      self._durations = DurationTable(self._directory,
+                                      self._files,
+                                      self._player.probe,
+                                      self._conf.playlog_file+".durations")
 
       self._log = Log(self,
                       self._player,
                       self._directory,
-                      self._conf)
+                      self._conf,
+                      self._files,
+                      self._durations)
       self._log.connect("notify::playlog",self._on_playlog)
+      self._log.connect("appended",self._on_appended)
 
       self._filename = None
       self._eob = False
 
+      # Relative seeks that arrive within the seek window are combined, and
+      # only the final target is seeked to. (filename,position) relative to
+      # which the pending seek is made, or None.
+      self._pending_seek = None
+      # What position() gives while a seek is pending, for cached_position().
+      self._seek_feedback = None
+      if self._conf.seek_window > 0:
+        self._seek_timer = Timer(self._conf.seek_window, self._commit_seek)
+      else:
+        self._seek_timer = None
+
       # Try to load last entry from play log.
-      if len(self._log.playlog)>0:
-        start_file = self._log.playlog[-1].filename
-        start_pos = self._log.playlog[-1].position
+      last = self._log.last()
+      if last != None:
+        start_file = last.filename
+        start_pos = last.position
         self._play(start_file, start_pos, log=False, seek=True)
       else:
         # Otherwise use first file in directory.
@@ -155,6 +208,16 @@ class AudioBook(gobject.GObject):
     with self._lock:
       self.notify("playlog")
 
+  def _on_appended(self,log,first,count):
+    """Entries were added to the playlog.
+
+    Arguments:
+      log       The logger object.
+      first     Index of the first new entry.
+      count     Number of new entries.
+    """
+    self.emit("appended",first,count)
+
   def _on_eos(self,player,property):
     """Gstreamer reached the end of a file.
     
@@ -178,6 +241,36 @@ class AudioBook(gobject.GObject):
           self._log.lognow("eob")
           self._log.stop()
 
+  def _on_switched(self,player,filename):
+    """Gstreamer continued into the next file without stopping.
+
+    Arguments:
+      player    The player that switched file.
+      filename  The file that is now playing.
+    """
+    with self._lock:
+      self._filename = filename
+      self.notify("filename")
+      duration = player.duration()
+      if duration > 0:
+        self._durations.update(filename, duration)
+      self._prefetch()
+      self.emit("position")
+
+  def _on_stopped(self,player):
+    """Playback could not be started, the error has already been reported.
+
+    Arguments:
+      player    The player that did not start playing.
+    """
+    with self._lock:
+      if self._playing:
+        self._playing = False
+        self.notify("playing")
+        self._log.lognow("stop")
+        self._log.stop()
+        self.emit("position")
+
   def mark(self, name):
     """Manually add an event in the playlog.
     
@@ -185,6 +278,7 @@ class AudioBook(gobject.GObject):
       name  Name of the event.
     """
     with self._lock:
+      self._commit_seek()
       self._log.lognow(name)
 
   def _play(self, start_file=None, start_pos=None, pos_relative_end=False, log=False, seek=False):
@@ -219,43 +313,33 @@ class AudioBook(gobject.GObject):
       # Make sure we are not playing anything.
       self._pause(log=log, seek=seek)
 
-      if start_file != None and start_file != self._filename:
+      target_file = start_file
+      target_pos = start_pos
+      if start_pos != None:
+        if start_file == None:
+          target_file = self._filename
+        if target_file != None:
+          (target_file, target_pos) = self._resolve(target_file,
+                                                    start_pos,
+                                                    pos_relative_end)
+
+      if target_file != None and target_file != self._filename:
         # Try to load new file.
-        self._filename = start_file
+        self._filename = target_file
         self.notify("filename")
-        if not self._player.load(start_file):
+        if not self._player.load(target_file):
           # Failed to load file.
-          self._log.lognow("loadfail")
+          self._log.lognow("loadfail",target_file)
           self._log.stop()
           self._playing = False
           self.notify("playing")
           return False
+        self._durations.update(target_file, self._player.duration())
+        self._durations.focus(target_file)
+        self._prefetch()
 
-      if start_pos != None:
-        duration = self.duration()
-        if pos_relative_end:
-          start_pos += duration
-        if start_pos < 0:
-          # Position in an earlier file.
-          prev_file = self.get_file(-1)
-          if prev_file == None:
-            # Already in first book!
-            start_pos = 0
-            pos_relative_end = False
-            self._player.seek(start_pos)
-          else:
-            self._play(prev_file, start_pos, pos_relative_end=True, seek=True)
-        elif start_pos < duration:
-          # Position in this file.
-          self._player.seek(start_pos)
-        else:
-          # Position in a later file.
-          next_file = self.get_file(1)
-          if next_file == None:
-            # Already in last book!
-            self._player.seek(duration)
-          else:
-            self._play(next_file, start_pos-duration, seek=True)
+      if target_pos != None:
+        self._player.seek(target_pos)
 
       if log:
         if seek:
@@ -274,6 +358,55 @@ class AudioBook(gobject.GObject):
       self.emit("position")
       return True
 
+  def _prefetch(self):
+    """Let the player preroll the files next to the current one. """
+    with self._lock:
+      self._player.prefetch([self.get_file(1), self.get_file(-1)])
+
+  def _resolve(self, filename, pos, pos_relative_end=False):
+    """Find which file a position relative to the given file is in.
+
+    Arguments:
+      filename          The file that the position is relative to.
+
+      pos               Position in ns relative to the start of the file.
+
+      pos_relative_end  True if the position is relative to the end of the
+                        file instead. (Optional, defaults to False.)
+
+    Returns:  (filename,position) where the position is within the file.
+    """
+    with self._lock:
+      duration = self._duration_of(filename)
+      if pos_relative_end:
+        pos += duration
+      if 0 <= pos < duration:
+        # Position in this file.
+        return (filename, pos)
+      if self._files.index(filename) == None:
+        # Not a file in the book, stay within it.
+        return (filename, max(0, min(pos, duration)))
+      # Position in another file. (Or outside of the book, in which case it is
+      # clamped to the beginning or end.)
+      return self._durations.resolve(filename, pos)
+
+  def _duration_of(self, filename):
+    """Get the duration of a file without probing it, which is not done
+    while holding the lock.
+
+    Arguments:
+      filename  The file.
+
+    Returns:  Duration in ns, 0 if it is not known.
+    """
+    with self._lock:
+      duration = self._durations.known(filename)
+      if duration == None:
+        if filename == self._player.filename():
+          return self._player.duration()
+        return 0
+      return duration
+
   def _pause(self, log=False, seek=False):
     """Internal general pause abstraction.
     
@@ -307,6 +440,10 @@ class AudioBook(gobject.GObject):
                   given.) (Optional, defaults to None.)
     """
     with self._lock:
+      if start_file != None or start_pos != None:
+        self._cancel_seek()
+      else:
+        self._commit_seek()
       # Only propagate if we are not playing, or we have given a position to
       # start playing at.
       if (not self._playing) or start_file != None or start_pos != None:
@@ -325,26 +462,95 @@ class AudioBook(gobject.GObject):
     """
     with self._lock:
       if start_file!=None or start_pos!=None:
+        self._cancel_seek()
         return self._play(start_file, start_pos, log=True, seek=True)
 
   def dseek(self, delta):
     """Seek relative to the current position.
 
+    Relative seeks that follow each other within the seek window are
+    combined into one, which is made when no more arrive, and logged as a
+    single seek. Until then, position() gives the position that will be
+    seeked to.
+
     Arguments:
       delta   Positive or negative distance to seek in ns.
     """
     with self._lock:
-      (filename,pos,_) = self.position()
-      return self._play(filename, pos+delta, log=True, seek=True)
+      if self._pending_seek == None:
+        (filename,pos,_) = self._player.position()
+        if self._seek_timer == None or filename == None:
+          return self._play(filename, pos+delta, log=True, seek=True)
+        self._pending_seek = (filename,pos)
+      (filename,pos) = self._pending_seek
+      self._pending_seek = (filename,pos+delta)
+      self._seek_feedback = self.position()
+      # Wait for the window to pass without more seeks.
+      self._seek_timer.start()
+      self.emit("position")
+      return True
+
+  def _commit_seek(self):
+    """Make the pending relative seek now, if there is one. """
+    with self._lock:
+      if self._pending_seek != None:
+        (filename,pos) = self._pending_seek
+        self._cancel_seek()
+        self._play(filename, pos, log=True, seek=True)
+
+  def _cancel_seek(self):
+    """Forget the pending relative seek, if there is one, since it has been
+    replaced by another seek. """
+    with self._lock:
+      self._pending_seek = None
+      self._seek_feedback = None
+      if self._seek_timer != None:
+        self._seek_timer.stop()
+
+  def back(self):
+    """Go back to where the last jump was made from, like in a web browser.
+
+    Returns:  True if there was somewhere to go back to.
+    """
+    return self._navigate("back")
+
+  def forward(self):
+    """Go forward again to where back() was used.
+
+    Returns:  True if there was somewhere to go forward to.
+    """
+    return self._navigate("forward")
+
+  def _navigate(self, direction):
+    """Go back or forward in the history of jumps.
+
+    Arguments:
+      direction   "back" or "forward".
+
+    Returns:  True if there was somewhere to go.
+    """
+    with self._lock:
+      self._cancel_seek()
+      (back,forward) = self._log.history()
+      places = back if direction == "back" else forward
+      if len(places)==0:
+        return False
+      target = places[-1]
+      # Tell the log that the following jump is not a new one.
+      self._log.lognow(direction)
+      self._play(target.filename, target.position, log=True, seek=True)
+      return True
 
   def pause(self):
     """Pause audiobook now. """
     with self._lock:
+      self._commit_seek()
       if self._playing:
         self._pause(log=True)
         backtrack = self._conf.backtrack
         if backtrack!=None and backtrack>0:
-          self.dseek(-backtrack*self.SECOND)
+          (filename,pos,_) = self._player.position()
+          self._play(filename, pos-backtrack*self.SECOND, log=True, seek=True)
 
   def play_pause(self):
     """Toggle play/pause. """
@@ -357,11 +563,29 @@ class AudioBook(gobject.GObject):
   def position(self):
     """Get current filename, position and duration (in ns) as a tuple.
     
+    While relative seeks are being combined, the position that will be
+    seeked to is given.
+
     Returns: (filename,position,duration)
     """
     with self._lock:
+      if self._pending_seek != None:
+        (filename,pos) = self._resolve(*self._pending_seek)
+        return (filename,pos,self._duration_of(filename))
       return self._player.position()
 
+  def cached_position(self):
+    """Get about the same as position(), without taking any locks or waiting
+    for the player. The position last published by the player is
+    extrapolated, so it is cheap enough to call many times a second.
+
+    Returns: (filename,position,duration)
+    """
+    feedback = self._seek_feedback
+    if feedback != None:
+      return feedback
+    return self._player.position_snapshot().extrapolate()
+
   def duration(self):
     """Get the duration of the current file.
 
@@ -370,39 +594,77 @@ class AudioBook(gobject.GObject):
     with self._lock:
       return self._player.duration()
 
+  def book_position(self):
+    """Get the current position and duration of the whole book as a tuple.
+
+    Returns: (position,duration) in ns. Either is None if it can not be told
+             until the durations of more files are known.
+    """
+    with self._lock:
+      (filename,pos,_) = self.position()
+      offset = self._durations.offset(filename)
+      if offset == None:
+        return (None, self._durations.total())
+      return (offset+pos, self._durations.total())
+
+  def book_duration(self):
+    """Get the duration of the whole book.
+
+    Returns:  Duration in ns, or None if the durations of some files are not
+              known yet.
+    """
+    with self._lock:
+      return self._durations.total()
+
+  def book_seek(self, position):
+    """Seek to a position in the whole book. Nothing is done until the
+    durations of all files are known.
+
+    Arguments:
+      position  Position in the book in ns.
+    """
+    with self._lock:
+      self._cancel_seek()
+      (filename,pos) = self._durations.locate(position)
+      if filename!=None:
+        return self._play(filename, pos, log=True, seek=True)
+
   def list_files(self):
     """List all audio files in audiobook directory.
 
+    The list is cached and only rebuilt when the directory changes, so it must
+    not be modified.
+
     Returns:  List of filenames as strings.
     """
     with self._lock:
-      entries = os.listdir(self._directory)
-      entries.sort()
-      return filter(self._is_audio_file, entries)
+      return self._files.files()
   
   def _is_audio_file(self,filename):
     """Internal function to check if a file is to be considered an audiobook.
 
+    It only reads the configuration, and takes no locks, since the file index
+    may be refreshed from any thread.
+
     Returns: True if so.
     """
-    with self._lock:
-      if not isfile(join(self._directory,filename)):
-        return False
+    if not isfile(join(self._directory,filename)):
+      return False
 
-      # Check if the filename ends with any of the given extensions.
-      exts = AudioBook.core_extensions + self._conf.extensions
-      exts = tuple(map(lambda e: '.'+e, exts))
-      if filename.endswith(exts):
-        return True
-
-      # Check if the mimetype database indicates sais the extension
-      # corresponds to an audio file.
-      (mime, _) = mimetypes.guess_type(filename)
-      if mime != None:
-        data = mime.split("/",1)
-        return len(data)==2 and data[0] == "audio"
-      else:
-        return False
+    # Check if the filename ends with any of the given extensions.
+    exts = AudioBook.core_extensions + self._conf.extensions
+    exts = tuple(map(lambda e: '.'+e, exts))
+    if filename.endswith(exts):
+      return True
+
+    # Check if the mimetype database indicates sais the extension
+    # corresponds to an audio file.
+    (mime, _) = mimetypes.guess_type(filename)
+    if mime != None:
+      data = mime.split("/",1)
+      return len(data)==2 and data[0] == "audio"
+    else:
+      return False
 
   def get_file(self,delta):
     """Get a file relative to the current one.
@@ -413,15 +675,90 @@ class AudioBook(gobject.GObject):
 
     Returns:  New filename.
     """
-    try:
-      files = self.list_files()
-      i = files.index(self._filename)
-      if 0 <= i+delta < len(files):
-        return files[i+delta]
-      else:
-        return None
-    except ValueError:
-      return None
+    with self._lock:
+      return self._files.relative(self._filename, delta)
+
+  def heard(self,filename):
+    """Get how much of a file has been listened to.
+
+    Arguments:
+      filename  The file.
+
+    Returns:    Fraction between 0 and 1, or None if it is not known.
+    """
+    return self._log.heard(filename)
+
+  def gap(self):
+    """Seek to the first part of the audiobook that has not been listened to.
+    Gaps shorter than five seconds are ignored.
+
+    Returns:  True if there was such a part.
+    """
+    with self._lock:
+      self._cancel_seek()
+      for filename in self.list_files():
+        position = self._log.first_gap(filename,tolerance=5*self.SECOND)
+        if position != None:
+          return self._play(filename, position, log=True, seek=True)
+      return False
+
+  def find_time(self,walltime):
+    """Find where entries at a given walltime start in the playlog.
+
+    Arguments:
+      walltime  The walltime in seconds since the epoch.
+
+    Returns:    Index of the first entry at or after the walltime, or the
+                length of the playlog if there is none.
+    """
+    return self._log.find_time(walltime)
+
+  def find(self,event=None,filename=None):
+    """Find entries in the playlog with a given event name and/or filename.
+
+    Arguments:
+      event     Event name to look for, or None for any. (Optional, defaults
+                to None.)
+      filename  Filename to look for, or None for any. (Optional, defaults
+                to None.)
+
+    Returns:    List of indices in the playlog in increasing order.
+    """
+    return self._log.find(event,filename)
+
+  def find_last(self,event=None,filename=None,before=None):
+    """Find the last entry in the playlog before an index with a given event
+    name and/or filename.
+
+    Arguments:
+      event     Event name to look for, or None for any. (Optional, defaults
+                to None.)
+      filename  Filename to look for, or None for any. (Optional, defaults
+                to None.)
+      before    Index to look before, or None to look at all entries.
+                (Optional, defaults to None.)
+
+    Returns:    Index in the playlog, or None if there is no such entry.
+    """
+    return self._log.find_last(event,filename,before)
+
+  def pool_stats(self):
+    """Get statistics of the pool of prerolled files.
+
+    Returns:  Dictionary with hits, misses, hit_rate, hit_latency,
+              hit_latency_max, miss_latency, miss_latency_max (in seconds) and
+              the number of pooled files.
+    """
+    return self._player.pool_stats()
+
+  def state_stats(self):
+    """Get statistics of how long the player takes to load, play, pause and
+    seek.
+
+    Returns:  Dictionary from operation to a dictionary with count, latency,
+              latency_max (in seconds), timeouts and failures.
+    """
+    return self._player.state_stats()
 
   def gst(self):
     """Get the gstreamer playbin2 object.
@@ -429,6 +766,12 @@ class AudioBook(gobject.GObject):
     Please do not touch play/pause/seek functionality, or it will seriously
     mess things up. Though feel free to adjust volume/playback speed etc.
 
+    The object may be replaced when another file is loaded, but the volume is
+    carried over. A position signal is always emitted after such a change.
+
+    With other backends than gstreamer, or with the player in a separate
+    process, it is an object that only has the volume and mute properties.
+
     Returns:  Gstreamer playbin2 object.
     """
     return self._player.gst
@@ -438,4 +781,12 @@ class AudioBook(gobject.GObject):
     """
     with self._lock:
       self.pause()
+      self._durations.close()
+      self._log.describe(len(self.list_files()), self._durations.known_total())
       self._player.quit()
+      self._log.quit()
+      self._files.close()
+      try:
+        self._durations.save()
+      except (IOError, OSError):
+        self.emit("error","Failed to write duration cache.")
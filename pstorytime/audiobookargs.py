@@ -22,6 +22,8 @@
 
 import argparse
 
+from pstorytime.logwriter import DURABILITY
+
 class FromCommaList(argparse.Action):
   """Generate a list strings from a string of comma separated strings.
   """
@@ -74,6 +76,11 @@ audiobookargs.add_argument(
   help="Path to the file to save playlog in relative to current directory. (Default: %(default)s)",
   default=".playlog")
 
+audiobookargs.add_argument(
+  "--library-file",
+  help="Path to the library index of all audiobooks, or nothing to not keep one. (Default: None)",
+  default=None)
+
 audiobookargs.add_argument(
   "--extensions",
   help="Comma separated list of additional extensions to treat as audiobook files. (Default: None)",
@@ -91,3 +98,93 @@ audiobookargs.add_argument(
   help="How far (in seconds) to automatically backtrack after pausing. (Default: %(default)s)",
   default=10,
   type=int)
+
+audiobookargs.add_argument(
+  "--backend",
+  help="What to play the audiobook with. gst: gstreamer. sim: a simulated player that plays nothing, with made up durations. (Default: %(default)s)",
+  choices=["gst","sim"],
+  default="gst")
+
+audiobookargs.add_argument(
+  "--player-process",
+  help="Run the player backend in a separate process, so that playback and the user interface can not hold each other up. (Default: %(default)s)",
+  action=Boolean,
+  default=False)
+
+audiobookargs.add_argument(
+  "--load-timeout",
+  help="How long (in milliseconds) loading a file may take before it is given up on. (Default: %(default)s)",
+  default=10000,
+  type=int)
+
+audiobookargs.add_argument(
+  "--seek-timeout",
+  help="How long (in milliseconds) a seek may take before it is reported as an error. (Default: %(default)s)",
+  default=5000,
+  type=int)
+
+audiobookargs.add_argument(
+  "--state-timeout",
+  help="How long (in milliseconds) starting or pausing playback may take before it is reported as an error. (Default: %(default)s)",
+  default=3000,
+  type=int)
+
+audiobookargs.add_argument(
+  "--async-state",
+  help="Do not wait for gstreamer to finish starting, pausing and seeking, but let it finish in the background. Problems are still reported when the timeouts run out. (Default: %(default)s)",
+  action=Boolean,
+  default=False)
+
+audiobookargs.add_argument(
+  "--seek-window",
+  help="How long (in milliseconds) to wait for more relative seeks, such as from holding down an arrow key, before seeking. Seeks within the window are combined into one. 0 seeks right away. (Default: %(default)s)",
+  default=250,
+  type=int)
+
+audiobookargs.add_argument(
+  "--gapless",
+  help="Queue the next file before the current one ends so that there is no gap between files. (Default: %(default)s)",
+  action=Boolean,
+  default=False)
+
+audiobookargs.add_argument(
+  "--pool-size",
+  help="Number of files next to the current one and recently played files to keep prerolled, so that switching to them is instant. Each one keeps a gstreamer pipeline with open decoders and audio output in memory. The limit is a number of pipelines rather than an amount of memory, since gstreamer can not tell how much memory a pipeline uses. (Default: %(default)s)",
+  default=0,
+  type=int)
+
+audiobookargs.add_argument(
+  "--log-durability",
+  help="How hard to try to get playlog events onto disk. sync: write and sync every event before continuing. group: write in the background and sync events that arrive close together at once. buffered: write in the background and let the operating system decide when to sync. (Default: %(default)s)",
+  choices=DURABILITY,
+  default="group")
+
+audiobookargs.add_argument(
+  "--log-commit-window",
+  help="How long (in milliseconds) to collect playlog events before writing them, when not using sync durability. (Default: %(default)s)",
+  default=200,
+  type=int)
+
+audiobookargs.add_argument(
+  "--playlog-segment-size",
+  help="Size (in KiB) at which the playlog is sealed and a new segment is started. Only the newest segment is read on startup. (Default: %(default)s)",
+  default=256,
+  type=int)
+
+audiobookargs.add_argument(
+  "--playlog-store",
+  help="How to keep the playlog in memory. objects: one object per entry. columnar: typed arrays that only create objects for entries that are looked at, which uses much less memory for long playlogs. (Default: %(default)s)",
+  choices=["objects","columnar"],
+  default="objects")
+
+audiobookargs.add_argument(
+  "--playlog-memory",
+  help="How many playlog entries to keep in memory, or 0 for no limit. Older entries are read from disk when they are needed, and the newest segment is sealed when it reaches this many entries. (Default: %(default)s)",
+  default=0,
+  type=int)
+
+audiobookargs.add_argument(
+  "--log-checksums",
+  help="Write a checksum with each playlog event, so that events that were damaged, for example by a power loss while writing, are detected and ignored. Playlogs with and without checksums can be read either way, but older versions of pstorytime and other tools that read the playlog can not read lines with checksums. (Default: %(default)s)",
+  action=Boolean,
+  default=False)
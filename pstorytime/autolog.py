@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Crash recovery record that is updated in place."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+from os.path import dirname, isdir
+import os
+import struct
+import threading
+import zlib
+
+__all__ = [
+  'AutoLog',
+  ]
+
+_MAGIC = "PSAL"
+_HEADER = struct.Struct("<4sQIH")
+_SLOT_SIZE = 4096
+_SLOTS = 2
+
+_sync = getattr(os, "fdatasync", os.fsync)
+
+def _checksum(seq,payload):
+  """Checksum of the sequence number and payload of a slot. """
+  return zlib.crc32(struct.pack("<Q",seq)+payload) & 0xffffffff
+
+class AutoLog(object):
+  """A single record stored in a preallocated file with two checksummed slots.
+
+  The slots are overwritten alternately, so the previous record survives if a
+  write is torn by a crash. Writing never changes the size of the file, so
+  only data and no metadata has to be synced. Reading picks the valid slot
+  with the highest sequence number.
+  """
+  def __init__(self,filepath):
+    """Create the record handler. The file is not touched until it is used.
+
+    Arguments:
+      filepath  Path to the record file.
+    """
+    self._lock = threading.RLock()
+    self._filepath = filepath
+    self._fd = None
+    self._seq = 0
+    self._slot = 0
+    self._empty = None
+
+  def _slots(self,data):
+    """Parse the valid slots of the given file contents.
+
+    Returns:  List of (seq,slot,payload) tuples.
+    """
+    valid = []
+    for i in xrange(0,_SLOTS):
+      raw = data[i*_SLOT_SIZE:(i+1)*_SLOT_SIZE]
+      if len(raw) < _HEADER.size:
+        continue
+      (magic,seq,crc,length) = _HEADER.unpack_from(raw)
+      payload = raw[_HEADER.size:_HEADER.size+length]
+      if magic == _MAGIC and len(payload) == length and crc == _checksum(seq,payload):
+        valid.append((seq,i,payload))
+    return valid
+
+  def read(self):
+    """Read the newest record.
+
+    Files in the old format, a single line of text, are also understood.
+
+    Returns:  The record as a string, or None if there is none.
+    """
+    with self._lock:
+      try:
+        with open(self._filepath,'rb') as f:
+          data = f.read(_SLOTS*_SLOT_SIZE)
+      except IOError:
+        return None
+      if not data.startswith(_MAGIC) and len(data) < _SLOT_SIZE:
+        # Old text format.
+        line = data.split("\n")[0]
+        return line if line != "" else None
+      valid = self._slots(data)
+      if len(valid)==0:
+        return None
+      (_,_,payload) = max(valid)
+      return payload if payload != "" else None
+
+  def _open(self):
+    """Open the file, creating and preallocating it if needed.
+
+    Exceptions:
+      IOError, OSError  If the file could not be opened.
+    """
+    with self._lock:
+      if self._fd != None:
+        return
+      dirpath = dirname(self._filepath)
+      if not isdir(dirpath) and dirpath!='':
+        os.makedirs(dirpath,mode=0700)
+      fd = os.open(self._filepath, os.O_RDWR | os.O_CREAT, 0600)
+      try:
+        data = os.read(fd, _SLOTS*_SLOT_SIZE)
+        valid = self._slots(data)
+        if len(data) != _SLOTS*_SLOT_SIZE:
+          # New or in the old format. Allocate it once.
+          os.ftruncate(fd, 0)
+          os.lseek(fd, 0, os.SEEK_SET)
+          os.write(fd, "\0" * (_SLOTS*_SLOT_SIZE))
+          os.fsync(fd)
+          valid = []
+        if len(valid) == 0:
+          self._seq = 0
+          self._slot = 0
+          self._empty = True
+        else:
+          (seq,slot,payload) = max(valid)
+          self._seq = seq
+          # Keep the newest record and overwrite the other slot next.
+          self._slot = (slot+1) % _SLOTS
+          self._empty = (payload == "")
+      except (IOError, OSError):
+        os.close(fd)
+        raise
+      self._fd = fd
+
+  def write(self,record):
+    """Store a new record, replacing the old one.
+
+    Arguments:
+      record  The record as a string without newlines.
+
+    Exceptions:
+      IOError, OSError  If the record could not be written.
+      ValueError        If the record is too long.
+    """
+    with self._lock:
+      if len(record) > _SLOT_SIZE - _HEADER.size:
+        raise ValueError("Auto log record too long.")
+      self._open()
+      self._seq += 1
+      data = _HEADER.pack(_MAGIC, self._seq, _checksum(self._seq,record), len(record)) + record
+      os.lseek(self._fd, self._slot*_SLOT_SIZE, os.SEEK_SET)
+      os.write(self._fd, data)
+      _sync(self._fd)
+      self._slot = (self._slot+1) % _SLOTS
+      self._empty = (record == "")
+
+  def clear(self):
+    """Remove the record, unless there is none.
+
+    Exceptions:
+      IOError, OSError  If the record could not be written.
+    """
+    with self._lock:
+      if self._empty == None:
+        if self.read() == None:
+          return
+      elif self._empty:
+        return
+      self.write("")
+
+  def close(self):
+    """Close the file. """
+    with self._lock:
+      if self._fd != None:
+        os.close(self._fd)
+        self._fd = None
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Player backends that AudioBook can play through.
+
+A backend is a gobject that is created with the arguments
+
+  (bus, directory, next_file, pool_size, timeouts, async_state)
+
+as described for pstorytime.player.Player, and that provides:
+
+  load(filename)          Load a file, returning True if successful.
+  play(), pause()         Start and stop playback.
+  seek(time_ns)           Seek in the current file.
+  position()              (filename,position,duration) right now.
+  position_snapshot()     PositionSnapshot that can be read without waiting.
+  duration(), filename()  Of the current file.
+  probe(filename)         Duration of a file, or None.
+  prefetch(filenames)     Hint about which files will be loaded next.
+  pool_stats(), state_stats()
+  quit()
+  gst                     Object with at least the volume and mute
+                          properties.
+  eos                     Property that is notified when a file ends.
+  switched                Signal with the new filename, when playback has
+                          continued into the next file by itself.
+  stopped                 Signal without arguments, when playback could not
+                          be started after play().
+
+Backends are looked up by name, and only imported when used, so that
+nothing needs gstreamer unless the gstreamer backend is used.
+"""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+import threading
+import time
+import gobject
+
+__all__ = [
+  'SECOND',
+  'BACKENDS',
+  'PositionSnapshot',
+  'GstProperties',
+  'register',
+  'factory',
+  ]
+
+SECOND = 1000000000
+"""A second in the time unit used by all backends, nanoseconds, the same as
+gstreamer uses. """
+
+BACKENDS = {
+  "gst" : "pstorytime.player.Player",
+  "sim" : "pstorytime.simplayer.SimPlayer",
+  }
+"""Backend name -> dotted path of its class, or a function that creates it. """
+
+_lock = threading.RLock()
+
+def register(name,backend):
+  """Make a backend available by name.
+
+  Arguments:
+    name      Name of the backend.
+    backend   Dotted path of the class, which is imported when it is first
+              used, or a function that takes the backend arguments and
+              creates it. Functions can not be used in a player process.
+  """
+  with _lock:
+    BACKENDS[name] = backend
+
+def factory(name):
+  """Get what creates a backend, importing it if needed.
+
+  Arguments:
+    name  Name of the backend.
+
+  Returns:  Function that takes the backend arguments and creates it.
+
+  Exceptions:
+    ValueError  If there is no such backend.
+  """
+  with _lock:
+    backend = BACKENDS.get(name)
+    if backend == None:
+      raise ValueError("Unknown player backend: {0}".format(name))
+    if isinstance(backend,basestring):
+      (module,_,attribute) = backend.rpartition(".")
+      backend = getattr(__import__(module, fromlist=[attribute]), attribute)
+      BACKENDS[name] = backend
+    return backend
+
+class PositionSnapshot(namedtuple("PositionSnapshot", [
+    "filename",
+    "position",
+    "duration",
+    "clock",
+    "rate",
+    "playing",
+    ])):
+  """Position of the player at one moment, that readers can extrapolate from.
+
+  Fields:
+    filename  The file that is loaded, or None.
+    position  Position in ns at the moment.
+    duration  Duration of the file in ns.
+    clock     Walltime in seconds of the moment.
+    rate      Playback rate, 1.0 for normal speed.
+    playing   True if the player was playing.
+  """
+  __slots__ = ()
+
+  def extrapolate(self,now=None):
+    """Estimate the position at another moment, assuming that the player has
+    kept playing, or kept still, since this one.
+
+    Arguments:
+      now   Walltime in seconds of the moment. (Optional, defaults to the
+            current time.)
+
+    Returns:  (filename,position,duration)
+    """
+    if not self.playing:
+      return (self.filename, self.position, self.duration)
+    if now == None:
+      now = time.time()
+    position = max(0, self.position + int((now-self.clock)*self.rate*SECOND))
+    if self.duration > 0:
+      position = min(position, self.duration)
+    return (self.filename, position, self.duration)
+
+class GstProperties(gobject.GObject):
+  """Stand-in for a gstreamer pipeline, for backends that do not have one.
+  It only has the volume and mute properties. """
+  __gproperties__ = {
+    'volume' : (gobject.TYPE_DOUBLE, 'volume', 'Playback volume.',
+                0.0, 10.0, 1.0, gobject.PARAM_READWRITE),
+    'mute' : (gobject.TYPE_BOOLEAN, 'mute', 'Mute the audio.',
+              False, gobject.PARAM_READWRITE)
+  }
+
+  def __init__(self):
+    gobject.GObject.__init__(self)
+    self._values = { 'volume' : 1.0, 'mute' : False }
+
+  def do_get_property(self,prop):
+    return self._values[prop.name]
+
+  def do_set_property(self,prop,value):
+    self._values[prop.name] = value
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Compact, array backed storage of playlog entries."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+import threading
+
+from pstorytime.logentry import LogEntry
+from pstorytime.logcheck import strip_checksum
+
+__all__ = [
+  'Dictionary',
+  'ColumnStore',
+  ]
+
+class Dictionary(object):
+  """Maps strings to small integer codes and back. """
+  def __init__(self):
+    """Create an empty dictionary. """
+    self.values = []
+    self._codes = {}
+
+  def encode(self,value):
+    """Get the code of a string, adding it if it is new.
+
+    Returns:  The code.
+    """
+    code = self._codes.get(value)
+    if code == None:
+      code = len(self.values)
+      self.values.append(value)
+      self._codes[value] = code
+    return code
+
+  def code(self,value):
+    """Get the code of a string without adding it.
+
+    Returns:  The code, or None if the string is unknown.
+    """
+    return self._codes.get(value)
+
+  def __len__(self):
+    return len(self.values)
+
+class ColumnStore(object):
+  """Append-only store of playlog entries, kept as one typed array per field.
+
+  Walltime, position and duration are stored as doubles, which are exact for
+  nanosecond positions of more than a hundred days, and the event names and
+  filenames are dictionary encoded. LogEntry objects are only created when an
+  entry is accessed. It can be used like a read-only list of entries, except
+  that entries can be appended.
+  """
+  def __init__(self,entries=[]):
+    """Create a store.
+
+    Arguments:
+      entries   Entries to start with. (Optional, defaults to no entries.)
+    """
+    self._lock = threading.RLock()
+    self.walltimes = array('d')
+    self.positions = array('d')
+    self.durations = array('d')
+    self.events = array('i')
+    self.filenames = array('i')
+    self.event_names = Dictionary()
+    self.filename_names = Dictionary()
+    for entry in entries:
+      self.append(entry)
+
+  @staticmethod
+  def from_lines(lines):
+    """Parse lines of the playlog into a new store, skipping invalid ones.
+    No LogEntry objects are created.
+
+    Arguments:
+      lines   Iterable of lines.
+
+    Returns:  The store.
+    """
+    store = ColumnStore()
+    # Look up everything used in the loop once, this is the hot path when
+    # loading long playlogs.
+    walltimes = store.walltimes.append
+    events = store.events.append
+    filenames = store.filenames.append
+    positions = store.positions.append
+    durations = store.durations.append
+    event_code = store.event_names._codes.get
+    event_encode = store.event_names.encode
+    filename_code = store.filename_names._codes.get
+    filename_encode = store.filename_names.encode
+    for line in lines:
+      if line[:1] == "@":
+        line = strip_checksum(line)
+        if line == None:
+          continue
+      data = line.rstrip("\n").split(' ')
+      if len(data)>=5:
+        try:
+          walltime = int(data[0])
+          position = int(data[-2])
+          duration = int(data[-1])
+        except ValueError:
+          continue
+        event = data[1]
+        filename = " ".join(data[2:-2])
+        e = event_code(event)
+        if e == None:
+          e = event_encode(event)
+        f = filename_code(filename)
+        if f == None:
+          f = filename_encode(filename)
+        walltimes(walltime)
+        events(e)
+        filenames(f)
+        positions(position)
+        durations(duration)
+    return store
+
+  def _append(self,walltime,event,filename,position,duration):
+    """Append an entry given as its fields. """
+    with self._lock:
+      self.walltimes.append(walltime)
+      self.events.append(self.event_names.encode(event))
+      self.filenames.append(self.filename_names.encode(filename))
+      self.positions.append(position)
+      self.durations.append(duration)
+
+  def append(self,entry):
+    """Append an entry.
+
+    Arguments:
+      entry   The LogEntry to append.
+    """
+    self._append(entry.walltime, entry.event, entry.filename, entry.position, entry.duration)
+
+  def event(self,i):
+    """Get the event name of an entry without creating a LogEntry. """
+    return self.event_names.values[self.events[i]]
+
+  def filename(self,i):
+    """Get the filename of an entry without creating a LogEntry. """
+    return self.filename_names.values[self.filenames[i]]
+
+  def __len__(self):
+    return len(self.walltimes)
+
+  def __getitem__(self,i):
+    with self._lock:
+      if isinstance(i,slice):
+        return [self[j] for j in xrange(*i.indices(len(self)))]
+      return LogEntry(int(self.walltimes[i]),
+                      self.event(i),
+                      self.filename(i),
+                      int(self.positions[i]),
+                      int(self.durations[i]))
+
+  def __iter__(self):
+    for i in xrange(0,len(self)):
+      yield self[i]
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""Which parts of each file have been listened to."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from bisect import bisect_left, bisect_right
+
+from pstorytime.logentry import LogEntry
+
+__all__ = [
+  'Intervals',
+  'Coverage',
+  ]
+
+class Intervals(object):
+  """Set of numbers stored as sorted, disjoint and non-adjacent intervals.
+
+  Adding an interval merges it with those it overlaps, so the number of
+  intervals stays small and lookups are done by bisection.
+
+  Fields:
+    length  Total length of the intervals.
+  """
+  def __init__(self):
+    """Create an empty set. """
+    self._starts = []
+    self._ends = []
+    self.length = 0
+
+  def add(self,start,end):
+    """Add the interval [start,end).
+
+    Arguments:
+      start   Start of the interval.
+      end     End of the interval, not included.
+    """
+    if end <= start:
+      return
+    # Intervals that overlap or touch the new one are merged into it.
+    first = bisect_left(self._ends,start)
+    last = bisect_right(self._starts,end)
+    if first < last:
+      start = min(start,self._starts[first])
+      end = max(end,self._ends[last-1])
+      for i in xrange(first,last):
+        self.length -= self._ends[i]-self._starts[i]
+    self._starts[first:last] = [start]
+    self._ends[first:last] = [end]
+    self.length += end-start
+
+  def total(self,limit=None):
+    """Get the total length of the intervals.
+
+    Arguments:
+      limit   Only count what is before this, or None to count everything.
+              (Optional, defaults to None.)
+
+    Returns:  The length.
+    """
+    total = 0
+    for (start,end) in zip(self._starts,self._ends):
+      if limit != None:
+        end = min(end,limit)
+        if start >= end:
+          break
+      total += end-start
+    return total
+
+  def first_gap(self,tolerance=0):
+    """Find the first number from zero that is not in the set.
+
+    Arguments:
+      tolerance   Gaps shorter than this are ignored. (Optional, defaults to
+                  0.)
+
+    Returns:      The start of the first gap.
+    """
+    position = 0
+    for (start,end) in zip(self._starts,self._ends):
+      if start-position > tolerance:
+        break
+      position = end
+    return position
+
+  def __iter__(self):
+    return iter(zip(self._starts,self._ends))
+
+  def __len__(self):
+    return len(self._starts)
+
+class Coverage(object):
+  """Which parts of each file have been listened to, worked out from the
+  entries of the playlog.
+
+  Playback is taken to go on from a start entry, or a seekto entry right after
+  a seekfrom entry, until the next entry. Entries other than those that end
+  playback continue it. If playback went on into another file, the rest of
+  the first file, the files in between and the start of the last file are
+  counted as listened to. Which files are in between is only known once
+  use_book() has been called.
+
+  Fields:
+    durations   Dictionary from filename to its duration in ns, as it was last
+                logged.
+  """
+  ENDS = ("seekfrom", "stop", "eob", "loadfail", "auto")
+  """Events that end playback. """
+
+  def __init__(self):
+    """Create an empty coverage. """
+    self._files = {}
+    self._playing = None
+    self._total = 0
+    self.durations = {}
+    self._index = None
+    self._duration = None
+
+  def use_book(self,index,duration):
+    """Use the files of the book to find which files playback went through
+    when it went on into a later file.
+
+    Arguments:
+      index     FileIndex of the audiobook files.
+      duration  Function that gives the duration of a file in ns, or None if
+                it is not known. It is used for files that have not been
+                logged with a duration.
+    """
+    self._index = index
+    self._duration = duration
+
+  def _duration_of(self,filename):
+    """Get the duration of a file in ns, 0 if it is not known. """
+    duration = self.durations.get(filename)
+    if duration == None and self._duration != None:
+      duration = self._duration(filename)
+    return duration if duration != None else 0
+
+  def _between(self,first,last):
+    """Get the files that playback went through from one file to a later one.
+
+    Returns:  List of filenames, not including first and last.
+    """
+    if self._index == None:
+      return []
+    i = self._index.index(first)
+    j = self._index.index(last)
+    if i == None or j == None or j <= i+1:
+      return []
+    return self._index.files()[i+1:j]
+
+  def update(self,entry,previous):
+    """Include the next entry of the playlog.
+
+    Arguments:
+      entry     The entry.
+      previous  The entry before it, or None if there is none.
+    """
+    if entry.duration > 0:
+      self.durations[entry.filename] = entry.duration
+    playing = self._playing
+    if playing != None:
+      if playing.filename == entry.filename:
+        self.add(entry.filename, playing.position, entry.position)
+      else:
+        self.add(playing.filename, playing.position,
+                 self._duration_of(playing.filename))
+        for filename in self._between(playing.filename,entry.filename):
+          self.add(filename, 0, self._duration_of(filename))
+        self.add(entry.filename, 0, entry.position)
+
+    if entry.event == "start":
+      self._playing = entry
+    elif entry.event == "seekto":
+      if previous != None and previous.event == "seekfrom":
+        self._playing = entry
+      else:
+        self._playing = None
+    elif playing != None and entry.event not in self.ENDS:
+      self._playing = entry
+    else:
+      self._playing = None
+
+  def add(self,filename,start,end):
+    """Mark a part of a file as listened to.
+
+    Arguments:
+      filename  The file.
+      start     Start of the part in ns.
+      end       End of the part in ns.
+    """
+    if end > start:
+      intervals = self._files.setdefault(filename,Intervals())
+      self._total -= intervals.length
+      intervals.add(start,end)
+      self._total += intervals.length
+
+  def total(self):
+    """Get how much has been listened to in all files together.
+
+    Returns:  Length in ns.
+    """
+    return self._total
+
+  def intervals(self,filename):
+    """Get the parts of a file that have been listened to.
+
+    Returns:  List of (start,end) in ns, in order.
+    """
+    intervals = self._files.get(filename)
+    return list(intervals) if intervals != None else []
+
+  def fraction(self,filename,duration=None):
+    """Get how much of a file has been listened to.
+
+    Arguments:
+      filename  The file.
+      duration  Duration of the file in ns, or None to use the last logged
+                one, or that of the book. (Optional, defaults to None.)
+
+    Returns:    Fraction between 0 and 1, or None if the duration is unknown.
+    """
+    if duration == None:
+      duration = self._duration_of(filename)
+    if duration == None or duration <= 0:
+      return None
+    intervals = self._files.get(filename)
+    if intervals == None:
+      return 0.0
+    return min(1.0, float(intervals.total(duration))/duration)
+
+  def first_gap(self,filename,duration=None,tolerance=0):
+    """Find the first part of a file that has not been listened to.
+
+    Arguments:
+      filename  The file.
+      duration  Duration of the file in ns, or None to use the last logged
+                one, or that of the book. (Optional, defaults to None.)
+      tolerance Gaps shorter than this in ns are ignored. (Optional, defaults
+                to 0.)
+
+    Returns:    Position of the gap in ns, or None if the whole file has been
+                listened to.
+    """
+    if duration == None:
+      duration = self._duration_of(filename)
+    intervals = self._files.get(filename)
+    if intervals == None:
+      return 0
+    gap = intervals.first_gap(tolerance)
+    if duration != None and duration > 0 and duration-gap <= tolerance:
+      return None
+    return gap
+
+  def lines(self):
+    """Convert the coverage to lines of text.
+
+    Returns:  List of lines without newlines.
+    """
+    lines = []
+    for (filename,intervals) in self._files.iteritems():
+      for (start,end) in intervals:
+        lines.append("heard {0} {1} {2}".format(start,end,filename))
+    for (filename,duration) in self.durations.iteritems():
+      lines.append("duration {0} {1}".format(duration,filename))
+    if self._playing != None:
+      lines.append("playing {0}".format(self._playing))
+    return lines
+
+  def parse(self,kind,data):
+    """Read a line from lines().
+
+    Arguments:
+      kind    The first word of the line.
+      data    The rest of the line.
+
+    Returns:  True if the line was understood.
+
+    Exceptions:
+      ValueError  If the line is invalid.
+    """
+    if kind == "heard":
+      (start,end,filename) = data.split(" ",2)
+      self.add(filename,int(start),int(end))
+    elif kind == "duration":
+      (duration,filename) = data.split(" ",1)
+      self.durations[filename] = int(duration)
+    elif kind == "playing":
+      self._playing = LogEntry.parse(data)
+    else:
+      return False
+    return True
@@ -29,6 +29,7 @@ from os.path import isfile, isdir, join, expanduser, dirname, basename
 import select
 import signal
 import os
+import sqlite3
 
 import pygst
 pygst.require("0.10")
@@ -43,7 +44,8 @@ import argparse
 import time
 
 from pstorytime.audiobook import AudioBook
-from pstorytime.misc import PathGen, FileLock, DummyLock, LockedException, ns_to_str, parse_pos
+from pstorytime.library import Library
+from pstorytime.misc import PathGen, FileLock, DummyLock, LockedException, ns_to_str, parse_pos, parse_walltime
 from pstorytime.timer import Timer
 import pstorytime.audiobookargs
 
@@ -56,9 +58,7 @@ class Select(object):
     self._audiobook = audiobook
     self._reader = reader
 
-    self._audiobook.connect("notify::playlog",self._on_playlog)
-
-    self._last_entry = None
+    self._audiobook.connect("appended",self._on_appended)
 
     self._logsel = LogSelect( self._window,
                               conf,
@@ -89,12 +89,10 @@ class Select(object):
           self._window.mvwin(geom.y,geom.x)
           self.update()
 
-  def _on_playlog(self,ab,prop):
+  def _on_appended(self,ab,first,count):
     with self._lock:
       if self._focus == self._logsel:
-        playlog = self._audiobook.playlog
-        if len(playlog)>0 and playlog[-1]!=self._last_entry:
-          self.update()
+        self._logsel.appended(first,count)
 
   def _on_event(self,obj,event):
     data = event.split()
@@ -128,6 +126,22 @@ class Select(object):
         self._swap_view()
         return True
 
+      elif cmd=="find" and len(data)>=2:
+        # The filename may contain spaces.
+        data = event.split(None,2)
+        filename = data[2] if len(data)==3 else None
+        self._focus = self._logsel
+        self._logsel.find(data[1],filename)
+        return True
+
+      elif cmd=="goto-time" and len(data)==2:
+        walltime = parse_walltime(data[1])
+        if walltime == None:
+          return False
+        self._focus = self._logsel
+        self._logsel.goto_time(walltime)
+        return True
+
       elif cmd=="select":
         if len(data)==2:
           (rel, pos) = parse_pos(data[1]) 
@@ -163,6 +177,11 @@ class LogSelect(object):
 
     self._focus = None
 
+    # Formatted rows by index in the playlog.
+    self._rows = {}
+    # (start,num,version) of what was drawn last, or None.
+    self._shown = None
+
   def getGeom(self):
     with self._lock:
       return self._geom
@@ -171,6 +190,8 @@ class LogSelect(object):
     with self._lock:
       with self._curseslock:
         self._geom = geom
+        self._rows = {}
+        self._shown = None
 
   def move(self,delta):
     with self._lock:
@@ -205,6 +226,33 @@ class LogSelect(object):
                                 focus = focus)
       self.draw()
 
+  def find(self,event,filename):
+    """Move to the closest entry before the selected one with the given event
+    name and filename.
+    """
+    with self._lock:
+      playlog = self._audiobook.playlog
+      if self._focus == None:
+        focus = len(playlog)
+      else:
+        focus = self._focus
+      found = self._audiobook.find_last(event,filename,focus)
+      if found != None:
+        self._focus = calc_focus( length = len(playlog),
+                                  focus = found)
+      self.draw()
+
+  def goto_time(self,walltime):
+    """Move to the first entry logged at or after the given walltime. """
+    with self._lock:
+      playlog = self._audiobook.playlog
+      if len(playlog) == 0:
+        return
+      focus = min(self._audiobook.find_time(walltime), len(playlog)-1)
+      self._focus = calc_focus( length = len(playlog),
+                                focus = focus)
+      self.draw()
+
   def select(self,rel,bufpos):
     with self._lock:
       ab = self._audiobook
@@ -224,6 +272,41 @@ class LogSelect(object):
         else:
           ab.seek(filename,position)
 
+  def appended(self,first,count):
+    """Show entries that were added to the playlog. If the end of the
+    playlog is shown, the new entries are scrolled in and only they are
+    drawn. Otherwise everything is redrawn.
+
+    Arguments:
+      first   Index of the first new entry.
+      count   Number of new entries.
+    """
+    with self._lock:
+      if not self._geom.is_sane() or self._focus != None or self._shown == None:
+        self.draw()
+        return
+      with self._curseslock:
+        playlog = self._audiobook.playlog
+        (old_start,old_num,version) = self._shown
+        if playlog.version == version:
+          return
+        num = min(self._geom.h, len(playlog))
+        start = max(0, len(playlog)-num)
+        delta = start - old_start
+        if delta < 0 or delta >= num or old_start+old_num < first:
+          self.draw()
+          return
+
+        if delta > 0:
+          self._window.scrollok(True)
+          self._window.scroll(delta)
+          self._window.scrollok(False)
+        for i in xrange(old_num-delta, num):
+          self._draw_row(playlog, i, start+i, False)
+        self._forget(start, num)
+        self._shown = (start, num, playlog.version)
+        self._window.refresh()
+
   def draw(self):
     with self._lock:
       if self._geom.is_sane():
@@ -247,47 +330,67 @@ class LogSelect(object):
           for i in xrange(0, num):
             # Position in playlog
             logi = i + start
-            # Check if this is the currently selected line
-            if logi == focus:
-              mark = "-> "
-              attr = curses.A_REVERSE
-            else:
-              mark = "   "
-              attr = curses.A_NORMAL
-
-            walltime = time.strftime("%Y-%m-%d %H:%M:%S",
-              time.gmtime(playlog[logi].walltime))
-
-            event = playlog[logi].event[:self._conf.event_len]
-            event += " " * (self._conf.event_len - len(event))
-
-            # Format all stuff before filename
-            part0 = "{mark}{walltime} {event} ".format(
-              mark = mark,
-              walltime = walltime,
-              event = event)
-
-            # Format all stuff after filename
-            position = ns_to_str(playlog[logi].position)
-            duration = ns_to_str(playlog[logi].duration)
-
-            part2 = " {position} / {duration}".format(
-              position=position,
-              duration=duration)
-
-            # Compute maximum length of filename
-            part1len = max(0, self._geom.w - 1 - len(part0) - len(part2))
-            # Take the end of filename, if it is too long.
-            part1 = playlog[logi].filename[-part1len:]
-
-            # Combine into complete line.
-            pad = " " * (part1len - len(part1))
-            line = part0 + part1 + pad + part2
-
-            if self._geom.h>=1:
-              self._window.addnstr(i, 0, line, self._geom.w-1,attr)
+            self._draw_row(playlog, i, logi, logi == focus)
+          self._forget(start, num)
+          self._shown = (start, num, playlog.version)
           self._window.refresh()
 
+  def _draw_row(self,playlog,i,logi,selected):
+    """Draw an entry of the playlog on a row of the window. """
+    # Check if this is the currently selected line
+    if selected:
+      mark = "-> "
+      attr = curses.A_REVERSE
+    else:
+      mark = "   "
+      attr = curses.A_NORMAL
+
+    # Entries never change, so the formatted rows are kept until they are
+    # scrolled out of view.
+    row = self._rows.get(logi)
+    if row == None:
+      row = self._format(playlog[logi], self._geom.w - 1 - len(mark))
+      self._rows[logi] = row
+
+    if self._geom.h>=1:
+      self._window.addnstr(i, 0, mark + row, self._geom.w-1,attr)
+
+  def _forget(self,start,num):
+    """Drop formatted rows that are not shown. """
+    for logi in self._rows.keys():
+      if logi < start or logi >= start+num:
+        del self._rows[logi]
+
+  def _format(self,entry,width):
+    """Format an entry of the playlog to fit the given width. """
+    walltime = time.strftime("%Y-%m-%d %H:%M:%S",
+      time.gmtime(entry.walltime))
+
+    event = entry.event[:self._conf.event_len]
+    event += " " * (self._conf.event_len - len(event))
+
+    # Format all stuff before filename
+    part0 = "{walltime} {event} ".format(
+      walltime = walltime,
+      event = event)
+
+    # Format all stuff after filename
+    position = ns_to_str(entry.position)
+    duration = ns_to_str(entry.duration)
+
+    part2 = " {position} / {duration}".format(
+      position=position,
+      duration=duration)
+
+    # Compute maximum length of filename
+    part1len = max(0, width - len(part0) - len(part2))
+    # Take the end of filename, if it is too long.
+    part1 = entry.filename[-part1len:]
+
+    # Combine into complete line.
+    pad = " " * (part1len - len(part1))
+    return part0 + part1 + pad + part2
+
 class FileSelect(object):
   def __init__(self,window,geom,curseslock,audiobook):
     self._lock = RLock()
@@ -383,14 +486,21 @@ class FileSelect(object):
               mark = "   "
               attr = curses.A_NORMAL
 
+            # How much of the file that has been listened to.
+            heard = self._audiobook.heard(filelist[listi])
+            if heard != None:
+              part1 = " {0:>4.0%}".format(heard)
+            else:
+              part1 = " " * 5
+
             # Compute maximum length of filename
-            part0len = max(0, self._geom.w - 1 - len(mark))
+            part0len = max(0, self._geom.w - 1 - len(mark) - len(part1))
             # Take the end of filename, if it is too long.
             part0 = filelist[listi][-part0len:]
 
             # Combine into complete line.
             pad = " " * (part0len - len(part0))
-            line = mark + part0 + pad
+            line = mark + part0 + pad + part1
 
             if self._geom.h>=1:
               self._window.addnstr(i, 0, line, self._geom.w-1,attr)
@@ -594,9 +704,11 @@ class Volume(object):
     self._lock = RLock()
     self._curseslock = curseslock
     self._window = geom.newwin()
+    self._audiobook = audiobook
     self._gst = audiobook.gst()
     self._geom = geom
-    self._gst.connect("notify::volume",self._on_volume)
+    self._volume_id = self._gst.connect("notify::volume",self._on_volume)
+    self._audiobook.connect("position",self._on_position)
     self.update()
 
   def getGeom(self):
@@ -616,6 +728,16 @@ class Volume(object):
     with self._lock:
       self.update()
 
+  def _on_position(self,ab):
+    # The gstreamer object may have been replaced when a file was loaded.
+    with self._lock:
+      gst = ab.gst()
+      if gst is not self._gst:
+        self._gst.disconnect(self._volume_id)
+        self._gst = gst
+        self._volume_id = self._gst.connect("notify::volume",self._on_volume)
+        self.update()
+
   def update(self):
     with self._lock:
       if self._geom.is_sane():
@@ -641,7 +763,7 @@ class Status(object):
       conf        The parsed program configuration.
       audiobook   The audiobook object to create a view for.
       geom        Geometry of the window.
-      interval    How often to show position while playing.
+      interval    How often to show position while playing, in seconds.
     """
     self._lock = RLock()
     self._curseslock = curseslock
@@ -652,7 +774,7 @@ class Status(object):
       self._audiobook.connect("notify::playing",self._on_playing)
       self._gst = self._audiobook.gst()
       self._window = geom.newwin()
-      self._timer = Timer(interval*1000, self._on_timer, repeat=True)
+      self._timer = Timer(int(interval*1000), self._on_timer, repeat=True)
       self.update()
 
   def getGeom(self):
@@ -697,7 +819,9 @@ class Status(object):
   def update(self):
     with self._lock:
       if self._geom.is_sane():
-        (filename,position,duration) = self._audiobook.position()
+        # Does not wait for the audiobook, so that the status is shown even
+        # while a file is loading.
+        (filename,position,duration) = self._audiobook.cached_position()
         if filename == None:
           filename = ""
 
@@ -790,6 +914,10 @@ class CursesUI(object):
                     "KEY_NPAGE":"npage",
                     "^I":"swap_view",
                     "*":"mark *",
+                    "m":"find *",
+                    "b":"back",
+                    "f":"forward",
+                    "g":"gap",
                     "^J":"select {b}",
                     "1":"buffer store 1",
                     "2":"buffer store 2",
@@ -837,7 +965,7 @@ class CursesUI(object):
                               conf=conf,
                               audiobook=self._audiobook,
                               geom=status_geom,
-                              interval=1)
+                              interval=0.1)
 
         self._select = Select(curseslock=self._curseslock,
                               conf=conf,
@@ -942,6 +1070,81 @@ class CursesUI(object):
     except (KeyboardInterrupt, SystemExit):
       self.quit()
 
+class LibraryBrowser(object):
+  """Lists the audiobooks in the library, the most recently listened to
+  first, and lets one of them be picked.
+  """
+  def __init__(self,stdscr,books):
+    """Create the browser.
+
+    Arguments:
+      stdscr  The curses window to use.
+      books   List of Book from the library.
+    """
+    self._window = stdscr
+    self._books = books
+    self._focus = 0
+
+  def run(self):
+    """Show the books until one is picked.
+
+    Returns:  The picked Book, or None if none was.
+    """
+    curses.curs_set(0)
+    self._window.keypad(1)
+    while True:
+      self.draw()
+      key = self._window.getch()
+      h = max(1,self._window.getmaxyx()[0])
+      if key in (curses.KEY_UP, ord('k')):
+        self._focus -= 1
+      elif key in (curses.KEY_DOWN, ord('j')):
+        self._focus += 1
+      elif key == curses.KEY_PPAGE:
+        self._focus -= h
+      elif key == curses.KEY_NPAGE:
+        self._focus += h
+      elif key == curses.KEY_HOME:
+        self._focus = 0
+      elif key == curses.KEY_END:
+        self._focus = len(self._books)-1
+      elif key in (curses.KEY_ENTER, ord('\n')):
+        if len(self._books)>0:
+          return self._books[self._focus]
+      elif key in (ord('q'), 27):
+        return None
+      self._focus = max(0, min(len(self._books)-1, self._focus))
+
+  def draw(self):
+    (h,w) = self._window.getmaxyx()
+    self._window.erase()
+    if len(self._books)==0:
+      self._window.addnstr(0, 0, "The library is empty.", w-1)
+    start = max(0, min(len(self._books)-h, self._focus - h/2))
+    for (i,book) in enumerate(self._books[start:start+h]):
+      if i+start == self._focus:
+        mark = "-> "
+        attr = curses.A_REVERSE
+      else:
+        mark = "   "
+        attr = curses.A_NORMAL
+
+      walltime = time.strftime("%Y-%m-%d %H:%M", time.gmtime(book.walltime))
+      if book.duration:
+        progress = " {0:>4.0%}".format(min(1.0, float(book.listened)/book.duration))
+      else:
+        progress = " " * 5
+
+      part0 = "{mark}{walltime}{progress} ".format(
+        mark = mark,
+        walltime = walltime,
+        progress = progress)
+      part1len = max(0, w - 1 - len(part0))
+      part1 = basename(book.directory)[-part1len:]
+      line = part0 + part1 + " " * (part1len - len(part1))
+      self._window.addnstr(i, 0, line, w-1, attr)
+    self._window.refresh()
+
 class Actuator(object):
   """A command actuator for the audiobook player.
   """
@@ -993,11 +1196,23 @@ class Actuator(object):
 
           elif cmd=="stepfile" and len(data)==2:
             delta = int(data[1])
-            new_file = ab._get_file(delta)
+            new_file = ab.get_file(delta)
             if new_file!=None:
               ab.seek(start_file=new_file,start_pos=0)
             return True
 
+          elif cmd=="back" and len(data)==1:
+            ab.back()
+            return True
+
+          elif cmd=="forward" and len(data)==1:
+            ab.forward()
+            return True
+
+          elif cmd=="gap" and len(data)==1:
+            ab.gap()
+            return True
+
           elif cmd=="play_pause" and len(data)==1:
             ab.play_pause()
             return True
@@ -1074,6 +1289,21 @@ def run():
     help="Path to the file to save playlog in relative to current directory. See section on paths. (Default: %(default)s)",
     default="{conf}/logs/{audiobook}/.playlog")
 
+  parser.add_argument(
+    "--library-file",
+    help="Path to the library index of all audiobooks, or nothing to not keep one. See section on paths. (Default: %(default)s)",
+    default="{conf}/library.db")
+
+  parser.add_argument(
+    "--library",
+    help="Pick the audiobook to play from the library index, instead of giving its path.",
+    action='store_true')
+
+  parser.add_argument(
+    "--resume-last",
+    help="Play the audiobook that was listened to most recently, according to the library index, instead of giving its path.",
+    action='store_true')
+
   parser.add_argument(
     "--conf-dir",
     help="Configuration directory (Default: %(default)s)",
@@ -1145,6 +1375,25 @@ def run():
     conf = parser.parse_args(["@"+configfile])
     conf = parser.parse_args(namespace=conf)
 
+  if conf.library or conf.resume_last:
+    library = Library(PathGen(conf.conf_dir,".").gen(conf.library_file))
+    try:
+      if conf.resume_last:
+        book = library.last()
+        if book == None:
+          print("The library is empty.")
+          exit(1)
+      else:
+        book = curses.wrapper(lambda stdscr: LibraryBrowser(stdscr,library.books()).run())
+        if book == None:
+          exit(0)
+    except (sqlite3.Error, OSError):
+      print("Failed to read library index: {0}".format(library.path))
+      exit(1)
+    finally:
+      library.close()
+    conf.path = book.directory
+
   if isfile(conf.path):
     directory = dirname(conf.path)
     filename = basename(conf.path)
@@ -1158,6 +1407,7 @@ def run():
   gen = PathGen(conf.conf_dir,directory)
   conf.playlog_file = gen.gen(conf.playlog_file)
   conf.cmdpipe = gen.gen(conf.cmdpipe)
+  conf.library_file = gen.gen(conf.library_file)
 
   if conf.cmdpipe==None or conf.cmdpipe=="":
     pipelock = DummyLock()
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""Table of file durations used to treat an audiobook as one stream."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+from os.path import join, dirname, isdir
+from bisect import bisect_right
+import os
+import threading
+
+__all__ = [
+  'DurationTable',
+  ]
+
+class DurationTable(object):
+  """Durations of the files in an audiobook with cumulative offsets.
+
+  Durations are probed once and cached on disk, keyed by filename, size and
+  modification time. The cumulative offsets make it possible to map a position
+  in the whole book to a file and a position in that file by bisection.
+
+  Files whose durations are not known are probed one at a time in a background
+  thread, starting with those nearest the file given to focus(). Until then,
+  total() and offset() report that they can not tell, and resolve() goes from
+  file to file over the durations that are known. Only duration() probes
+  right away.
+  """
+  def __init__(self,directory,index,probe,cachefile):
+    """Create the duration table.
+
+    Arguments:
+      directory   Directory of the audiobook.
+      index       FileIndex of the audiobook files.
+      probe       Function that takes a filename and returns its duration in
+                  ns, or None if the duration could not be found.
+      cachefile   File to cache durations in, or None to not cache them.
+    """
+    self._lock = threading.RLock()
+    self._directory = directory
+    self._index = index
+    self._probe = probe
+    self._cachefile = cachefile
+
+    # filename -> (size,mtime,duration)
+    self._cache = {}
+    self._dirty = False
+
+    # Order of files and offset of their start in the book. The offsets list
+    # contains one more item than files, which is the total duration.
+    self._generation = None
+    self._files = []
+    self._offsets = [0]
+    self._positions = {}
+    # Files in the offsets whose durations are not known yet.
+    self._missing = set()
+    self._focus = None
+
+    # Files that could not be probed, as (filename,size,mtime), so that they
+    # are not tried again.
+    self._failed = set()
+    self._prober = None
+    self._closed = False
+
+    self._load()
+
+  def _load(self):
+    """Load cached durations from file. """
+    with self._lock:
+      if self._cachefile == None:
+        return
+      try:
+        with open(self._cachefile,'rb') as f:
+          for line in f:
+            data = line.rstrip("\n").split(' ',3)
+            if len(data)==4:
+              try:
+                self._cache[data[3]] = (int(data[0]),float(data[1]),int(data[2]))
+              except ValueError:
+                pass
+      except IOError:
+        pass
+
+  def save(self):
+    """Write the durations to the cache file if anything has changed. It is
+    only needed when the table is no longer used.
+
+    Exceptions:
+      IOError, OSError  If the file could not be written.
+    """
+    with self._lock:
+      if self._cachefile == None or not self._dirty:
+        return
+      dirpath = dirname(self._cachefile)
+      if not isdir(dirpath) and dirpath!='':
+        os.makedirs(dirpath,mode=0700)
+      tmpfile = self._cachefile+".tmp"
+      with open(tmpfile,'wb') as f:
+        for (filename,(size,mtime,duration)) in self._cache.iteritems():
+          f.write("{0} {1!r} {2} {3}\n".format(size,mtime,duration,filename))
+        f.flush()
+        os.fsync(f.fileno())
+      os.rename(tmpfile,self._cachefile)
+      self._dirty = False
+
+  def _stat(self,filename):
+    """Get the cache key of a file.
+
+    Returns:  (size,mtime) or None if the file could not be read.
+    """
+    try:
+      st = os.stat(join(self._directory,filename))
+      return (st.st_size,st.st_mtime)
+    except OSError:
+      return None
+
+  def duration(self,filename):
+    """Get the duration of a file, probing it if it is not already known.
+
+    Arguments:
+      filename  The file to get the duration of.
+
+    Returns:    Duration in ns, 0 if it could not be found.
+    """
+    with self._lock:
+      key = self._stat(filename)
+      if key == None:
+        return 0
+      cached = self._cache.get(filename)
+      if cached != None and cached[0:2] == key:
+        return cached[2]
+      if (filename,)+key in self._failed:
+        return 0
+      duration = self._probe(filename)
+      if duration == None:
+        self._failed.add((filename,)+key)
+        return 0
+      self._set(filename,key,duration)
+      return duration
+
+  def known(self,filename):
+    """Get the duration of a file if it is known, without probing it.
+
+    Returns:  Duration in ns, 0 if it can not be found, or None if the file
+              has not been probed yet.
+    """
+    with self._lock:
+      key = self._stat(filename)
+      if key == None or (filename,)+key in self._failed:
+        return 0
+      cached = self._cache.get(filename)
+      if cached != None and cached[0:2] == key:
+        return cached[2]
+      return None
+
+  def update(self,filename,duration):
+    """Record a duration that was found some other way than probing.
+
+    Arguments:
+      filename  The file that the duration belongs to.
+      duration  Its duration in ns.
+    """
+    with self._lock:
+      key = self._stat(filename)
+      if key != None:
+        cached = self._cache.get(filename)
+        if cached == None or cached != key+(duration,):
+          self._set(filename,key,duration)
+
+  def _set(self,filename,key,duration):
+    """Store a duration and move the offsets of the following files. """
+    with self._lock:
+      self._cache[filename] = key+(duration,)
+      self._dirty = True
+      self._missing.discard(filename)
+      i = self._positions.get(filename)
+      if i != None:
+        delta = duration - (self._offsets[i+1] - self._offsets[i])
+        if delta != 0:
+          for j in xrange(i+1,len(self._offsets)):
+            self._offsets[j] += delta
+
+  def _refresh(self):
+    """Recompute the offsets if the files have changed, without probing. Files
+    that are not known are handed to the background prober. """
+    with self._lock:
+      files = self._index.files()
+      if self._generation == self._index.generation and self._files is files:
+        return
+      offsets = [0]
+      missing = set()
+      for filename in files:
+        duration = self.known(filename)
+        if duration == None:
+          missing.add(filename)
+          duration = 0
+        offsets.append(offsets[-1] + duration)
+      self._files = files
+      self._offsets = offsets
+      self._positions = dict((f,i) for (i,f) in enumerate(files))
+      self._missing = missing
+      self._generation = self._index.generation
+      if len(missing) > 0 and self._prober == None and not self._closed:
+        self._prober = threading.Thread(target=self._run, name="DurationTable")
+        self._prober.daemon = True
+        self._prober.start()
+
+  def focus(self,filename):
+    """Probe the files nearest the given one first.
+
+    Arguments:
+      filename  The file, such as the one that is playing.
+    """
+    with self._lock:
+      self._focus = filename
+
+  def _next_pending(self):
+    """Pick the file to probe next, the one nearest the focus.
+
+    Returns:  The filename, or None if there is none.
+    """
+    with self._lock:
+      if len(self._missing) == 0:
+        return None
+      focus = self._positions.get(self._focus,0)
+      return min(self._missing, key=lambda f: abs(self._positions[f]-focus))
+
+  def _run(self):
+    """Background thread that probes the files that are not known, one at a
+    time. The lock is not held while probing, and the index is not used, as
+    it is only refreshed by the users of the table. """
+    while True:
+      with self._lock:
+        filename = self._next_pending()
+        if filename == None or self._closed:
+          self._prober = None
+          return
+        key = self._stat(filename)
+        if key == None or self.known(filename) != None:
+          self._missing.discard(filename)
+          continue
+      duration = self._probe(filename)
+      with self._lock:
+        if key != self._stat(filename):
+          continue
+        if duration == None:
+          self._failed.add((filename,)+key)
+          self._missing.discard(filename)
+        else:
+          self._set(filename,key,duration)
+
+  def close(self):
+    """Stop probing in the background, and wait for a probe in progress. """
+    with self._lock:
+      self._closed = True
+      prober = self._prober
+    if prober != None:
+      prober.join()
+
+  def offset(self,filename):
+    """Get the position in the book where a file starts.
+
+    Arguments:
+      filename  The file to look up.
+
+    Returns:    Offset in ns, or None if the file is not in the book or the
+                duration of a file before it is not known yet.
+    """
+    with self._lock:
+      self._refresh()
+      i = self._positions.get(filename)
+      if i == None:
+        return None
+      if any(self._positions[f] < i for f in self._missing):
+        return None
+      return self._offsets[i]
+
+  def total(self):
+    """Get the duration of the whole book.
+
+    Returns:  Duration in ns, or None if the durations of some files are not
+              known yet.
+    """
+    with self._lock:
+      self._refresh()
+      if len(self._missing) > 0:
+        return None
+      return self._offsets[-1]
+
+  def known_total(self):
+    """Get the duration of the whole book without probing any files. Files
+    with unknown durations count as zero.
+
+    Returns:  Duration in ns.
+    """
+    with self._lock:
+      total = 0
+      for filename in self._index.files():
+        cached = self._cache.get(filename)
+        if cached != None:
+          total += cached[2]
+      return total
+
+  def resolve(self,filename,position):
+    """Find the file and position in that file of a position relative to the
+    start of another file, without probing any files. The offsets are
+    bisected when the durations of all files are known. Otherwise it goes from
+    file to file, and stops in the first file whose duration is not known:
+    at the position that is left if going forward, and at its beginning if
+    going backward.
+
+    Positions before the beginning are clamped to the start of the first file
+    and positions after the end are clamped to the end of the last file.
+
+    Arguments:
+      filename  The file the position is relative to, which must be in the
+                index.
+      position  Position in ns.
+
+    Returns:    (filename,position)
+    """
+    with self._lock:
+      self._refresh()
+      i = self._positions.get(filename)
+      if i != None and len(self._missing) == 0:
+        return self.locate(self._offsets[i]+position)
+      duration = self.known(filename)
+      if duration == None:
+        return (filename,max(0,position))
+      while position >= duration:
+        following = self._index.relative(filename,1)
+        if following == None:
+          return (filename,duration)
+        position -= duration
+        filename = following
+        duration = self.known(filename)
+        if duration == None:
+          return (filename,position)
+      while position < 0:
+        previous = self._index.relative(filename,-1)
+        if previous == None:
+          return (filename,0)
+        filename = previous
+        duration = self.known(filename)
+        if duration == None:
+          return (filename,0)
+        position += duration
+      return (filename,position)
+
+  def locate(self,position):
+    """Find the file and position in that file of a position in the book.
+
+    Positions before the beginning are clamped to the start of the first file
+    and positions after the end are clamped to the end of the last file.
+
+    Arguments:
+      position  Position in the book in ns.
+
+    Returns:    (filename,position), or (None,None) if the book is empty or
+                the durations of some files are not known yet.
+    """
+    with self._lock:
+      self._refresh()
+      if len(self._files) == 0 or len(self._missing) > 0:
+        return (None,None)
+      if position < 0:
+        return (self._files[0],0)
+      if position >= self._offsets[-1]:
+        last = len(self._files)-1
+        return (self._files[last],self._offsets[-1]-self._offsets[last])
+      # Files with zero duration share offsets with the next file, so this
+      # always picks the file that actually contains the position.
+      i = bisect_right(self._offsets,position)-1
+      return (self._files[i],position-self._offsets[i])
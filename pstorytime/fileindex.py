@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""Cached index of the audio files in an audiobook directory."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+
+import pstorytime.inotify as inotify
+
+__all__ = [
+  'FileIndex',
+  ]
+
+_DIR_EVENTS = ( inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM
+              | inotify.IN_MOVED_TO | inotify.IN_ATTRIB | inotify.IN_DELETE_SELF
+              | inotify.IN_MOVE_SELF )
+
+_GONE = inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_IGNORED
+
+class FileIndex(object):
+  """Sorted list of audio files in a directory with a filename to index map.
+
+  The directory is only listed again when it has changed. Changes are detected
+  with inotify when it is available. The modification time and size of the
+  directory are also compared, at most every RECHECK seconds, since inotify
+  may not be available and does not see changes made by other hosts on a
+  network file system.
+  """
+  RECHECK = 1.0
+  """Least time in seconds between checks of the modification time. """
+
+  MTIME_RESOLUTION = 2.0
+  """Resolution of modification times that is allowed for, which is that of
+  FAT. """
+
+  def __init__(self,directory,accept):
+    """Create the index.
+
+    Arguments:
+      directory   The directory to index.
+      accept      Function that takes a filename and returns True if it
+                  should be included in the index.
+    """
+    self._lock = threading.RLock()
+    self._directory = directory
+    self._accept = accept
+    self._files = []
+    self._positions = {}
+    self._signature = None
+    self._scanned = 0
+    self._checked = 0
+    self.generation = 0
+    """Increased every time the list of files is rebuilt. """
+
+    self._watch = None
+    self._scan()
+
+  def _stale(self):
+    """Check if the directory has changed since it was last listed.
+
+    Returns:  True if so.
+    """
+    if self._watch != None:
+      events = self._watch.read()
+      if any(mask & _GONE for (mask,_) in events):
+        # The directory was removed or moved away, so the watch is dead. The
+        # path is watched again when it is listed.
+        self._watch.close()
+        self._watch = None
+      if len(events) > 0:
+        return True
+    now = time.time()
+    if now - self._checked < self.RECHECK:
+      return False
+    self._checked = now
+    if self._signature != None and \
+       self._scanned - self._signature[0] < self.MTIME_RESOLUTION:
+      # The directory was changed so shortly before it was listed that a
+      # later change could have the same modification time.
+      return True
+    return self._stat() != self._signature
+
+  def _stat(self):
+    """Get what the modification check compares.
+
+    Returns:  (mtime,size) of the directory, or None if it does not exist.
+    """
+    try:
+      st = os.stat(self._directory)
+      return (st.st_mtime, st.st_size)
+    except OSError:
+      return None
+
+  def _scan(self):
+    """List the directory and rebuild the index. """
+    with self._lock:
+      # Start watching before listing so that no change can be missed. This
+      # also watches the directory again if it had been replaced.
+      if self._watch == None:
+        self._watch = inotify.watch(self._directory, _DIR_EVENTS)
+      self._scanned = time.time()
+      self._checked = self._scanned
+      self._signature = self._stat()
+      try:
+        entries = os.listdir(self._directory)
+      except OSError:
+        entries = []
+      entries.sort()
+      # Build new objects rather than changing the old ones, so that lists
+      # that have already been handed out stay valid.
+      self._files = filter(self._accept, entries)
+      self._positions = dict((f,i) for (i,f) in enumerate(self._files))
+      # Replaced in one assignment, so that peek() sees a consistent pair
+      # without taking the lock.
+      self._snapshot = (self._files, self._positions)
+      self.generation += 1
+
+  def _check(self):
+    """Rebuild the index if the directory has changed. """
+    with self._lock:
+      if self._stale():
+        self._scan()
+
+  def files(self):
+    """All files in the index.
+
+    Returns:  Sorted list of filenames. It must not be modified.
+    """
+    with self._lock:
+      self._check()
+      return self._files
+
+  def index(self,filename):
+    """Get the index of the given file.
+
+    Arguments:
+      filename  The filename to look up.
+
+    Returns:    The index, or None if the file is not in the index.
+    """
+    with self._lock:
+      self._check()
+      return self._positions.get(filename)
+
+  def relative(self,filename,delta):
+    """Get a file relative to another one.
+
+    Arguments:
+      filename  The file to start from.
+      delta     Number of steps to move in the index.
+
+    Returns:    The filename, or None if there is no such file.
+    """
+    with self._lock:
+      self._check()
+      i = self._positions.get(filename)
+      if i != None and 0 <= i+delta < len(self._files):
+        return self._files[i+delta]
+      else:
+        return None
+
+  def peek(self,filename,delta):
+    """Like relative(), but uses the files as they were when the directory
+    was last listed. It neither checks the directory nor takes the lock, so
+    it can be called from any thread, such as a gstreamer streaming thread.
+
+    Arguments:
+      filename  The file to start from.
+      delta     Number of steps to move in the index.
+
+    Returns:    The filename, or None if there is no such file.
+    """
+    (files,positions) = self._snapshot
+    i = positions.get(filename)
+    if i != None and 0 <= i+delta < len(files):
+      return files[i+delta]
+    else:
+      return None
+
+  def rescan(self):
+    """Unconditionally list the directory again. """
+    with self._lock:
+      self._scan()
+
+  def close(self):
+    """Stop watching the directory for changes. """
+    with self._lock:
+      if self._watch != None:
+        self._watch.close()
+        self._watch = None
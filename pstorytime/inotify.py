@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Minimal inotify binding used to detect changes without polling the disk."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+__all__ = [
+  'Watch',
+  'watch',
+  ]
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+_EVENT = struct.Struct("iIII")
+
+def _load_libc():
+  """Load the C library if it provides inotify.
+
+  Returns:  The library handle, or None if inotify is not available.
+  """
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                       use_errno=True)
+    libc.inotify_init1
+    libc.inotify_add_watch
+    return libc
+  except (OSError, AttributeError):
+    return None
+
+_libc = _load_libc()
+
+class Watch(object):
+  """Non-blocking inotify watch on a single path. """
+  def __init__(self,path,mask):
+    """Start watching the given path.
+
+    Arguments:
+      path  The file or directory to watch.
+      mask  Bitmask of IN_* events to watch for.
+
+    Exceptions:
+      OSError   If inotify is unavailable or the watch could not be added.
+    """
+    if _libc == None:
+      raise OSError(errno.ENOSYS,"inotify is not available")
+    self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self._fd < 0:
+      raise OSError(ctypes.get_errno(),"inotify_init1 failed")
+    if _libc.inotify_add_watch(self._fd, path, mask) < 0:
+      err = ctypes.get_errno()
+      os.close(self._fd)
+      self._fd = None
+      raise OSError(err,"inotify_add_watch failed: {0}".format(path))
+
+  def fileno(self):
+    """File descriptor that becomes readable when events are pending. """
+    return self._fd
+
+  def read(self):
+    """Read all pending events without blocking.
+
+    Returns:  List of (mask,name) tuples. Empty if nothing happened.
+    """
+    events = []
+    while self._fd != None:
+      try:
+        data = os.read(self._fd, 4096)
+      except OSError as e:
+        if e.errno == errno.EAGAIN:
+          break
+        raise
+      offset = 0
+      while offset + _EVENT.size <= len(data):
+        (_, mask, _, length) = _EVENT.unpack_from(data, offset)
+        offset += _EVENT.size
+        name = data[offset:offset+length].rstrip("\0")
+        offset += length
+        events.append((mask,name))
+    return events
+
+  def changed(self):
+    """Consume pending events.
+
+    Returns:  True if any event was pending.
+    """
+    return len(self.read()) > 0
+
+  def close(self):
+    """Stop watching. """
+    if self._fd != None:
+      os.close(self._fd)
+      self._fd = None
+
+def watch(path,mask):
+  """Try to watch the given path.
+
+  Arguments:
+    path  The file or directory to watch.
+    mask  Bitmask of IN_* events to watch for.
+
+  Returns:  A Watch, or None if inotify can not be used for the path.
+  """
+  try:
+    return Watch(path,mask)
+  except OSError:
+    return None
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""Index of all audiobooks, stored in an SQLite database."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from os.path import dirname, isdir
+from collections import namedtuple
+import os
+import sqlite3
+import threading
+
+__all__ = [
+  'Book',
+  'Library',
+  'LibraryUpdater',
+  ]
+
+Book = namedtuple("Book", [
+  "directory",
+  "playlog_file",
+  "filename",
+  "position",
+  "walltime",
+  "listened",
+  "files",
+  "duration",
+  ])
+"""An audiobook in the library.
+
+Fields:
+  directory     Directory of the audiobook.
+  playlog_file  Path to its playlog.
+  filename      File of the last entry in the playlog.
+  position      Position in ns of the last entry in the playlog.
+  walltime      Walltime of the last entry in the playlog.
+  listened      How much of the book has been listened to, in ns.
+  files         Number of files in the book, or None if not known.
+  duration      Duration of the book in ns, or None if not known.
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+  directory TEXT PRIMARY KEY,
+  playlog_file TEXT NOT NULL,
+  filename TEXT NOT NULL,
+  position INTEGER NOT NULL,
+  walltime INTEGER NOT NULL,
+  listened INTEGER NOT NULL,
+  files INTEGER,
+  duration INTEGER
+);
+CREATE INDEX IF NOT EXISTS books_walltime ON books (walltime);
+"""
+
+class Library(object):
+  """Index of all audiobooks that have been listened to, with where and when
+  they were last listened to and how much of them that has been heard.
+
+  The index is kept up to date by the log of each audiobook, so it can be
+  shown without reading any playlogs. The database is opened when it is first
+  used, and the object may be used from any thread.
+
+  Fields:
+    path  Path to the database file.
+  """
+  def __init__(self,path):
+    """Create the library handler.
+
+    Arguments:
+      path  Path to the database file.
+    """
+    self._lock = threading.RLock()
+    self.path = path
+    self._db = None
+
+  def _open(self):
+    """Open the database, creating it if needed.
+
+    Returns:  The connection.
+
+    Exceptions:
+      sqlite3.Error, OSError  If it could not be opened.
+    """
+    with self._lock:
+      if self._db == None:
+        dirpath = dirname(self.path)
+        if not isdir(dirpath) and dirpath!='':
+          os.makedirs(dirpath,mode=0700)
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.text_factory = str
+        db.executescript(_SCHEMA)
+        self._db = db
+      return self._db
+
+  def update(self,directory,playlog_file,entry,listened,files=None,duration=None):
+    """Record the last entry of an audiobook.
+
+    Arguments:
+      directory     Directory of the audiobook.
+      playlog_file  Path to its playlog.
+      entry         The last entry in its playlog.
+      listened      How much of the book has been listened to, in ns.
+      files         Number of files in the book, or None to keep the old
+                    value. (Optional, defaults to None.)
+      duration      Duration of the book in ns, or None to keep the old value.
+                    (Optional, defaults to None.)
+
+    Exceptions:
+      sqlite3.Error, OSError  If it could not be written.
+    """
+    with self._lock:
+      db = self._open()
+      with db:
+        old = db.execute("SELECT files, duration FROM books WHERE directory = ?",
+                         (directory,)).fetchone()
+        if old != None:
+          if files == None:
+            files = old[0]
+          if duration == None:
+            duration = old[1]
+        db.execute("INSERT OR REPLACE INTO books VALUES (?,?,?,?,?,?,?,?)",
+                   (directory, playlog_file, entry.filename, entry.position,
+                    entry.walltime, listened, files, duration))
+
+  def books(self):
+    """Get all audiobooks, the most recently listened to first.
+
+    Returns:  List of Book.
+
+    Exceptions:
+      sqlite3.Error, OSError  If it could not be read.
+    """
+    with self._lock:
+      rows = self._open().execute("SELECT * FROM books ORDER BY walltime DESC")
+      return [Book(*row) for row in rows]
+
+  def last(self):
+    """Get the audiobook that was listened to most recently.
+
+    Returns:  The Book, or None if the library is empty.
+
+    Exceptions:
+      sqlite3.Error, OSError  If it could not be read.
+    """
+    with self._lock:
+      row = self._open().execute(
+        "SELECT * FROM books ORDER BY walltime DESC LIMIT 1").fetchone()
+      return Book(*row) if row != None else None
+
+  def close(self):
+    """Close the database. """
+    with self._lock:
+      if self._db != None:
+        self._db.close()
+        self._db = None
+
+class LibraryUpdater(object):
+  """Writes updates to a library from a background thread, so that no one
+  waits for the database. While an update waits to be written, a newer one
+  of the same audiobook replaces it.
+  """
+  def __init__(self,library,error):
+    """Create the updater. The thread is started when it is first needed.
+
+    Arguments:
+      library   The Library to update.
+      error     Function that is called with an error message if an update
+                fails. It is called from the background thread.
+    """
+    self._lock = threading.Condition(threading.RLock())
+    self.library = library
+    self._error = error
+    # directory -> arguments of Library.update(), in no particular order.
+    self._pending = {}
+    self._thread = None
+    self._closed = False
+
+  def update(self,directory,playlog_file,entry,listened,files=None,duration=None):
+    """Record the last entry of an audiobook later. See Library.update(). """
+    with self._lock:
+      if self._closed:
+        return
+      self._pending[directory] = (directory,playlog_file,entry,listened,files,duration)
+      if self._thread == None:
+        self._thread = threading.Thread(target=self._run, name="LibraryUpdater")
+        self._thread.daemon = True
+        self._thread.start()
+      self._lock.notify()
+
+  def _run(self):
+    """Background thread that writes the updates. """
+    while True:
+      with self._lock:
+        while len(self._pending)==0 and not self._closed:
+          self._lock.wait()
+        if len(self._pending)==0:
+          return
+        updates = self._pending.values()
+        self._pending.clear()
+      for args in updates:
+        try:
+          self.library.update(*args)
+        except (sqlite3.Error, OSError):
+          self._error("Failed to update library index: {0}".format(self.library.path))
+
+  def close(self):
+    """Write the waiting updates, stop the thread and close the library. """
+    with self._lock:
+      self._closed = True
+      thread = self._thread
+      self._lock.notify()
+    if thread != None:
+      thread.join()
+    self.library.close()
@@ -22,102 +22,87 @@
 __all__ = [
   'LogEntry',
   'Log',
+  'LogFollower',
   ]
 
-from os.path import isfile, dirname, isdir
+import errno
 import os
+import select
 import threading
 import time
 import gobject
 
 from pstorytime.timer import Timer
+from pstorytime.logentry import LogEntry
+from pstorytime.playlog import Playlog, Segment, PageCache, MappedEntries, Snapshot, PostingIndex, segment_file, segment_files, read_entries, find_walltime, STORES
+from pstorytime.logwriter import LogWriter
+from pstorytime.autolog import AutoLog
+from pstorytime.library import Library, LibraryUpdater
+from pstorytime.logcheck import add_checksum, repair_tail, Verifier
 from pstorytime.misc import withdoc
+import pstorytime.inotify as inotify
 
-class LogEntry(gobject.GObject):
-  """Each event in the playlog is represented with one of these. """
-  @withdoc(gobject.property)
-  def walltime(self):
-    """Walltime when the event occurred. """
-    return self._walltime
+class Log(gobject.GObject):
+  """The playlog of an audiobook.
 
-  @withdoc(gobject.property)
-  def event(self):
-    """What happened. (Start/stop/seek etc.) """
-    return self._event
+  The playlog is split into segments of limited size. On startup only a
+  snapshot that summarizes the playlog and what has been logged after it are
+  read. The active segment is memory mapped and indexed in the background,
+  and sealed segments are read when their entries are accessed. With a memory
+  limit, only recently used pages of sealed segments are kept.
 
-  @withdoc(gobject.property)
-  def filename(self):
-    """Which filename the event occurred in. """
-    return self._filename
+  Signals:
+    appended          Entries were added to the playlog. Contains the index of
+                      the first new entry and the number of new entries.
 
-  @withdoc(gobject.property)
-  def position(self):
-    """At what position the event occurred. """
-    return self._position
+    notify::playlog   playlog property updated.
+  """
+  __gsignals__ = {
+    'appended' : (gobject.SIGNAL_RUN_LAST,
+                  gobject.TYPE_NONE,
+                  (gobject.TYPE_INT,gobject.TYPE_INT))
+  }
 
-  @withdoc(gobject.property)
-  def duration(self):
-    """At what position the event occurred. """
-    return self._duration
-
-  @staticmethod
-  def parse(line):
-    """Parse a line of text into a LogEntry. """
-    # Remove last character if it is a newline.
-    if len(line)>0 and line.endswith("\n"):
-      line = line[:-1]
-
-    data = line.split(' ')
-    if len(data)>=5:
-      walltime = data[0]
-      event = data[1]
-      filename = " ".join(data[2:-2])
-      position = data[-2]
-      duration = data[-1]
-      return LogEntry(walltime, event, filename, position, duration)
-    else:
-      return None
+  _POSTING_ENTRIES = 1<<17
+  """Number of entries of sealed segments whose postings are kept. """
 
-  def __init__(self,walltime,event,filename,position,duration):
-    """Create a new LogEntry.
-    
-    Arguments:
-      walltime  At what walltime did the event occur.
-      event     What occurred.
-      filename  In what file.
-      position  At what position.
-      duration  Duration of the file.
-    """
-    gobject.GObject.__gobject_init__(self)
-    self._walltime = int(walltime)
-    self._event = event
-    self._filename = filename
-    self._position = int(position)
-    self._duration = int(duration)
+  _SEAL_TIMEOUT = 0.5
+  """How long sealing a segment waits for the playlog to be written, in
+  seconds. """
 
-  def __str__(self):
-    """Convert the entry back into a string. """
-    return "{e.walltime} {e.event} {e.filename} {e.position} {e.duration}".format(e=self)
-
-class Log(gobject.GObject):
   @withdoc(gobject.property)
   def playlog(self):
-    """The current playlog. """
-    with self._lock:
-      return self._playlog
+    """The current playlog, as a read-only view that does not change. Reading
+    it does not take any locks. """
+    return self._view
+
+  @withdoc(gobject.property)
+  def version(self):
+    """Version number of the playlog, which increases when entries are
+    added. It is the same as the version of the view in the playlog
+    property. """
+    return self._view.version
 
-  def __init__(self,bus,player,directory,conf):
+  def __init__(self,bus,player,directory,conf,files=None,durations=None):
     """Create a new log handler.
 
     Arguments:
       bus               Which gobject to send error events to.
 
-      player            Which object to ask the current position of.
+      player            Which backend to get the current position from, with
+                        position_snapshot().
 
       directory         Directory of the audiobook.
 
       conf        A configuration object like that from the result of the
                   parser in pstorytime.coreparser.
+
+      files       FileIndex of the audiobook, used to tell which parts of
+                  the book have been listened to. (Optional, defaults to
+                  None.)
+
+      durations   DurationTable of the audiobook, used with files. (Optional,
+                  defaults to None.)
     """
 
     gobject.GObject.__gobject_init__(self)
@@ -126,21 +111,76 @@ class Log(gobject.GObject):
     self._bus = bus
     self._player = player
 
+    self._directory = os.path.abspath(directory)
+    self._files = files
+    self._durations = durations
     self._playlog_file = conf.playlog_file
     self._autolog_file = conf.playlog_file+".auto"
+    self._autolog = AutoLog(self._autolog_file)
+
+    self._snapshot_file = conf.playlog_file+".snapshot"
+    self._segment_size = conf.playlog_segment_size*1024
+    self._checksums = conf.log_checksums
+    self._parse = STORES[conf.playlog_store]
+    # Entries of sealed segments are paged in from disk within the memory
+    # limit, and the active segment is sealed before it holds more than that.
+    self._memory = conf.playlog_memory
+    if self._memory > 0:
+      self._cache = PageCache(self._memory)
+    else:
+      self._cache = None
 
-    self._playlog = self._load(self._playlog_file)
-    self._pending = ""
+    if conf.library_file:
+      self._library = LibraryUpdater(Library(conf.library_file),
+                                     self._library_error)
+    else:
+      self._library = None
+    self._book_files = None
+    self._book_duration = None
+    self._library_dirty = False
+
+    self._writer = LogWriter(bus,
+                             conf.log_durability,
+                             conf.log_commit_window/1000.0)
+    self._playlog = self._open_playlog()
+    self._view = self._playlog.view(self._snapshot.total())
+    # Postings of the active segment, kept up to date as entries are logged.
+    # The entries that are already in it are indexed in the background and
+    # merged in front; until then, or if that fails, they are in the range
+    # _unindexed, which is scanned instead. Sealed segments are indexed from
+    # their files when first searched, and only some are kept.
+    sealed = self._snapshot.total() - self._snapshot.active_count
+    self._postings = PostingIndex(start=len(self._view))
+    self._unindexed = (sealed, len(self._view))
+    self._posting_cache = PageCache(self._POSTING_ENTRIES)
+    self._postings_ready = threading.Event()
+    indexer = threading.Thread(target=self._index_postings,
+                               args=(self._playlog.active(), sealed,
+                                     self._snapshot.active_count,
+                                     self._postings),
+                               name="PostingIndex")
+    indexer.daemon = True
+    indexer.start()
+    if self._active_size >= self._segment_size:
+      self._seal()
+    else:
+      self._save_snapshot()
 
     self._autologtimer = Timer(conf.autolog_interval*1000, self._autolognow, repeat=True)
 
     # Merge in old auto save (should only be there if the last session crashed
     # while playing.)
-    if isfile(self._autolog_file):
-      auto = self._load(self._autolog_file)
-      if len(auto)==1:
-        self._logentry(auto[0])
-      os.remove(self._autolog_file)
+    auto = self._autolog.read()
+    if auto != None:
+      entry = LogEntry.parse(auto)
+      if entry != None:
+        self._logentry(entry)
+    self._clear_autolog()
+
+    # Check the whole playlog in the background, without delaying playback.
+    paths = [segment.path for segment in self._playlog.segments()]
+    self._verifier = Verifier(bus, paths+[self._playlog_file])
+    self._verifier.start()
 
   def start(self):
     """Start autologging (or reset the timer.)"""
@@ -149,39 +189,416 @@ class Log(gobject.GObject):
       self._autolognow()
 
   def stop(self):
-    """Stop autologging and remove autolog file."""
+    """Stop autologging and clear the autolog record."""
     with self._lock:
       self._autologtimer.stop()
-      if isfile(self._autolog_file):
-        os.remove(self._autolog_file)
+      self._clear_autolog()
+      self._update_library()
+
+  def _clear_autolog(self):
+    """Clear the autolog record. """
+    with self._lock:
+      try:
+        self._autolog.clear()
+      except (IOError, OSError):
+        self._bus.emit("error","Failed to write to auto log: {0}".format(self._autolog_file))
+
+  def flush(self,timeout=None):
+    """Wait until all logged events are on disk. The lock is not held while
+    waiting.
 
-  def lognow(self,event):
+    Arguments:
+      timeout   Longest time to wait in seconds, or None to wait until it is
+                done. (Optional, defaults to None.)
+
+    Returns:  True if successful.
+    """
+    return self._writer.flush(timeout)
+
+  def quit(self):
+    """Write all logged events to disk and stop the background writer. """
+    with self._lock:
+      self._autologtimer.stop()
+      self._writer.close()
+      self._autolog.close()
+      if self._library != None:
+        self._update_library()
+        self._library.close()
+      self._save_snapshot()
+
+  def last(self):
+    """Get the last entry in the playlog, without reading any sealed
+    segments.
+
+    Returns:  The entry, or None if the playlog is empty.
+    """
+    with self._lock:
+      return self._snapshot.last
+
+  def positions(self):
+    """Get the last entry for each file in the playlog, without reading any
+    sealed segments.
+
+    Returns:  Dictionary from filename to LogEntry.
+    """
+    with self._lock:
+      return dict(self._snapshot.positions)
+
+  def describe(self,files,duration):
+    """Tell the log about the audiobook, for the library index.
+
+    Arguments:
+      files     Number of files in the audiobook.
+      duration  Duration of the audiobook in ns.
+    """
+    with self._lock:
+      self._book_files = files
+      self._book_duration = duration
+      self._library_dirty = True
+      self._update_library()
+
+  def _update_library(self):
+    """Record the last entry in the library index, in the background, if
+    anything has changed since the last time. It is done when playback stops,
+    when a segment is sealed, on quit and with the autolog, rather than for
+    every entry. """
+    with self._lock:
+      if self._library == None or not self._library_dirty:
+        return
+      entry = self._snapshot.last
+      if entry == None:
+        return
+      self._library_dirty = False
+      self._library.update(self._directory,
+                           self._playlog_file,
+                           entry,
+                           self._snapshot.coverage.total(),
+                           self._book_files,
+                           self._book_duration)
+
+  def _library_error(self,message):
+    """Report an error from the library updater in the main loop.
+
+    Arguments:
+      message   The error message.
+    """
+    gobject.idle_add(self._bus.emit,"error",message)
+
+  def history(self):
+    """Get the places that can be gone back and forward to, without reading
+    the playlog.
+
+    Returns:  (back,forward) where back is a list of entries that can be gone
+              back to, the next one last, and forward is a list of entries
+              that can be gone forward to, the next one last.
+    """
+    with self._lock:
+      return (list(self._snapshot.back), list(self._snapshot.forward))
+
+  def heard(self,filename):
+    """Get how much of a file has been listened to, without reading the
+    playlog.
+
+    Arguments:
+      filename  The file.
+
+    Returns:    Fraction between 0 and 1, or None if the duration of the file
+                has not been logged.
+    """
+    with self._lock:
+      return self._snapshot.coverage.fraction(filename)
+
+  def first_gap(self,filename,tolerance=0):
+    """Find the first part of a file that has not been listened to, without
+    reading the playlog.
+
+    Arguments:
+      filename  The file.
+      tolerance Gaps shorter than this in ns are ignored. (Optional, defaults
+                to 0.)
+
+    Returns:    Position of the gap in ns, or None if the whole file has been
+                listened to.
+    """
+    with self._lock:
+      return self._snapshot.coverage.first_gap(filename,tolerance=tolerance)
+
+  def find_time(self,walltime):
+    """Find where entries at a given walltime start in the playlog, by
+    bisection.
+
+    Arguments:
+      walltime  The walltime in seconds since the epoch.
+
+    Returns:    Index of the first entry at or after the walltime, or the
+                length of the playlog if there is none.
+    """
+    return find_walltime(self._view,walltime)
+
+  def time_range(self,start,end):
+    """Find the entries logged during a range of walltimes.
+
+    Arguments:
+      start   First walltime of the range, in seconds since the epoch.
+      end     Walltime after the range.
+
+    Returns:  (first,last) where first is the index of the first entry in the
+              range and last is the index after the last entry.
+    """
+    view = self._view
+    first = find_walltime(view,start)
+    return (first, max(first,find_walltime(view,end)))
+
+  def _index_postings(self,active,start,count,logged):
+    """Index the entries that were in the active segment when the playlog
+    was opened, and put them in front of the entries logged since.
+
+    Arguments:
+      active  The active segment when the playlog was opened.
+      start   Index in the playlog of its first entry.
+      count   Number of entries in it.
+      logged  PostingIndex of the entries logged since.
+    """
+    try:
+      postings = PostingIndex(start=start)
+      for i in xrange(0,count):
+        postings.add(active[i])
+      with self._lock:
+        # If the segment has been sealed since, it is indexed from its file
+        # instead.
+        if self._postings is logged:
+          postings.merge(logged)
+          self._postings = postings
+          self._unindexed = None
+    except Exception as e:
+      # Signals are emitted in the main loop, not from this thread.
+      gobject.idle_add(self._bus.emit,"error",
+        "Failed to index playlog, searching it instead: {0}".format(e))
+    finally:
+      self._postings_ready.set()
+
+  def _segment_postings(self):
+    """Get the postings of all entries, a segment at a time, along with the
+    range of entries that has to be scanned instead.
+
+    Returns:  (postings,unindexed) where postings is a list of functions
+              that get the PostingIndex of a segment, oldest first, and
+              unindexed is (first,last) or None.
+    """
+    self._postings_ready.wait()
+    with self._lock:
+      segments = self._playlog.segments()
+      active = self._postings
+      unindexed = self._unindexed
+    def sealed(segment,start):
+      return lambda: self._posting_cache.get(segment.number,
+        lambda: PostingIndex.read(segment.path,start,segment.count))
+    postings = []
+    start = 0
+    for segment in segments:
+      postings.append(sealed(segment,start))
+      start += segment.count
+    postings.append(lambda: active)
+    return (postings,unindexed)
+
+  def _scan(self,event,filename,first,last):
+    """Find entries with a given event name and/or filename by reading them.
+
+    Returns:  List of indices in increasing order.
+    """
+    view = self._view
+    result = []
+    for i in xrange(first,min(last,len(view))):
+      entry = view[i]
+      if (event == None or entry.event == event) and \
+         (filename == None or entry.filename == filename):
+        result.append(i)
+    return result
+
+  def find(self,event=None,filename=None):
+    """Find entries with a given event name and/or filename. Until the
+    entries that were in the active segment when the playlog was opened have
+    been indexed, it waits for that.
+
+    Arguments:
+      event     Event name to look for, or None for any. (Optional, defaults
+                to None.)
+      filename  Filename to look for, or None for any. (Optional, defaults
+                to None.)
+
+    Returns:    List of indices in the playlog in increasing order.
+    """
+    if event == None and filename == None:
+      return range(0,len(self._view))
+    (postings,unindexed) = self._segment_postings()
+    result = []
+    for get in postings[:-1]:
+      result.extend(get().find(event,filename))
+    if unindexed != None:
+      result.extend(self._scan(event,filename,*unindexed))
+    result.extend(postings[-1]().find(event,filename))
+    return result
+
+  def find_last(self,event=None,filename=None,before=None):
+    """Find the last entry before an index with a given event name and/or
+    filename. Unlike find(), the time it takes does not grow with the number
+    of matching entries.
+
+    Arguments:
+      event     Event name to look for, or None for any. (Optional, defaults
+                to None.)
+      filename  Filename to look for, or None for any. (Optional, defaults
+                to None.)
+      before    Index to look before, or None to look at all entries.
+                (Optional, defaults to None.)
+
+    Returns:    Index in the playlog, or None if there is no such entry.
+    """
+    if before == None or before > len(self._view):
+      before = len(self._view)
+    if event == None and filename == None:
+      return before-1 if before > 0 else None
+    (postings,unindexed) = self._segment_postings()
+    # Search the newest segments first, and stop at the first match.
+    i = postings[-1]().last(event,filename,before)
+    if i != None:
+      return i
+    if unindexed != None:
+      found = self._scan(event,filename,unindexed[0],min(before,unindexed[1]))
+      if len(found) > 0:
+        return found[-1]
+    for get in reversed(postings[:-1]):
+      i = get().last(event,filename,before)
+      if i != None:
+        return i
+    return None
+
+  def lognow(self,event,filename=None):
     """Log an event with the given event name at the current position and time.
 
     Arguments:
-      event   The event type to log.
+      event     The event type to log.
+      filename  A file that the player does not have loaded, such as one that
+                failed to load, to log the event at the beginning of.
+                (Optional, defaults to the file of the player.)
     """
     with self._lock:
       walltime = time.time()
-      (filename,position,duration) = self._player.position()
+      if filename == None:
+        # The published position does not wait for the player, which may be
+        # in another process.
+        (filename,position,duration) = self._player.position_snapshot().extrapolate(walltime)
+      else:
+        (position,duration) = (0,0)
       self._logentry(LogEntry(walltime,event,filename,position,duration))
 
-  def _load(self,logfile):
-    """Load log from given file.
-
-    Arguments:
-      logfile   File name to load log from.
+  def _open_playlog(self):
+    """Open the segmented playlog. The playlog is not read unless the
+    snapshot is missing or does not match it.
 
-    Return:     The loaded log.
+    Returns:  The playlog.
     """
     with self._lock:
+      files = segment_files(self._playlog_file)
+      # Recover to the last valid entry. A line that was only partly written
+      # before a crash would otherwise be joined with the next one, or become
+      # the resume point.
       try:
-        with open(logfile,'rb') as f:
-          lines = f.readlines()
-        # Parse lines and remove invalid ones.
-        return filter(lambda e: e!=None, map(LogEntry.parse, lines))
-      except IOError:
-        return []
+        repair_tail(self._playlog_file)
+      except (IOError, OSError):
+        self._bus.emit("error","Failed to repair end of playlog: {0}".format(self._playlog_file))
+      active = MappedEntries(self._playlog_file,self._parse)
+      self._active_size = active.size
+
+      snapshot = Snapshot.load(self._snapshot_file)
+      if snapshot != None:
+        self._use_book(snapshot)
+        known = [(number,size) for (number,_,size) in snapshot.segments]
+        ondisk = [(number,_file_size(path)) for (number,path) in files]
+        if known != ondisk or snapshot.active_size > active.size:
+          snapshot = None
+
+      if snapshot == None:
+        # Rebuild the snapshot by reading the whole playlog.
+        snapshot = Snapshot()
+        self._use_book(snapshot)
+        for (number,path) in files:
+          (entries,size) = read_entries(path,self._parse)
+          for entry in entries:
+            snapshot.update(entry)
+          snapshot.segments.append((number,len(entries),size))
+        for entry in active:
+          snapshot.update(entry)
+        snapshot.active_count = len(active)
+        snapshot.active_size = active.size
+
+      segments = [Segment(segment_file(self._playlog_file,number),
+                          number,
+                          count,
+                          size,
+                          parse=self._parse,
+                          cache=self._cache)
+                  for (number,count,size) in snapshot.segments]
+
+      # Include what was logged after the snapshot was saved.
+      for entry in active.entries_from(snapshot.active_size):
+        snapshot.update(entry)
+        snapshot.active_count += 1
+      self._snapshot = snapshot
+      # Entries already in the active segment count against the memory
+      # limit too.
+      self._resident = snapshot.active_count
+
+      return Playlog(segments,active,self._parse)
+
+  def _use_book(self,snapshot):
+    """Let the coverage of a snapshot know about the files of the book. """
+    if self._files != None:
+      snapshot.coverage.use_book(self._files,
+        self._durations.known if self._durations != None else None)
+
+  def _save_snapshot(self):
+    """Write the snapshot to file. """
+    with self._lock:
+      self._snapshot.active_size = self._active_size
+      try:
+        self._snapshot.save(self._snapshot_file)
+      except (IOError, OSError):
+        self._bus.emit("error","Failed to write playlog snapshot: {0}".format(self._snapshot_file))
+
+  def _seal(self):
+    """Turn the active segment into a sealed segment and start a new one. """
+    with self._lock:
+      active = self._playlog.active()
+      count = self._snapshot.active_count
+      # The writes must reach the file before it is renamed. If the disk is
+      # too slow for that, the segment is sealed with a later entry instead
+      # of holding up the user interface.
+      if count==0 or not self._writer.flush(self._SEAL_TIMEOUT):
+        return
+      if len(self._snapshot.segments)>0:
+        number = self._snapshot.segments[-1][0]+1
+      else:
+        number = 1
+      path = segment_file(self._playlog_file,number)
+      try:
+        os.rename(self._playlog_file,path)
+      except OSError:
+        self._bus.emit("error","Failed to start new playlog segment: {0}".format(path))
+        return
+      size = _file_size(path)
+      self._playlog.seal(Segment(path,number,count,size,active,self._parse,self._cache))
+      if self._unindexed == None:
+        postings = self._postings
+        self._posting_cache.get(number, lambda: postings)
+      self._snapshot.segments.append((number,count,size))
+      self._snapshot.active_count = 0
+      self._postings = PostingIndex(start=self._snapshot.total())
+      self._unindexed = None
+      self._active_size = 0
+      self._resident = 0
+      self._save_snapshot()
+      self._update_library()
 
   def _autolognow(self):
     """Save current position and such to autolog file now.
@@ -189,17 +606,17 @@ class Log(gobject.GObject):
     with self._lock:
       # Retry writing pending entries to the play log.
       self._writelog()
+      self._update_library()
       # Make sure the autolog timer is running. The autologging could have been stopped
       # while we were waiting at the lock.
       if self._autologtimer.started():
         # Update autolog
         walltime = time.time()
-        (filename,position,duration) = self._player.position()
+        (filename,position,duration) = self._player.position_snapshot().extrapolate(walltime)
         event = LogEntry(walltime, 'auto', filename, position, duration)
-        line = str(event)+"\n"
         try:
-          _write_file(self._autolog_file,'wb',line)
-        except IOError:
+          self._autolog.write(str(event))
+        except (IOError, OSError, ValueError):
           self._bus.emit("error","Failed to write to auto log: {0}".format(self._autolog_file))
 
   def _logentry(self,entry):
@@ -210,32 +627,296 @@ class Log(gobject.GObject):
     """
     with self._lock:
       self._playlog.append(entry)
+      self._snapshot.update(entry)
+      self._snapshot.active_count += 1
+      self._postings.add(entry)
+      total = self._snapshot.total()
+      self._view = self._playlog.view(total, self._view.version+1)
       self.notify("playlog")
-      self._pending += str(entry)+"\n"
-      self._writelog()
+      self.emit("appended", total-1, 1)
+      self._library_dirty = True
+      line = str(entry)
+      if self._checksums:
+        line = add_checksum(line)
+      line += "\n"
+      self._writer.write(self._playlog_file, line)
+      self._active_size += len(line)
+      self._resident += 1
+      if self._active_size >= self._segment_size or \
+         (self._cache != None and self._resident >= self._memory):
+        self._seal()
 
   def _writelog(self):
-    """Write all pending log entries to file. """
+    """Retry writing log entries that failed to be written earlier. """
     with self._lock:
-      if self._pending != "":
-        try:
-          _write_file(self._playlog_file,'ab',self._pending)
-          self._pending = ""
-        except IOError as e:
-          self._bus.emit("error","Failed to write to play log, data will be included in next write: {0}".format(self._playlog_file))
-
-def _write_file(filepath,writemode,data):
-  """Write given data to the given file.
-
-  Arguments:
-    filepath    Path to the file that is written to.
-    writemode   What mode to open the file with.
-    data        The data to write.
+      self._writer.retry()
+
+def _file_size(path):
+  """Get the size of a file.
+
+  Returns:  Size in bytes, or None if it could not be found.
+  """
+  try:
+    return os.path.getsize(path)
+  except OSError:
+    return None
+
+# Events that mean that a file in the playlog directory may have changed.
+_CHANGES = ( inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_FROM
+           | inotify.IN_MOVED_TO | inotify.IN_CREATE | inotify.IN_DELETE )
+
+class LogFollower(object):
+  """Follows a playlog that is written by a running player, without locking
+  it, and gets the entries as they are appended.
+
+  Only data that has not been seen before is read: the follower keeps the
+  active playlog file open and remembers how far it has read. When the active
+  segment is sealed, the rest of the old file is read before the new one is
+  followed from its beginning. When the file is replaced by an import, or
+  truncated, the new file is followed from its end, as its entries have been
+  seen already. Changes are waited for with inotify where it
+  is available, and by checking the files now and then otherwise.
+
+  It can be iterated over, which gives the new entries forever.
+
+  Fields:
+    offset    Offset in bytes in the active playlog file up to which complete
+              lines have been read.
+    auto      The latest entry in the crash recovery record, which holds the
+              position while playing, or None if there is none.
   """
-  dirpath = dirname(filepath)
-  if not isdir(dirpath) and dirpath!='':
-    os.makedirs(dirpath,mode=0700)
-  with open(filepath,writemode) as f:
-    f.write(data)
-    f.flush()
-    os.fsync(f.fileno())
+  def __init__(self,playlog_file,offset=None,auto=False,interval=1.0):
+    """Start following a playlog.
+
+    Arguments:
+      playlog_file  Path to the playlog.
+      offset        Offset in the active playlog file to start reading at, or
+                    None to only get entries that are appended from now on.
+                    Use 0 to get the entries of the active segment first.
+                    (Optional, defaults to None.)
+      auto          True to also get the entry of the crash recovery record
+                    each time it changes. It has the event "auto" and is not
+                    part of the playlog. (Optional, defaults to False.)
+      interval      How often to check for changes, in seconds, when inotify
+                    is not available. (Optional, defaults to 1.0.)
+    """
+    self._lock = threading.RLock()
+    self._playlog_file = playlog_file
+    self._autolog = AutoLog(playlog_file+".auto") if auto else None
+    self._auto_stat = None
+    self._interval = interval
+    self._file = None
+    self._partial = ""
+    self.offset = 0
+    self.auto = None
+
+    self._reopen()
+    if self._file != None:
+      if offset == None:
+        self.offset = self._end_of_lines()
+      else:
+        self.offset = offset
+      self._file.seek(self.offset)
+    if self._autolog != None:
+      self._read_auto()
+
+    self._watch = inotify.watch(os.path.dirname(os.path.abspath(playlog_file)),
+                                _CHANGES)
+
+  def _reopen(self):
+    """Open the current active playlog file, if there is one. """
+    with self._lock:
+      if self._file != None:
+        self._file.close()
+      self._partial = ""
+      self.offset = 0
+      try:
+        self._file = open(self._playlog_file,'rb')
+      except IOError:
+        self._file = None
+
+  def _end_of_lines(self):
+    """Find the end of the last complete line of the open file, reading
+    backwards from the end.
+
+    Returns:  The offset.
+    """
+    with self._lock:
+      self._file.seek(0, os.SEEK_END)
+      end = self._file.tell()
+      while end > 0:
+        start = max(0, end-4096)
+        self._file.seek(start)
+        newline = self._file.read(end-start).rfind("\n")
+        if newline != -1:
+          return start+newline+1
+        end = start
+      return 0
+
+  def _read_lines(self):
+    """Read what has been appended to the open file.
+
+    Returns:  List of new entries.
+    """
+    with self._lock:
+      # Seeking clears the end of file flag, so that new data is seen.
+      self._file.seek(0, os.SEEK_CUR)
+      data = self._partial + self._file.read()
+      end = data.rfind("\n")+1
+      self._partial = data[end:]
+      self.offset += end
+      entries = []
+      for line in data[:end].splitlines():
+        entry = LogEntry.parse(line)
+        if entry != None:
+          entries.append(entry)
+      return entries
+
+  def _rotated(self):
+    """Check if the active playlog file has been replaced or truncated.
+
+    Returns:  True if so.
+    """
+    with self._lock:
+      try:
+        st = os.stat(self._playlog_file)
+      except OSError:
+        return False
+      if self._file == None:
+        return True
+      current = os.fstat(self._file.fileno())
+      return (st.st_ino, st.st_dev) != (current.st_ino, current.st_dev) or \
+             st.st_size < self.offset
+
+  def _skipped_segments(self):
+    """Read segments that were sealed after the open file, which happens if
+    the playlog is sealed more than once between two polls.
+
+    Returns:  List of their entries, or None if the open file was not sealed
+              but replaced or truncated.
+    """
+    with self._lock:
+      current = os.fstat(self._file.fileno())
+      newer = []
+      for (_,path) in reversed(segment_files(self._playlog_file)):
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        if (st.st_ino, st.st_dev) == (current.st_ino, current.st_dev):
+          break
+        newer.append(path)
+      else:
+        # The open file is not a segment, so it was replaced rather than
+        # sealed.
+        return None
+      entries = []
+      for path in reversed(newer):
+        (segment,_) = read_entries(path)
+        entries.extend(segment)
+      return entries
+
+  def _read_auto(self):
+    """Read the crash recovery record if it has changed.
+
+    Returns:  The new entry, or None if it has not changed.
+    """
+    with self._lock:
+      try:
+        st = os.stat(self._playlog_file+".auto")
+        stat = (st.st_ino, st.st_size, st.st_mtime)
+      except OSError:
+        stat = None
+      if stat == self._auto_stat:
+        return None
+      self._auto_stat = stat
+      record = self._autolog.read() if stat != None else None
+      entry = LogEntry.parse(record) if record != None else None
+      if entry == None or (self.auto != None and str(entry) == str(self.auto)):
+        return None
+      self.auto = entry
+      return entry
+
+  def poll(self):
+    """Get the entries that have been appended since the last time, without
+    waiting.
+
+    Returns:  List of new entries, oldest first.
+    """
+    with self._lock:
+      entries = []
+      if self._file != None:
+        entries.extend(self._read_lines())
+      if self._rotated():
+        # The sealed segment is complete by the time a new one is started,
+        # so read what is left of it before switching.
+        replaced = False
+        if self._file != None:
+          entries.extend(self._read_lines())
+          skipped = self._skipped_segments()
+          if skipped == None:
+            replaced = True
+          else:
+            entries.extend(skipped)
+        self._reopen()
+        if self._file != None:
+          if replaced:
+            # An import writes the whole history to a new file, and what was
+            # truncated has been read already, so only what is appended
+            # after this is new.
+            self.offset = self._end_of_lines()
+            self._file.seek(self.offset)
+          entries.extend(self._read_lines())
+      if self._autolog != None:
+        auto = self._read_auto()
+        if auto != None:
+          entries.append(auto)
+      return entries
+
+  def wait(self,timeout=None):
+    """Wait until there are new entries and get them.
+
+    Arguments:
+      timeout   Longest time to wait in seconds, or None to wait forever.
+                (Optional, defaults to None.)
+
+    Returns:  List of new entries, oldest first. It is empty if the time ran
+              out.
+    """
+    if timeout != None:
+      deadline = time.time() + timeout
+    while True:
+      entries = self.poll()
+      if len(entries) > 0:
+        return entries
+      if timeout == None:
+        remaining = None
+      else:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return entries
+      if self._watch != None:
+        try:
+          select.select([self._watch],[],[],remaining)
+        except select.error as e:
+          if e.args[0] != errno.EINTR:
+            raise
+        # Forget the changes, they are all seen by the next poll.
+        self._watch.changed()
+      else:
+        time.sleep(self._interval if remaining == None else min(self._interval,remaining))
+
+  def close(self):
+    """Stop following the playlog. """
+    with self._lock:
+      if self._file != None:
+        self._file.close()
+        self._file = None
+      if self._watch != None:
+        self._watch.close()
+        self._watch = None
+
+  def __iter__(self):
+    while True:
+      for entry in self.wait():
+        yield entry
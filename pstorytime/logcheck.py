@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""Checksums of playlog lines, and checking and repairing of playlog files."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import os
+import sys
+import threading
+import zlib
+import gobject
+
+__all__ = [
+  'add_checksum',
+  'strip_checksum',
+  'check_file',
+  'repair_tail',
+  'repair_file',
+  'valid_line',
+  'read_lines',
+  'Verifier',
+  ]
+
+_BLOCK = 1<<20
+
+def add_checksum(line):
+  """Prefix a line with its checksum, like "@1a2b3c4d 1300000000 start ...".
+
+  Arguments:
+    line    The line without newline.
+
+  Returns:  The line with checksum.
+  """
+  return "@%08x %s" % (zlib.crc32(line) & 0xffffffff, line)
+
+def strip_checksum(line):
+  """Check and remove the checksum of a line. Lines without checksum are
+  returned as they are, so both formats can be mixed in a playlog.
+
+  Arguments:
+    line    The line, with or without newline.
+
+  Returns:  The line without checksum and newline, or None if the checksum
+            is wrong.
+  """
+  if line.endswith("\n"):
+    line = line[:-1]
+  if line[:1] != "@":
+    return line
+  if len(line) < 10 or line[9] != " ":
+    return None
+  payload = line[10:]
+  try:
+    crc = int(line[1:9],16)
+  except ValueError:
+    return None
+  if crc != zlib.crc32(payload) & 0xffffffff:
+    return None
+  return payload
+
+def valid_line(line):
+  """Check if a line is a valid entry, the same way as LogEntry.parse, but
+  without creating the entry.
+
+  Arguments:
+    line    The line, with or without newline.
+
+  Returns:  True if so.
+  """
+  line = strip_checksum(line)
+  if line == None:
+    return False
+  data = line.split(' ')
+  if len(data) < 5:
+    return False
+  try:
+    int(data[0])
+    int(data[-2])
+    int(data[-1])
+  except ValueError:
+    return False
+  return True
+
+def read_lines(f):
+  """Read the lines of a file a block at a time. Lines are split on "\n"
+  only, like the rest of the playlog code does.
+
+  Arguments:
+    f   The file, opened in binary mode.
+
+  Returns:  Iterator over (offset,line) where line includes the newline, if
+            there is one.
+  """
+  offset = 0
+  rest = ""
+  while True:
+    block = f.read(_BLOCK)
+    if block == "":
+      break
+    lines = (rest+block).split("\n")
+    rest = lines.pop()
+    for line in lines:
+      yield (offset,line+"\n")
+      offset += len(line)+1
+  if rest != "":
+    yield (offset,rest)
+
+def check_file(path):
+  """Check all lines of a playlog file.
+
+  Arguments:
+    path    The file.
+
+  Returns:  (valid,invalid,end) where valid and invalid are the numbers of
+            valid and invalid non-empty lines, and end is the offset after the
+            last valid line.
+
+  Exceptions:
+    IOError   If the file could not be read.
+  """
+  valid = 0
+  invalid = 0
+  end = 0
+  with open(path,'rb') as f:
+    for (offset,line) in read_lines(f):
+      if valid_line(line) and line.endswith("\n"):
+        valid += 1
+        end = offset+len(line)
+      elif line.strip() != "":
+        invalid += 1
+  return (valid,invalid,end)
+
+def repair_tail(path):
+  """Remove everything after the last valid line. That is what is left if
+  writing was interrupted, such as a partially written line, which the next
+  line would otherwise be appended to, or a line with a wrong checksum. Only
+  the end of the file is read.
+
+  Arguments:
+    path    The file.
+
+  Returns:  Number of bytes removed.
+
+  Exceptions:
+    IOError, OSError  If the file could not be repaired.
+  """
+  try:
+    f = open(path,'r+b')
+  except IOError:
+    return 0
+  with f:
+    f.seek(0,os.SEEK_END)
+    size = f.tell()
+    # Go back a line at a time until a valid one is found. data is the part
+    # of the file from start that has been read, and end the offset after the
+    # line that is checked.
+    start = size
+    data = ""
+    end = size
+    while end > 0:
+      i = data.rfind("\n",0,end-start-1)
+      while i == -1 and start > 0:
+        read = max(0,start-4096)
+        f.seek(read)
+        data = f.read(start-read) + data
+        start = read
+        i = data.rfind("\n",0,end-start-1)
+      line = data[i+1:end-start]
+      if line.endswith("\n") and valid_line(line):
+        break
+      end -= len(line)
+    if end < size:
+      f.truncate(end)
+      f.flush()
+      os.fsync(f.fileno())
+    return size-end
+
+def repair_file(path):
+  """Remove all invalid lines of a playlog file. The file is replaced
+  atomically.
+
+  Arguments:
+    path    The file.
+
+  Returns:  Number of lines removed.
+
+  Exceptions:
+    IOError, OSError  If the file could not be repaired.
+  """
+  removed = 0
+  tmppath = path+".repair"
+  with open(path,'rb') as f:
+    with open(tmppath,'wb') as out:
+      for (_,line) in read_lines(f):
+        if valid_line(line) and line.endswith("\n"):
+          out.write(line)
+        elif line.strip() != "":
+          removed += 1
+      out.flush()
+      os.fsync(out.fileno())
+  if removed > 0:
+    os.rename(tmppath,path)
+  else:
+    os.remove(tmppath)
+  return removed
+
+class Verifier(threading.Thread):
+  """Background thread that checks playlog files and reports invalid lines.
+  """
+  def __init__(self,bus,paths):
+    """Create the verifier. Start it with start().
+
+    Arguments:
+      bus     Which gobject to send error events to.
+      paths   Files to check.
+    """
+    threading.Thread.__init__(self,name="Verifier")
+    self.daemon = True
+    self._bus = bus
+    self._paths = list(paths)
+    self.results = {}
+
+  def run(self):
+    for path in self._paths:
+      try:
+        result = check_file(path)
+      except IOError:
+        continue
+      self.results[path] = result
+      if result[1] > 0:
+        # Signals are emitted in the main loop, not from this thread.
+        gobject.idle_add(self._bus.emit, "error",
+          "Playlog contains {0} invalid entries, which are ignored: {1}".format(result[1],path))
+
+def main(argv=None):
+  """Command line interface. """
+  parser = argparse.ArgumentParser(
+    prog="pstorytime-logcheck",
+    description="%(prog)s checks and repairs pstorytime playlog files.")
+  parser.add_argument("file", nargs="+", help="Playlog file, or a segment of one.")
+  parser.add_argument("--repair", action="store_true", help="Remove invalid lines.")
+  conf = parser.parse_args(argv)
+
+  status = 0
+  for path in conf.file:
+    try:
+      (valid,invalid,end) = check_file(path)
+      print("{0}: {1} valid, {2} invalid".format(path,valid,invalid))
+      if invalid > 0:
+        status = 1
+        if conf.repair:
+          print("{0}: removed {1} lines".format(path,repair_file(path)))
+    except (IOError, OSError) as e:
+      print("{0}: {1}".format(path,e))
+      status = 1
+  sys.exit(status)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Entries of the playlog."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = [
+  'LogEntry',
+  ]
+
+import gobject
+
+from pstorytime.misc import withdoc
+from pstorytime.logcheck import strip_checksum
+
+class LogEntry(gobject.GObject):
+  """Each event in the playlog is represented with one of these. """
+  @withdoc(gobject.property)
+  def walltime(self):
+    """Walltime when the event occurred. """
+    return self._walltime
+
+  @withdoc(gobject.property)
+  def event(self):
+    """What happened. (Start/stop/seek etc.) """
+    return self._event
+
+  @withdoc(gobject.property)
+  def filename(self):
+    """Which filename the event occurred in. """
+    return self._filename
+
+  @withdoc(gobject.property)
+  def position(self):
+    """At what position the event occurred. """
+    return self._position
+
+  @withdoc(gobject.property)
+  def duration(self):
+    """At what position the event occurred. """
+    return self._duration
+
+  @staticmethod
+  def parse(line):
+    """Parse a line of text into a LogEntry, or None if it is invalid. """
+    # Remove the checksum, if there is one, and the newline.
+    line = strip_checksum(line)
+    if line == None:
+      return None
+
+    data = line.split(' ')
+    if len(data)>=5:
+      walltime = data[0]
+      event = data[1]
+      filename = " ".join(data[2:-2])
+      position = data[-2]
+      duration = data[-1]
+      try:
+        return LogEntry(walltime, event, filename, position, duration)
+      except ValueError:
+        return None
+    else:
+      return None
+
+  def __init__(self,walltime,event,filename,position,duration):
+    """Create a new LogEntry.
+    
+    Arguments:
+      walltime  At what walltime did the event occur.
+      event     What occurred.
+      filename  In what file.
+      position  At what position.
+      duration  Duration of the file.
+    """
+    gobject.GObject.__gobject_init__(self)
+    self._walltime = int(walltime)
+    self._event = event
+    self._filename = filename
+    self._position = int(position)
+    self._duration = int(duration)
+
+  def __str__(self):
+    """Convert the entry back into a string. """
+    return "{e.walltime} {e.event} {e.filename} {e.position} {e.duration}".format(e=self)
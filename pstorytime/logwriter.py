@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""Background writer that commits log data to disk in groups."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+from os.path import dirname, isdir
+import os
+import threading
+import time
+import Queue
+import gobject
+
+__all__ = [
+  'DURABILITY',
+  'LogWriter',
+  ]
+
+DURABILITY = ["sync", "group", "buffered"]
+"""Available durability modes, see LogWriter. """
+
+_sync = getattr(os, "fdatasync", os.fsync)
+
+class LogWriter(object):
+  """Appends data to files, optionally from a background thread.
+
+  Durability modes:
+    sync      Every write is on disk before write() returns.
+
+    group     Writes are handed to a background thread that collects them for
+              a short window and commits them with a single write and sync
+              per file.
+
+    buffered  Like group, but the data is left for the operating system to
+              sync, unless flush() is called.
+
+  Data that could not be written is kept and included in the next attempt.
+  """
+  def __init__(self,bus,mode="group",window=0.2,maxsize=1024):
+    """Create the writer.
+
+    Arguments:
+      bus       Which gobject to send error events to.
+      mode      Durability mode, one of DURABILITY. (Optional, defaults to
+                "group".)
+      window    How long to collect writes before committing them, in
+                seconds. (Optional, defaults to 0.2.)
+      maxsize   How many writes may wait for the background thread before
+                write() blocks. (Optional, defaults to 1024.)
+    """
+    if mode not in DURABILITY:
+      raise ValueError("Invalid durability mode: {0}".format(mode))
+    self._lock = threading.RLock()
+    self._bus = bus
+    self._mode = mode
+    self._window = window
+
+    # (filepath,data) that have not been written yet, in order.
+    self._pending = []
+
+    if self._mode != "sync":
+      self._queue = Queue.Queue(maxsize)
+      self._thread = threading.Thread(target=self._run, name="LogWriter")
+      self._thread.daemon = True
+      self._thread.start()
+    else:
+      self._queue = None
+      self._thread = None
+
+  def write(self,filepath,data):
+    """Append data to a file.
+
+    Arguments:
+      filepath  The file to append to.
+      data      The data to append.
+    """
+    if self._queue == None:
+      with self._lock:
+        self._pending.append((filepath,data))
+        self._commit(True)
+    else:
+      self._queue.put(("write",(filepath,data)))
+
+  def call(self,function):
+    """Call a function after everything that has been written so far, in the
+    background thread unless the mode is sync. Use it for work that should
+    not delay the caller, such as updating an index.
+
+    Arguments:
+      function  The function, which is called without arguments.
+    """
+    if self._queue == None:
+      with self._lock:
+        function()
+    else:
+      self._queue.put(("call",function))
+
+  def retry(self):
+    """Try to write data that failed to be written earlier. """
+    if self._queue == None:
+      with self._lock:
+        self._commit(True)
+    else:
+      self._queue.put(("retry",None))
+
+  def flush(self,timeout=None):
+    """Wait until everything that has been written so far is on disk.
+
+    Arguments:
+      timeout   Longest time to wait in seconds, or None to wait until it is
+                done. The data is still written after the time has run out.
+                (Optional, defaults to None.)
+
+    Returns:  True if successful, False if it failed or the time ran out.
+    """
+    if self._queue == None:
+      with self._lock:
+        return self._commit(True)
+    else:
+      done = threading.Event()
+      result = []
+      self._queue.put(("flush",(done,result)))
+      done.wait(timeout)
+      return done.is_set() and result[0]
+
+  def close(self):
+    """Flush everything and stop the background thread.
+
+    Returns:  True if everything could be written.
+    """
+    result = self.flush()
+    if self._queue != None:
+      self._queue.put(("stop",None))
+      self._thread.join()
+    return result
+
+  def _run(self):
+    """Background thread that collects and commits writes. """
+    running = True
+    while running:
+      # Wait for something to do. Retry failed writes now and then.
+      try:
+        if len(self._pending)>0:
+          items = [self._queue.get(timeout=max(self._window,1.0))]
+        else:
+          items = [self._queue.get()]
+      except Queue.Empty:
+        items = [("retry",None)]
+
+      # Collect everything that arrives within the window, unless someone
+      # is waiting for the data to reach the disk. Calls do not end the
+      # window, since they are run after the commit anyway.
+      deadline = time.time() + self._window
+      while items[-1][0] in ("write","call"):
+        remaining = deadline - time.time()
+        try:
+          if remaining > 0:
+            items.append(self._queue.get(timeout=remaining))
+          else:
+            items.append(self._queue.get_nowait())
+        except Queue.Empty:
+          break
+
+      flushes = []
+      calls = []
+      for (kind,arg) in items:
+        if kind == "write":
+          self._pending.append(arg)
+        elif kind == "flush":
+          flushes.append(arg)
+        elif kind == "call":
+          calls.append(arg)
+        elif kind == "stop":
+          running = False
+
+      with self._lock:
+        result = self._commit(self._mode == "group" or len(flushes)>0)
+        for function in calls:
+          function()
+      for (done,res) in flushes:
+        res.append(result)
+        done.set()
+
+  def _commit(self,sync):
+    """Write all pending data.
+
+    Arguments:
+      sync  True if the data should be synced to disk.
+
+    Returns:  True if successful.
+    """
+    with self._lock:
+      if len(self._pending)==0:
+        return True
+
+      # Combine the data for each file, keeping the order of the files.
+      order = []
+      combined = {}
+      for (filepath,data) in self._pending:
+        if filepath not in combined:
+          order.append(filepath)
+          combined[filepath] = []
+        combined[filepath].append(data)
+
+      for filepath in order:
+        try:
+          _append_file(filepath,"".join(combined[filepath]),sync)
+        except (IOError, OSError):
+          # Signals are emitted in the main loop, not from this thread.
+          gobject.idle_add(self._bus.emit,"error",
+            "Failed to write to play log, data will be included in next write: {0}".format(filepath))
+          # Keep the data for this and later files.
+          self._pending = [(f,d) for (f,d) in self._pending if f in order[order.index(filepath):]]
+          return False
+      self._pending = []
+      return True
+
+def _append_file(filepath,data,sync):
+  """Append given data to the given file.
+
+  Arguments:
+    filepath    Path to the file that is written to.
+    data        The data to write.
+    sync        True if the data should be synced to disk.
+  """
+  dirpath = dirname(filepath)
+  if not isdir(dirpath) and dirpath!='':
+    os.makedirs(dirpath,mode=0700)
+  with open(filepath,'ab') as f:
+    f.write(data)
+    f.flush()
+    if sync:
+      _sync(f.fileno())
@@ -22,8 +22,10 @@
 from os.path import abspath, expanduser, join, dirname, isdir, isfile
 import os
 import fcntl
+import calendar
+import time
 from datetime import timedelta
-from gst import SECOND
+from pstorytime.backend import SECOND
 
 __all__ = [
   'PathGen',
@@ -158,6 +160,22 @@ def ns_to_str(time_ns):
   dtime = dtime - timedelta(microseconds=dtime.microseconds)
   return str(dtime)
 
+def parse_walltime(raw):
+  """Parse walltime from given string in ISO 8601 format, like
+  2011-10-12T22:00. It is taken to be in UTC, like walltimes are shown.
+
+  Arguments:
+    raw     raw data that is parsed to a walltime.
+
+  Returns:  Walltime in seconds since the epoch, or None if parsing failed.
+  """
+  for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+    try:
+      return calendar.timegm(time.strptime(raw,fmt))
+    except ValueError:
+      pass
+  return None
+
 def parse_pos(raw):
   """Parse position from given string.
   
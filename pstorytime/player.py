@@ -23,8 +23,10 @@ import pygst
 pygst.require("0.10")
 import os.path
 import threading
+import time
 import gobject
 import sys
+from collections import OrderedDict
 
 # Don't touch my arguments!
 argv = sys.argv
@@ -33,28 +35,204 @@ import gst
 sys.argv = argv
 
 from pstorytime.misc import withdoc
+from pstorytime.backend import PositionSnapshot
+from pstorytime.timer import Timer
 
 __all__ = [
   'Player',
+  'PositionSnapshot',
+  'STATE_TIMEOUTS',
+  'PipelinePool',
   ]
 
+STATE_TIMEOUTS = {
+  "load" : 10000,
+  "play" : 3000,
+  "pause" : 3000,
+  "seek" : 5000,
+  }
+"""Default time (in milliseconds) that each player operation may take before
+it is given up on. """
+
+_CLEAR_EOS = "pstorytime-clear-eos"
+"""Name of the marker message that is posted when eos is cleared. """
+
+_BEGIN = "pstorytime-begin"
+"""Name of the marker message that is posted when an operation begins. """
+
+class PipelinePool(object):
+  """Least recently used pool of prerolled pipelines, keyed by filename.
+
+  The pool is limited by the number of pipelines rather than by memory, since
+  gstreamer does not tell how much memory a pipeline uses.
+
+  It also keeps statistics of how often a file could be taken from the pool
+  and how long it took to switch to files that were or were not pooled.
+  """
+  def __init__(self,size,dispose):
+    """Create an empty pool.
+
+    Arguments:
+      size      Maximum number of pipelines to keep. 0 disables the pool.
+      dispose   Function that shuts down a pipeline that is evicted.
+    """
+    self._lock = threading.RLock()
+    self.size = size
+    self._dispose = dispose
+    # filename -> (pipeline,duration), least recently used first.
+    self._entries = OrderedDict()
+    self._hits = 0
+    self._misses = 0
+    # hit -> [count,total,max] of switch latency in seconds.
+    self._latency = { True : [0,0.0,0.0], False : [0,0.0,0.0] }
+
+  def take(self,filename):
+    """Remove the pipeline for the given file from the pool.
+
+    Arguments:
+      filename  The file to get a pipeline for.
+
+    Returns:    (pipeline,duration) or None if the file is not pooled.
+    """
+    with self._lock:
+      return self._entries.pop(filename,None)
+
+  def put(self,filename,pipeline,duration):
+    """Add a prerolled pipeline to the pool, evicting the least recently used
+    ones if the pool is full.
+
+    Arguments:
+      filename  The file that is loaded in the pipeline.
+      pipeline  The pipeline.
+      duration  Duration of the file in ns.
+    """
+    with self._lock:
+      old = self._entries.pop(filename,None)
+      if old != None and old[0] is not pipeline:
+        self._dispose(old[0])
+      self._entries[filename] = (pipeline,duration)
+      while len(self._entries) > self.size:
+        (_,(evicted,_)) = self._entries.popitem(last=False)
+        self._dispose(evicted)
+
+  def contains(self,filename):
+    """Check if a file is pooled.
+
+    Returns:  True if so.
+    """
+    with self._lock:
+      return filename in self._entries
+
+  def discard(self,pipeline):
+    """Remove a pipeline from the pool and shut it down.
+
+    Arguments:
+      pipeline  The pipeline to remove.
+    """
+    with self._lock:
+      for (filename,(pooled,_)) in self._entries.items():
+        if pooled is pipeline:
+          del self._entries[filename]
+      self._dispose(pipeline)
+
+  def clear(self):
+    """Shut down all pooled pipelines. """
+    with self._lock:
+      for (pipeline,_) in self._entries.values():
+        self._dispose(pipeline)
+      self._entries.clear()
+
+  def record(self,hit,latency):
+    """Record a switch and how long it took.
+
+    Arguments:
+      hit       True if the file was taken from the pool, False if it was not
+                pooled or the pooled pipeline could not be used.
+      latency   Time the switch took in seconds.
+    """
+    with self._lock:
+      if hit:
+        self._hits += 1
+      else:
+        self._misses += 1
+      data = self._latency[hit]
+      data[0] += 1
+      data[1] += latency
+      data[2] = max(data[2],latency)
+
+  def stats(self):
+    """Get pool statistics.
+
+    Returns:  Dictionary with the number of hits and misses, the hit rate, the
+              mean and maximum switch latency (in seconds) for hits and misses
+              and the number of pooled pipelines.
+    """
+    with self._lock:
+      lookups = self._hits + self._misses
+      result = {
+        "hits" : self._hits,
+        "misses" : self._misses,
+        "hit_rate" : float(self._hits)/lookups if lookups>0 else 0.0,
+        "pooled" : len(self._entries) }
+      for (hit,name) in [(True,"hit"),(False,"miss")]:
+        (count,total,maximum) = self._latency[hit]
+        result[name+"_latency"] = total/count if count>0 else 0.0
+        result[name+"_latency_max"] = maximum
+      return result
+
 class Player(gobject.GObject):
-  """Simple gstreamer playing abstraction. """
+  """Simple gstreamer playing abstraction. This is the "gst" backend, see
+  pstorytime.backend.
+
+  Signals:
+    switched    Contains the new filename. Emitted in gapless mode when
+                playback has continued into the next file without stopping
+    stopped     Emitted when playback could not be started, because
+                gstreamer failed or did not start playing in time.
+  """
   SECOND = gst.SECOND
   """A second according to gstreamer. """
 
+  __gsignals__ = {
+    'switched' : ( gobject.SIGNAL_RUN_LAST,
+                   gobject.TYPE_NONE,
+                   (gobject.TYPE_STRING,)),
+    'stopped' : ( gobject.SIGNAL_RUN_LAST,
+                  gobject.TYPE_NONE,
+                  tuple())
+  }
+
   @withdoc(gobject.property)
   def eos(self):
     """If the player is currently at the end of a stream."""
     with self._lock:
       return self._eos
 
-  def __init__(self,bus,directory):
+  def __init__(self,bus,directory,next_file=None,pool_size=0,timeouts=None,async_state=False):
     """Create the gstreamer player abstraction.
 
     Arguments:
       bus         A gobject to emit error signals to.
       directory   The directory where the audio files are located.
+      next_file   Function that takes a filename and returns the file to play
+                  after it, or None if there is none. If given, the next file
+                  is queued before the current one ends so that playback
+                  continues without a gap. It is called from a gstreamer
+                  streaming thread and must not take any locks, for example
+                  by using a snapshot of the files such as FileIndex.peek().
+                  (Optional, defaults to None.)
+      pool_size   Number of prerolled pipelines to keep for recently used and
+                  neighbouring files, so that switching to them does not
+                  require loading them again. (Optional, defaults to 0.)
+      timeouts    Dictionary with how long (in milliseconds) each of the
+                  operations load, play, pause and seek may take. Operations
+                  that take longer are reported as errors instead of hanging
+                  the player. (Optional, defaults to STATE_TIMEOUTS.)
+      async_state True to not wait for play, pause and seek to finish. They
+                  are instead finished when gstreamer reports that it is
+                  done, or reported as errors when they time out. Load
+                  always waits, since the duration is needed. (Optional,
+                  defaults to False.)
     """
     gobject.GObject.__init__(self)
     self._lock = threading.RLock()
@@ -65,67 +243,380 @@ class Player(gobject.GObject):
     self._filename = None
     self._hasplayed = False
     self._duration = 0
+    self._playing = False
+    self._eos = False
+
+    self._timeouts = dict(STATE_TIMEOUTS)
+    if timeouts != None:
+      self._timeouts.update(timeouts)
+    self._async = async_state
+    # Operations that are waited for asynchronously, as seq ->
+    # (operation,start). A numbered marker is posted on the bus before each
+    # operation begins, and ASYNC_DONE only finishes the operations whose
+    # markers have come through, since it was posted after they began.
+    self._pending = {}
+    self._pending_seq = 0
+    self._seen_pending_seq = 0
+    # operation -> [count,total,max,timeouts,failures] of latency in seconds.
+    self._state_stats = dict((op,[0,0.0,0.0,0,0]) for op in self._timeouts)
+
+    # Eos is cleared by posting a numbered marker on the bus of the current
+    # pipeline. Eos messages are only believed when the latest marker has
+    # come through, since earlier ones were posted before eos was cleared.
+    self._eos_seq = 0
+    self._seen_eos_seq = 0
+
+    # Replaced, never modified, whenever the position changes other than by
+    # playing on, so that it can be read without taking the lock.
+    self._snapshot = PositionSnapshot(None, 0, 0, time.time(), 1.0, False)
+    # Correct the extrapolation now and then while playing, for example if
+    # the rate has been changed through the gst object.
+    self._resync = Timer(1000, self._on_resync, repeat=True)
+
+    self._prober = None
+    self._probe_lock = threading.RLock()
+
+    # Files queued for gapless playback that playback has not reached yet.
+    # Protected by its own lock since it is used from gstreamer threads.
+    self._next_file = next_file
+    self._queued = []
+    self._queued_lock = threading.Lock()
+    self._flushed = False
+
+    self._pool = PipelinePool(pool_size,self._dispose)
+    self._prefetch = []
+    self._prefetch_id = None
+    # Pipeline that is being prerolled for the pool, as
+    # (pipeline,filename,timeout id), or None.
+    self._prerolling = None
 
-    self.gst = gst.element_factory_make("playbin2", "audioplayer")
+    self.gst = self._make_pipeline()
+
+  def _make_pipeline(self):
+    """Create a new playbin2 pipeline.
+
+    Returns:  The pipeline.
+    """
+    pipeline = gst.element_factory_make("playbin2", "audioplayer")
     fakesink = gst.element_factory_make("fakesink", "fakesink")
-    self.gst.set_property("video-sink", fakesink)
+    pipeline.set_property("video-sink", fakesink)
+
+    if self._next_file != None:
+      pipeline.connect("about-to-finish", self._on_about_to_finish)
+      audiosink = gst.element_factory_make("autoaudiosink", "audiosink")
+      pipeline.set_property("audio-sink", audiosink)
+      audiosink.get_pad("sink").add_event_probe(self._on_sink_event, pipeline)
 
-    self._gstbus = self.gst.get_bus()
-    self._gstbus.add_signal_watch()
-    self._gstbus.connect("message", self._on_message)
+    gstbus = pipeline.get_bus()
+    gstbus.add_signal_watch()
+    gstbus.connect("message", self._on_message, pipeline)
+    return pipeline
 
-    self._clear_eos_count = 0
-    self._on_eos_id = self._gstbus.connect( "message", 
-                                            self._on_eos,
-                                            self._clear_eos_count)
+  def _dispose(self,pipeline):
+    """Shut down a pipeline that is no longer used.
+
+    Arguments:
+      pipeline  The pipeline.
+    """
+    pipeline.set_state(gst.STATE_NULL)
+    pipeline.get_bus().remove_signal_watch()
 
-  def _on_message(self, bus, message):
+  def _on_message(self, bus, message, pipeline):
     """A message was received from gstreamer.
     
     Arguments:
       bus       The gstreamer bus.
       message   The message gstreamer sent to us.
+      pipeline  The pipeline that the bus belongs to.
     """
     with self._lock:
       t = message.type
       if t == gst.MESSAGE_ERROR:
+        if pipeline is self.gst:
+          self.gst.set_state(gst.STATE_NULL)
+          self._playing = False
+          self._resync.stop()
+          self._pending.clear()
+          self._publish()
+          err, _ = message.parse_error()
+          errormsg = "GStreamer: {0} (File: {1})".format(err,self._filename)
+          self._bus.emit("error",errormsg)
+        elif self._prerolling != None and pipeline is self._prerolling[0]:
+          self._prerolled(pipeline, False)
+        else:
+          # A pooled pipeline failed, it will be loaded normally if needed.
+          self._pool.discard(pipeline)
+      elif pipeline is not self.gst:
+        if t == gst.MESSAGE_ASYNC_DONE:
+          self._prerolled(pipeline, True)
+        return
+      elif t == gst.MESSAGE_APPLICATION:
+        structure = message.structure
+        if structure != None and structure.get_name() == _CLEAR_EOS:
+          self._seen_eos_seq = structure["seq"]
+        elif structure != None and structure.get_name() == _BEGIN:
+          self._seen_pending_seq = structure["seq"]
+      elif t == gst.MESSAGE_EOS and self._seen_eos_seq == self._eos_seq:
+        # Files that were queued have been played, even if it was not
+        # noticed before the stream ended.
+        while len(self._queued)>0:
+          self._switch()
         self.gst.set_state(gst.STATE_NULL)
-        err, _ = message.parse_error()
-        errormsg = "GStreamer: {0} (File: {1})".format(err,self._filename)
-        self._bus.emit("error",errormsg)
-
-  def _on_eos(self, bus, message, clear_eos_count):
-    """A message was received from gstreamer. This second handler also takes a
-    number that this player itself included when the handler was registered.
-    This variable indicates how many times the eos state have been cleared.
-    This is done everytime something is done that would move the player away
-    from eos.
-    
+        self._playing = False
+        self._resync.stop()
+        self._publish()
+        self._eos = True
+        self.notify("eos")
+      elif t == gst.MESSAGE_ASYNC_DONE:
+        done = [seq for seq in self._pending if seq <= self._seen_pending_seq]
+        for seq in sorted(done):
+          (operation,start) = self._pending.pop(seq)
+          self._finish(operation,start,"done")
+        if len(done) > 0:
+          self._publish()
+
+  def _on_about_to_finish(self, playbin):
+    """Playbin is about to run out of data, queue the next file. This is
+    called from a streaming thread, so the player lock must not be taken.
+
     Arguments:
-      bus               The gstreamer bus.
-      message           The message gstreamer sent to us.
-      clear_eos_count   The number of times the eos has been cleared.
+      playbin   The gstreamer playbin.
     """
+    if playbin is not self.gst:
+      return
+    with self._queued_lock:
+      if len(self._queued)>0:
+        current = self._queued[-1]
+      else:
+        current = self._filename
+      next_file = self._next_file(current)
+      if next_file != None:
+        playbin.set_property("uri", self._uri(next_file))
+        self._queued.append(next_file)
+
+  def _on_sink_event(self, pad, event, pipeline):
+    """An event reached the audio sink. A new segment that is not the result
+    of a flushing seek means that playback moved on to a queued file. This is
+    called from a streaming thread, so the player lock must not be taken.
+
+    Arguments:
+      pad       The sink pad of the audio sink.
+      event     The event.
+      pipeline  The pipeline that the sink belongs to.
+
+    Returns:    True to let the event pass.
+    """
+    if pipeline is not self.gst:
+      return True
+    t = event.type
+    if t == gst.EVENT_FLUSH_STOP:
+      self._flushed = True
+    elif t == gst.EVENT_NEWSEGMENT:
+      if self._flushed:
+        self._flushed = False
+      else:
+        with self._queued_lock:
+          if len(self._queued)>0:
+            gobject.idle_add(self._switch)
+    return True
+
+  def _forget_queued(self):
+    """Forget the files queued for gapless playback, since the next
+    about-to-finish queues them again from the current file. Otherwise a seek
+    back within the current file would make it queue the file after next. """
     with self._lock:
-      t = message.type
-      if t == gst.MESSAGE_EOS and clear_eos_count == self._clear_eos_count:
-        self.gst.set_state(gst.STATE_NULL)
-        self._eos = True
-        self.notify("eos")
+      with self._queued_lock:
+        self._queued = []
+
+  def _switch(self):
+    """Playback has reached the first queued file, make it the current one.
+
+    Returns:  False, so that it is only run once when used as an idle callback.
+    """
+    with self._lock:
+      with self._queued_lock:
+        if len(self._queued)==0:
+          return False
+        filename = self._queued.pop(0)
+      self._filename = filename
+      self._hasplayed = True
+      try:
+        self._duration = self.gst.query_duration(gst.FORMAT_TIME,None)[0]
+      except gst.QueryError:
+        self._duration = 0
+      self._publish()
+    self.emit("switched",filename)
+    return False
 
   def _clear_eos(self):
-    """Forget all pending eos events."""
+    """Forget all pending eos events. Call it after changing the state of the
+    pipeline, since the marker would be lost if the pipeline is stopped."""
     with self._lock:
       # We are no longer at the end of a stream.
       self._eos = False
       self.notify("eos")
-      # Increase the clear_eos_count sent with new events.
-      self._gstbus.disconnect(self._on_eos_id)
-      self._clear_eos_count += 1
-      self._on_eos_id = self._gstbus.connect( "message"
-                                            , self._on_eos
-                                            , self._clear_eos_count
-                                            )
+      self._eos_seq += 1
+      structure = gst.Structure(_CLEAR_EOS)
+      structure["seq"] = self._eos_seq
+      self.gst.post_message(gst.message_new_application(self.gst, structure))
+
+  def _begin(self,operation):
+    """Start timing an operation. Call it right before the operation is
+    started.
+
+    Arguments:
+      operation   One of the operations in STATE_TIMEOUTS.
+
+    Returns:  The start time, to give to _wait().
+    """
+    with self._lock:
+      if self._async and operation != "load":
+        self._pending_seq += 1
+        structure = gst.Structure(_BEGIN)
+        structure["seq"] = self._pending_seq
+        self.gst.post_message(gst.message_new_application(self.gst, structure))
+      return time.time()
+
+  def _wait(self,operation,start,result):
+    """Wait for a state change or seek of the current pipeline to finish, but
+    at most the timeout of the operation. With asynchronous state changes,
+    play, pause and seek do not wait but are finished when gstreamer says
+    that it is done.
+
+    Arguments:
+      operation   One of the operations in STATE_TIMEOUTS.
+      start       When the operation was started, as given by _begin().
+      result      The state change return that gstreamer gave when the
+                  operation was started.
+
+    Returns:  False if the operation failed or timed out.
+    """
+    with self._lock:
+      timeout = self._timeouts[operation]
+      if result == gst.STATE_CHANGE_FAILURE:
+        return self._finish(operation,start,"failed")
+      if self._async and operation != "load":
+        if result == gst.STATE_CHANGE_ASYNC:
+          seq = self._pending_seq
+          self._pending[seq] = (operation,start)
+          gobject.timeout_add(timeout, self._on_state_timeout, seq)
+          return True
+        return self._finish(operation,start,"done")
+      (result,_,_) = self.gst.get_state(timeout*gst.MSECOND)
+      if result == gst.STATE_CHANGE_FAILURE:
+        return self._finish(operation,start,"failed")
+      elif result == gst.STATE_CHANGE_ASYNC:
+        return self._finish(operation,start,"timeout")
+      return self._finish(operation,start,"done")
+
+  def _on_state_timeout(self,seq):
+    """An asynchronous operation may have timed out.
+
+    Arguments:
+      seq   Which operation the timeout is for.
+
+    Returns:  False, so that it is only run once.
+    """
+    stopped = False
+    with self._lock:
+      if seq in self._pending:
+        (operation,start) = self._pending.pop(seq)
+        self._finish(operation,start,"timeout")
+        if operation == "play":
+          self._playing = False
+          self._resync.stop()
+          self._publish()
+          stopped = True
+    if stopped:
+      self.emit("stopped")
+    return False
+
+  def _finish(self,operation,start,outcome):
+    """Record how an operation went, and report it if it went wrong.
+
+    Arguments:
+      operation   One of the operations in STATE_TIMEOUTS.
+      start       When the operation was started, as given by time.time().
+      outcome     "done", "failed" or "timeout".
+
+    Returns:  True if the outcome was "done".
+    """
+    with self._lock:
+      latency = time.time()-start
+      data = self._state_stats[operation]
+      data[0] += 1
+      data[1] += latency
+      data[2] = max(data[2],latency)
+      if outcome == "timeout":
+        data[3] += 1
+        self._bus.emit("error","GStreamer did not {0} within {1} ms. (File: {2})".format(
+          operation, self._timeouts[operation], self._filename))
+      elif outcome == "failed":
+        data[4] += 1
+        self._bus.emit("error","GStreamer failed to {0}. (File: {1})".format(
+          operation, self._filename))
+      return outcome == "done"
+
+  def state_stats(self):
+    """Get statistics of how long player operations take.
+
+    Returns:  Dictionary from operation (load, play, pause, seek) to a
+              dictionary with the count, mean and maximum latency (in
+              seconds), and the number of timeouts and failures.
+    """
+    with self._lock:
+      result = {}
+      for (operation,(count,total,maximum,timeouts,failures)) in self._state_stats.items():
+        result[operation] = {
+          "count" : count,
+          "latency" : total/count if count>0 else 0.0,
+          "latency_max" : maximum,
+          "timeouts" : timeouts,
+          "failures" : failures }
+      return result
+
+  def _activate(self,pipeline):
+    """Make the given pipeline the one that is played.
+
+    Arguments:
+      pipeline  The pipeline.
+    """
+    with self._lock:
+      old = self.gst
+      if pipeline is not old:
+        for prop in ["volume","mute"]:
+          pipeline.set_property(prop, old.get_property(prop))
+        self.gst = pipeline
+      with self._queued_lock:
+        self._queued = []
+      self._flushed = False
+      # Operations on the old pipeline will not be finished.
+      self._pending.clear()
+      self._clear_eos()
+
+  def _retire(self):
+    """Put the current pipeline in the pool if it can be used again, otherwise
+    shut it down. """
+    with self._lock:
+      (_,state,_) = self.gst.get_state(0)
+      reusable = ( self._filename != None and self._duration > 0
+                 and state == gst.STATE_PAUSED and len(self._queued)==0 )
+      if reusable:
+        self._pool.put(self._filename, self.gst, self._duration)
+      else:
+        self._dispose(self.gst)
+
+  def _uri(self,filename):
+    """Get the uri of a file in the audiobook directory.
+
+    Arguments:
+      filename  The file to get the uri of.
+
+    Returns:    The uri as a string.
+    """
+    filepath = os.path.expanduser(os.path.join(self._directory,filename))
+    filepath = os.path.abspath(filepath)
+    return "file://" + filepath
 
   def load(self,filename):
     """Load the given file.
@@ -136,23 +627,197 @@ class Player(gobject.GObject):
     Returns:    True if the load was successfull, otherwise False.
     """
     with self._lock:
-      self._clear_eos()
-      filepath = os.path.expanduser(os.path.join(self._directory,filename))
-      filepath = os.path.abspath(filepath)
+      if self._pool.size > 0:
+        start = time.time()
+        entry = self._pool.take(filename)
+        self._retire()
+        if entry != None:
+          # Already prerolled, just switch to it and rewind.
+          (pipeline, duration) = entry
+          self._activate(pipeline)
+          self._filename = filename
+          self._hasplayed = False
+          self._duration = duration
+          seeked = self.gst.seek_simple(gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH, 0)
+          if not self._wait("load", start, _seek_result(seeked)):
+            self._unload()
+            self._pool.record(False, time.time()-start)
+            return False
+          self._playing = False
+          self._resync.stop()
+          self._publish()
+          self._pool.record(True, time.time()-start)
+          return True
+        self._activate(self._make_pipeline())
+        result = self._load(filename)
+        self._pool.record(False, time.time()-start)
+        return result
+      else:
+        return self._load(filename)
+
+  def _load(self,filename):
+    """Load the given file into the current pipeline.
+
+    Arguments:
+      filename  The file to load.
+
+    Returns:    True if the load was successfull, otherwise False.
+    """
+    with self._lock:
+      start = time.time()
       self._filename = filename
       self._hasplayed = False
+      self._playing = False
+      self._resync.stop()
       self.gst.set_state(gst.STATE_NULL)
-      self.gst.set_property("uri", "file://" + filepath)
-      self.gst.set_state(gst.STATE_PAUSED)
-      self.gst.get_state()
+      with self._queued_lock:
+        self._queued = []
+      self._flushed = False
+      self.gst.set_property("uri", self._uri(filename))
+      result = self.gst.set_state(gst.STATE_PAUSED)
+      self._clear_eos()
+      if not self._wait("load", start, result):
+        self._unload()
+        return False
       try:
         dur = self.gst.query_duration(gst.FORMAT_TIME,None)[0]
       except gst.QueryError:
-        self._duration = 0
+        self._unload()
         return False
       self._duration = dur
+      self._publish()
       return True
 
+  def _unload(self):
+    """Stop the current pipeline after a failed load, so that it is not left
+    loading in the background or thought to have the file loaded. """
+    with self._lock:
+      self.gst.set_state(gst.STATE_NULL)
+      self._filename = None
+      self._duration = 0
+      self._publish()
+
+  def prefetch(self,filenames):
+    """Preroll files in the background so that loading them is quick. This
+    replaces any files from earlier calls that have not been prerolled yet.
+    Does nothing unless the pool is enabled.
+
+    Arguments:
+      filenames   List of files to preroll. None entries are ignored.
+    """
+    with self._lock:
+      if self._pool.size == 0:
+        return
+      self._prefetch = [f for f in filenames if f != None][:self._pool.size]
+      if ( self._prefetch_id == None and self._prerolling == None
+           and len(self._prefetch)>0 ):
+        self._prefetch_id = gobject.idle_add(self._on_prefetch)
+
+  def _on_prefetch(self):
+    """Start prerolling the next file that should be prefetched. It is
+    finished by _prerolled() when gstreamer is done, so that nothing waits
+    for gstreamer in the main loop.
+
+    Returns:  False, so that it is only run once.
+    """
+    with self._lock:
+      self._prefetch_id = None
+      filename = None
+      while filename == None and len(self._prefetch)>0:
+        candidate = self._prefetch.pop(0)
+        if candidate != self._filename and not self._pool.contains(candidate):
+          filename = candidate
+      if filename == None:
+        return False
+      pipeline = self._make_pipeline()
+      pipeline.set_property("uri", self._uri(filename))
+      timeout_id = gobject.timeout_add(self._timeouts["load"],
+                                       self._on_preroll_timeout, pipeline)
+      self._prerolling = (pipeline, filename, timeout_id)
+      result = pipeline.set_state(gst.STATE_PAUSED)
+      if result != gst.STATE_CHANGE_ASYNC:
+        self._prerolled(pipeline, result == gst.STATE_CHANGE_SUCCESS)
+      return False
+
+  def _prerolled(self,pipeline,success):
+    """Prerolling a pipeline for the pool finished, failed or timed out. Put
+    it in the pool and go on with the next file.
+
+    Arguments:
+      pipeline  The pipeline that was prerolled.
+      success   True if it was prerolled.
+    """
+    with self._lock:
+      if self._prerolling == None or self._prerolling[0] is not pipeline:
+        return
+      (_, filename, timeout_id) = self._prerolling
+      self._prerolling = None
+      if timeout_id != None:
+        gobject.source_remove(timeout_id)
+      duration = None
+      if success:
+        try:
+          duration = pipeline.query_duration(gst.FORMAT_TIME,None)[0]
+        except gst.QueryError:
+          pass
+      if duration == None or filename == self._filename:
+        self._dispose(pipeline)
+      else:
+        self._pool.put(filename, pipeline, duration)
+      if len(self._prefetch)>0 and self._prefetch_id == None:
+        self._prefetch_id = gobject.idle_add(self._on_prefetch)
+
+  def _on_preroll_timeout(self,pipeline):
+    """Prerolling a pipeline for the pool took too long.
+
+    Arguments:
+      pipeline  The pipeline that was prerolled.
+
+    Returns:  False, so that it is only run once.
+    """
+    with self._lock:
+      if self._prerolling != None and self._prerolling[0] is pipeline:
+        (pipeline, filename, _) = self._prerolling
+        self._prerolling = (pipeline, filename, None)
+        self._prerolled(pipeline, False)
+      return False
+
+  def pool_stats(self):
+    """Get statistics of the pool of prerolled pipelines.
+
+    Returns:  See PipelinePool.stats().
+    """
+    return self._pool.stats()
+
+  def probe(self,filename):
+    """Find the duration of a file without disturbing playback.
+
+    A separate pipeline that is only prerolled is used for this.
+
+    Arguments:
+      filename  The file to probe.
+
+    Returns:    Duration in ns, or None if it could not be found.
+    """
+    # The prober has a lock of its own, so that probing in the background
+    # does not hold up playback.
+    with self._probe_lock:
+      if self._prober == None:
+        self._prober = gst.element_factory_make("playbin2", "prober")
+        for sink in ["audio-sink","video-sink"]:
+          self._prober.set_property(sink, gst.element_factory_make("fakesink"))
+      self._prober.set_property("uri", self._uri(filename))
+      self._prober.set_state(gst.STATE_PAUSED)
+      (result,_,_) = self._prober.get_state(self._timeouts["load"]*gst.MSECOND)
+      try:
+        if result in (gst.STATE_CHANGE_FAILURE, gst.STATE_CHANGE_ASYNC):
+          return None
+        return self._prober.query_duration(gst.FORMAT_TIME,None)[0]
+      except gst.QueryError:
+        return None
+      finally:
+        self._prober.set_state(gst.STATE_NULL)
+
   def play(self):
     """Start playing at the current position."""
     with self._lock:
@@ -161,15 +826,27 @@ class Player(gobject.GObject):
         self.notify("eos")
       else:
         self._hasplayed = True
-        self.gst.set_state(gst.STATE_PLAYING)
-        self.gst.get_state()
+        start = self._begin("play")
+        if self._wait("play", start, self.gst.set_state(gst.STATE_PLAYING)):
+          self._playing = True
+          self._resync.start()
+        else:
+          # Emitted from the main loop, so that the handler does not run
+          # while the caller is holding its own lock.
+          gobject.idle_add(self.emit,"stopped")
+        self._publish()
 
   def pause(self):
     """Pause playback."""
     with self._lock:
+      self._playing = False
+      self._resync.stop()
+      self._forget_queued()
+      start = self._begin("pause")
+      result = self.gst.set_state(gst.STATE_PAUSED)
       self._clear_eos()
-      self.gst.set_state(gst.STATE_PAUSED)
-      self.gst.get_state()
+      self._wait("pause", start, result)
+      self._publish()
 
   def seek(self,time_ns):
     """Seek to the given position in the current file.
@@ -178,9 +855,12 @@ class Player(gobject.GObject):
       time_ns   The position to seek to in nanoseconds.
     """
     with self._lock:
+      self._forget_queued()
+      start = self._begin("seek")
+      seeked = self.gst.seek_simple(gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH, time_ns)
       self._clear_eos()
-      self.gst.seek_simple(gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH, time_ns)
-      self.gst.get_state()
+      self._wait("seek", start, _seek_result(seeked))
+      self._publish()
 
   def position(self):
     """Get the current playback position.
@@ -188,6 +868,63 @@ class Player(gobject.GObject):
     Returns:  (filename,position,duration)
     """
     with self._lock:
+      return self._query_position()
+
+  def position_snapshot(self):
+    """Get the last published position of the player, without taking any
+    locks or asking gstreamer. Use its extrapolate() method to estimate the
+    current position.
+
+    Returns:  PositionSnapshot.
+    """
+    return self._snapshot
+
+  def _publish(self):
+    """Publish the current position for position_snapshot(). """
+    with self._lock:
+      self._snapshot = self._make_snapshot(self._query_position())
+
+  def _make_snapshot(self,position):
+    """Create a snapshot of the given position, taken now.
+
+    Arguments:
+      position  (filename,position,duration)
+
+    Returns:  PositionSnapshot.
+    """
+    with self._lock:
+      (filename,pos,duration) = position
+      rate = 1.0
+      try:
+        query = gst.query_new_segment(gst.FORMAT_TIME)
+        if self.gst.query(query):
+          rate = query.parse_segment()[0]
+      except gst.QueryError:
+        pass
+      return PositionSnapshot(filename, pos, duration, time.time(), rate, self._playing)
+
+  def _on_resync(self):
+    """Publish the position again, unless the player is busy, in which case
+    it will be published when it is done. """
+    if self._lock.acquire(False):
+      try:
+        if self._playing:
+          self._publish()
+      finally:
+        self._lock.release()
+
+  def _query_position(self):
+    """Ask gstreamer for the current playback position.
+
+    Returns:  (filename,position,duration)
+    """
+    with self._lock:
+      if self._duration == 0 and self._hasplayed:
+        # The duration may not have been known yet when switching file.
+        try:
+          self._duration = self.gst.query_duration(gst.FORMAT_TIME,None)[0]
+        except gst.QueryError:
+          pass
       try:
         pos = self.gst.query_position(gst.FORMAT_TIME,None)[0]
       except gst.QueryError:
@@ -216,4 +953,31 @@ class Player(gobject.GObject):
   def quit(self):
     """Shut down the player."""
     with self._lock:
+      self._resync.stop()
+      if self._prefetch_id != None:
+        gobject.source_remove(self._prefetch_id)
+        self._prefetch_id = None
+      if self._prerolling != None:
+        (pipeline, _, timeout_id) = self._prerolling
+        self._prerolling = None
+        if timeout_id != None:
+          gobject.source_remove(timeout_id)
+        self._dispose(pipeline)
+      self._pool.clear()
       self.gst.set_state(gst.STATE_NULL)
+      if self._prober != None:
+        self._prober.set_state(gst.STATE_NULL)
+
+def _seek_result(seeked):
+  """Turn the result of a seek into a state change return, since a flushing
+  seek makes the pipeline preroll again.
+
+  Arguments:
+    seeked  True if the seek was accepted.
+
+  Returns:  STATE_CHANGE_ASYNC if so, otherwise STATE_CHANGE_FAILURE.
+  """
+  if seeked:
+    return gst.STATE_CHANGE_ASYNC
+  else:
+    return gst.STATE_CHANGE_FAILURE
@@ -0,0 +1,889 @@
+# -*- coding: utf-8 -*-
+"""Segmented storage of the playlog."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+from os.path import basename, dirname, join, isdir
+from bisect import bisect_left, bisect_right
+from array import array
+from collections import OrderedDict
+import mmap
+import os
+import threading
+
+from pstorytime.logentry import LogEntry
+from pstorytime.columnar import ColumnStore
+from pstorytime.coverage import Coverage
+from pstorytime.logcheck import valid_line, read_lines, strip_checksum
+
+__all__ = [
+  'Segment',
+  'PageCache',
+  'MappedEntries',
+  'Playlog',
+  'PlaylogView',
+  'PostingIndex',
+  'find_walltime',
+  'Snapshot',
+  'segment_files',
+  'segment_file',
+  'read_entries',
+  'parse_objects',
+  'STORES',
+  ]
+
+def parse_objects(lines):
+  """Parse lines of the playlog into a list of LogEntry objects, skipping
+  invalid ones.
+
+  Arguments:
+    lines   Iterable of lines.
+
+  Returns:  The list.
+  """
+  return filter(lambda e: e!=None, map(LogEntry.parse, lines))
+
+STORES = {
+  "objects" : parse_objects,
+  "columnar" : ColumnStore.from_lines,
+  }
+"""Ways to keep entries in memory. Each is a function that parses lines into
+a list-like object that entries can be appended to. """
+
+def segment_file(playlog_file,number):
+  """Get the path of a sealed segment of a playlog.
+
+  Arguments:
+    playlog_file  Path to the playlog. This is also the active segment.
+    number        Number of the segment.
+
+  Returns:        Path to the segment.
+  """
+  return "{0}.{1:06d}".format(playlog_file,number)
+
+def segment_files(playlog_file):
+  """Find the sealed segments of a playlog.
+
+  Arguments:
+    playlog_file  Path to the playlog. This is also the active segment.
+
+  Returns:        List of (number,path) in order, oldest first.
+  """
+  dirpath = dirname(playlog_file)
+  prefix = basename(playlog_file)+"."
+  try:
+    names = os.listdir(dirpath if dirpath!='' else '.')
+  except OSError:
+    return []
+  segments = []
+  for name in names:
+    suffix = name[len(prefix):]
+    if name.startswith(prefix) and len(suffix)==6 and suffix.isdigit():
+      segments.append((int(suffix),join(dirpath,name)))
+  segments.sort()
+  return segments
+
+def read_entries(path,parse=parse_objects):
+  """Read all valid entries of a playlog file.
+
+  Arguments:
+    path    The file to read.
+    parse   One of STORES, used to parse the lines. (Optional, defaults to
+            parse_objects.)
+
+  Returns:  (entries,size) where size is the size of the file in bytes.
+  """
+  try:
+    with open(path,'rb') as f:
+      data = f.read()
+  except IOError:
+    return (parse([]),0)
+  return (parse(data.split("\n")),len(data))
+
+class PageCache(object):
+  """Least recently used cache of pages of entries, limited by the total
+  number of entries in the pages. """
+  def __init__(self,capacity):
+    """Create an empty cache.
+
+    Arguments:
+      capacity  Number of entries to keep. At least one page is always kept.
+    """
+    self._lock = threading.RLock()
+    self.capacity = capacity
+    # key -> page, least recently used first.
+    self._pages = OrderedDict()
+    self._size = 0
+
+  def get(self,key,load):
+    """Get a page, loading it if it is not cached.
+
+    Arguments:
+      key   Key of the page.
+      load  Function that reads the page, called without arguments.
+
+    Returns:  The page.
+    """
+    with self._lock:
+      page = self._pages.pop(key,None)
+      if page == None:
+        page = load()
+        self._size += len(page)
+      self._pages[key] = page
+      while self._size > self.capacity and len(self._pages) > 1:
+        (_,evicted) = self._pages.popitem(last=False)
+        self._size -= len(evicted)
+      return page
+
+  def __len__(self):
+    return self._size
+
+class Segment(object):
+  """A sealed part of the playlog that is only read when needed.
+
+  Without a cache, all entries are read the first time one is accessed and
+  then kept. With a cache, the entries are read a page at a time, using an
+  index of where each page starts in the file, and the cache decides which
+  pages are kept.
+  """
+  PAGE = 256
+  """Number of entries in a page. """
+
+  def __init__(self,path,number,count,size,entries=None,parse=parse_objects,cache=None):
+    """Create a segment.
+
+    Arguments:
+      path      Path to the segment file.
+      number    Number of the segment.
+      count     Number of entries in it.
+      size      Size of the file in bytes.
+      entries   The entries, if they are already known. Not used with a
+                cache. (Optional, defaults to None.)
+      parse     One of STORES, used when reading the entries. (Optional,
+                defaults to parse_objects.)
+      cache     PageCache shared by the segments of a playlog, or None to
+                keep all entries. (Optional, defaults to None.)
+    """
+    self._lock = threading.RLock()
+    self.path = path
+    self.number = number
+    self.count = count
+    self.size = size
+    self._cache = cache
+    self._entries = entries if cache == None else None
+    self._parse = parse
+    # Offsets in the file where each page starts, built when first needed.
+    self._offsets = None
+
+  def _pad(self,entries,count):
+    """The count is what positions in the playlog are based on, so make sure
+    that there are enough entries even if the file has been changed behind
+    our back. """
+    while len(entries) < count:
+      entries.append(LogEntry(0,"invalid","",0,0))
+    return entries
+
+  def entries(self):
+    """Get the entries of the segment, reading them if needed. With a cache,
+    they are read every time and not kept.
+
+    Returns:  List-like object of LogEntry objects.
+    """
+    with self._lock:
+      if self._entries != None:
+        return self._entries
+      (entries,_) = read_entries(self.path,self._parse)
+      entries = self._pad(entries,self.count)
+      if self._cache == None:
+        self._entries = entries
+      return entries
+
+  def entry(self,i):
+    """Get an entry of the segment, reading it if needed.
+
+    Arguments:
+      i   Index of the entry in the segment.
+
+    Returns:  The entry.
+    """
+    if self._cache == None:
+      return self.entries()[i]
+    page = i // self.PAGE
+    entries = self._cache.get((self.number,page), lambda: self._read_page(page))
+    return entries[i % self.PAGE]
+
+  def _page_offsets(self):
+    """Get the offsets where the pages start, scanning the file if needed.
+
+    Returns:  Array of offsets.
+    """
+    with self._lock:
+      if self._offsets == None:
+        offsets = array('L')
+        valid = 0
+        try:
+          with open(self.path,'rb') as f:
+            for (offset,line) in read_lines(f):
+              if valid_line(line):
+                if valid % self.PAGE == 0:
+                  offsets.append(offset)
+                valid += 1
+        except IOError:
+          pass
+        self._offsets = offsets
+      return self._offsets
+
+  def _read_page(self,page):
+    """Read a page of entries from the file.
+
+    Arguments:
+      page  Number of the page.
+
+    Returns:  List-like object of the entries.
+    """
+    offsets = self._page_offsets()
+    lines = []
+    if page < len(offsets):
+      try:
+        with open(self.path,'rb') as f:
+          f.seek(offsets[page])
+          if page+1 < len(offsets):
+            data = f.read(offsets[page+1]-offsets[page])
+          else:
+            data = f.read()
+        lines = data.split("\n")
+      except IOError:
+        pass
+    return self._pad(self._parse(lines), min(self.PAGE,self.count-page*self.PAGE))
+
+  def loaded(self):
+    """Check if the entries have been read and are kept.
+
+    Returns:  True if so.
+    """
+    with self._lock:
+      return self._entries != None
+
+  def __len__(self):
+    return self.count
+
+class MappedEntries(object):
+  """Entries of a playlog file that are read through a memory map.
+
+  Only the end of the file is read when it is opened, to find the last valid
+  entry. A background thread then builds an index of where each valid line
+  starts, and entries are parsed from the map when they are accessed.
+  Entries that are appended later are kept in memory.
+
+  It can be used like a read-only list of entries, except that entries can
+  be appended. Getting the length, or an entry that has not been indexed
+  yet, waits for the index.
+
+  Fields:
+    size  Size of the file in bytes when it was opened.
+    last  The last valid entry in the file, or None if there is none.
+  """
+  _BATCH = 4096
+
+  def __init__(self,path,parse=parse_objects):
+    """Open a playlog file.
+
+    Arguments:
+      path    The file to read. A missing file is treated as empty.
+      parse   One of STORES, used to keep appended entries. (Optional,
+              defaults to parse_objects.)
+    """
+    self._lock = threading.RLock()
+    self._indexed = threading.Event()
+    self._offsets = array('L')
+    self._appended = parse([])
+    self._map = None
+    self.size = 0
+    try:
+      with open(path,'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > 0:
+          self._map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+          self.size = size
+    except EnvironmentError:
+      pass
+    self.last = self._find_last()
+
+    if self._map == None:
+      self._indexed.set()
+    else:
+      thread = threading.Thread(target=self._index, name="MappedEntries")
+      thread.daemon = True
+      thread.start()
+
+  def _find_last(self):
+    """Scan backwards from the end of the file for the last valid entry.
+
+    Returns:  The entry, or None if there is none.
+    """
+    if self._map == None:
+      return None
+    end = self.size
+    while end > 0:
+      start = self._map.rfind("\n",0,end)+1
+      entry = LogEntry.parse(self._map[start:end])
+      if entry != None:
+        return entry
+      end = start-1
+    return None
+
+  def _index(self):
+    """Background thread that finds the offsets of all valid lines. """
+    data = self._map
+    find = data.find
+    parse = LogEntry.parse
+    size = self.size
+    batch = array('L')
+    start = 0
+    while start < size:
+      end = find("\n",start)
+      if end == -1:
+        end = size
+      if parse(data[start:end]) != None:
+        batch.append(start)
+      start = end+1
+      if len(batch) >= self._BATCH:
+        with self._lock:
+          self._offsets.extend(batch)
+        batch = array('L')
+    with self._lock:
+      self._offsets.extend(batch)
+    self._indexed.set()
+
+  def _entry_at(self,offset):
+    """Parse the line that starts at the given offset. """
+    end = self._map.find("\n",offset)
+    if end == -1:
+      end = self.size
+    return LogEntry.parse(self._map[offset:end])
+
+  def indexed(self):
+    """Check if the whole file has been indexed.
+
+    Returns:  True if so.
+    """
+    return self._indexed.is_set()
+
+  def wait(self):
+    """Wait until the whole file has been indexed. """
+    self._indexed.wait()
+
+  def entries_from(self,offset):
+    """Parse the valid entries after a given offset in the file right away,
+    without waiting for the index.
+
+    Arguments:
+      offset  Offset in bytes where a line starts.
+
+    Returns:  List of entries.
+    """
+    if self._map == None or offset >= self.size:
+      return []
+    lines = self._map[offset:self.size].split("\n")
+    return filter(lambda e: e!=None, map(LogEntry.parse, lines))
+
+  def append(self,entry):
+    """Append an entry.
+
+    Arguments:
+      entry   The LogEntry to append.
+    """
+    with self._lock:
+      self._appended.append(entry)
+
+  def __len__(self):
+    self.wait()
+    with self._lock:
+      return len(self._offsets) + len(self._appended)
+
+  def __getitem__(self,i):
+    if isinstance(i,slice):
+      return [self[j] for j in xrange(*i.indices(len(self)))]
+    with self._lock:
+      if 0 <= i < len(self._offsets):
+        return self._entry_at(self._offsets[i])
+    length = len(self)
+    with self._lock:
+      if i < 0:
+        i += length
+      if i < 0 or i >= length:
+        raise IndexError("playlog index out of range")
+      mapped = len(self._offsets)
+      if i < mapped:
+        return self._entry_at(self._offsets[i])
+      return self._appended[i-mapped]
+
+  def __iter__(self):
+    for i in xrange(0,len(self)):
+      yield self[i]
+
+class Playlog(object):
+  """Sequence of all entries in a segmented playlog, that entries can be
+  appended to.
+
+  Sealed segments are only read when an entry in them is accessed, while the
+  active segment is read through a memory map.
+
+  Readers should use a view, which can be used without locking.
+  """
+  def __init__(self,segments,active,parse=parse_objects):
+    """Create the playlog.
+
+    Arguments:
+      segments  List of sealed segments, oldest first.
+      active    List-like object of entries in the active segment, such as
+                MappedEntries.
+      parse     One of STORES, used to create new active segments.
+                (Optional, defaults to parse_objects.)
+    """
+    self._lock = threading.RLock()
+    self._parse = parse
+    starts = []
+    total = 0
+    for segment in segments:
+      starts.append(total)
+      total += segment.count
+    # (segments,starts,sealed,active). The tuple is replaced, never modified,
+    # so that views can hold on to it.
+    self._state = (tuple(segments),tuple(starts),total,active)
+
+  def append(self,entry):
+    """Add an entry to the active segment.
+
+    Arguments:
+      entry   The entry to add.
+    """
+    with self._lock:
+      self._state[3].append(entry)
+
+  def seal(self,segment):
+    """Turn the entries of the active segment into a sealed segment and start
+    a new empty active segment.
+
+    Arguments:
+      segment   The new sealed segment. It must contain the active entries.
+    """
+    with self._lock:
+      (segments,starts,sealed,_) = self._state
+      self._state = ( segments+(segment,),
+                      starts+(sealed,),
+                      sealed+segment.count,
+                      self._parse([]))
+
+  def segments(self):
+    """Get the sealed segments.
+
+    Returns:  List of segments, oldest first.
+    """
+    return list(self._state[0])
+
+  def active(self):
+    """Get the entries of the active segment.
+
+    Returns:  List-like object of entries. It must not be modified.
+    """
+    return self._state[3]
+
+  def view(self,length,version=0):
+    """Get a view of the first entries of the playlog.
+
+    Arguments:
+      length    Number of entries in the view. It must not be more than what
+                is in the playlog.
+      version   Version number of the view. (Optional, defaults to 0.)
+
+    Returns:  The view.
+    """
+    return PlaylogView(self._state,length,version)
+
+  def __len__(self):
+    (_,_,sealed,active) = self._state
+    return sealed + len(active)
+
+  def __getitem__(self,i):
+    return self.view(len(self))[i]
+
+  def __iter__(self):
+    for i in xrange(0,len(self)):
+      yield self[i]
+
+class PlaylogView(object):
+  """Read-only view of the first entries of a playlog.
+
+  Entries are only ever appended to the playlog, so a view does not change
+  when the playlog grows or when its active segment is sealed. Views are
+  therefore safe to use from any thread without locking.
+
+  Fields:
+    version   Version number of the view.
+  """
+  def __init__(self,state,length,version):
+    """Create a view. Use Playlog.view() instead. """
+    (self._segments,self._starts,self._sealed,self._active) = state
+    self._length = length
+    self.version = version
+
+  def __len__(self):
+    return self._length
+
+  def __getitem__(self,i):
+    if isinstance(i,slice):
+      return [self[j] for j in xrange(*i.indices(self._length))]
+    if i < 0:
+      i += self._length
+    if i < 0 or i >= self._length:
+      raise IndexError("playlog index out of range")
+    if i >= self._sealed:
+      return self._active[i-self._sealed]
+    s = bisect_right(self._starts,i)-1
+    return self._segments[s].entry(i-self._starts[s])
+
+  def __iter__(self):
+    for i in xrange(0,self._length):
+      yield self[i]
+
+def find_walltime(playlog,walltime):
+  """Find where entries at a given walltime start in a playlog, by bisection.
+  The entries must be in order of walltime, which is how they are logged.
+
+  Arguments:
+    playlog   Playlog or view to search.
+    walltime  The walltime in seconds since the epoch.
+
+  Returns:    Index of the first entry at or after the walltime, or the length
+              of the playlog if there is none.
+  """
+  lo = 0
+  hi = len(playlog)
+  while lo < hi:
+    mid = (lo+hi)//2
+    if playlog[mid].walltime < walltime:
+      lo = mid+1
+    else:
+      hi = mid
+  return lo
+
+class PostingIndex(object):
+  """Indices of the entries in a playlog for each event name, each filename
+  and each combination of the two, as sorted arrays. Entries must be added in
+  order.
+  """
+  def __init__(self,entries=[],start=0):
+    """Create an index.
+
+    Arguments:
+      entries   Entries to start with. (Optional, defaults to no entries.)
+      start     Index in the playlog of the first entry. (Optional, defaults
+                to 0.)
+    """
+    self._lock = threading.RLock()
+    self._events = {}
+    self._filenames = {}
+    self._pairs = {}
+    self._start = start
+    self._count = start
+    for entry in entries:
+      self.add(entry)
+
+  def add(self,entry):
+    """Add the next entry of the playlog.
+
+    Arguments:
+      entry   The entry.
+    """
+    self._add(entry.event,entry.filename)
+
+  def _add(self,event,filename):
+    """Add the next entry of the playlog, given as its event and filename. """
+    with self._lock:
+      self._events.setdefault(event,array('l')).append(self._count)
+      self._filenames.setdefault(filename,array('l')).append(self._count)
+      self._pairs.setdefault((event,filename),array('l')).append(self._count)
+      self._count += 1
+
+  @staticmethod
+  def read(path,start,count):
+    """Index the entries of a sealed segment by reading its file, without
+    creating LogEntry objects. Entries that are missing from the file are
+    indexed the same way as Segment pads them.
+
+    Arguments:
+      path    The file to read.
+      start   Index in the playlog of the first entry.
+      count   Number of entries in the segment.
+
+    Returns:  The index.
+    """
+    index = PostingIndex(start=start)
+    try:
+      with open(path,'rb') as f:
+        for (_,line) in read_lines(f):
+          if len(index) >= count:
+            break
+          line = strip_checksum(line)
+          if line == None:
+            continue
+          data = line.split(' ')
+          if len(data) < 5:
+            continue
+          try:
+            int(data[0])
+            int(data[-2])
+            int(data[-1])
+          except ValueError:
+            continue
+          index._add(data[1]," ".join(data[2:-2]))
+    except IOError:
+      pass
+    while len(index) < count:
+      index._add("invalid","")
+    return index
+
+  def merge(self,later):
+    """Add the entries of an index that starts where this one ends.
+
+    Arguments:
+      later   The other index.
+
+    Exceptions:
+      ValueError  If the other index does not start where this one ends.
+    """
+    with self._lock:
+      if later._start != self._count:
+        raise ValueError("Posting indices do not follow each other.")
+      for (mine,theirs) in [(self._events,later._events),
+                            (self._filenames,later._filenames),
+                            (self._pairs,later._pairs)]:
+        for (key,indices) in theirs.iteritems():
+          mine.setdefault(key,array('l')).extend(indices)
+      self._count = later._count
+
+  def _postings(self,event,filename):
+    """Get the array of indices for a query, which must not be modified. """
+    if filename == None:
+      return self._events.get(event)
+    elif event == None:
+      return self._filenames.get(filename)
+    else:
+      return self._pairs.get((event,filename))
+
+  def find(self,event=None,filename=None):
+    """Find entries with a given event name and/or filename.
+
+    Arguments:
+      event     Event name to look for, or None for any. (Optional, defaults
+                to None.)
+      filename  Filename to look for, or None for any. (Optional, defaults
+                to None.)
+
+    Returns:    List of indices in increasing order.
+    """
+    with self._lock:
+      if event == None and filename == None:
+        return range(self._start,self._count)
+      postings = self._postings(event,filename)
+      if postings == None:
+        return []
+      return postings.tolist()
+
+  def last(self,event=None,filename=None,before=None):
+    """Find the last entry before an index with a given event name and/or
+    filename, by bisection.
+
+    Arguments:
+      event     Event name to look for, or None for any. (Optional, defaults
+                to None.)
+      filename  Filename to look for, or None for any. (Optional, defaults
+                to None.)
+      before    Index to look before, or None to look at all entries.
+                (Optional, defaults to None.)
+
+    Returns:    Index of the entry, or None if there is none.
+    """
+    with self._lock:
+      if before == None or before > self._count:
+        before = self._count
+      if event == None and filename == None:
+        return before-1 if before > self._start else None
+      postings = self._postings(event,filename)
+      if postings == None:
+        return None
+      i = bisect_left(postings,before)
+      return postings[i-1] if i > 0 else None
+
+  def __len__(self):
+    return self._count - self._start
+
+class Snapshot(object):
+  """Summary of a playlog that is enough to resume playback without reading
+  the playlog itself.
+
+  Fields:
+    segments      List of (number,count,size) of the sealed segments.
+    active_count  Number of entries of the active segment that are included.
+    active_size   Size in bytes of the included part of the active segment.
+    last          The last entry, or None if the playlog is empty.
+    positions     Dictionary from filename to the last entry in that file.
+    back          List of entries where jumps were made from, that can be
+                  gone back to, oldest first.
+    forward       List of entries that can be gone forward to again after
+                  going back, the next one last.
+    navigate      "back" or "forward" if the next jump is one of those, or
+                  None.
+    coverage      Coverage of which parts of the files have been listened to.
+
+  The back and forward lists work like the history of a web browser. A jump
+  is a seekto or start entry that is further than JUMP from the entry before
+  it. Going back or forward is logged as a back or forward entry followed by
+  the jump.
+  """
+  MAGIC = "pstorytime-snapshot 3"
+
+  JUMP = 30*10**9
+  """Shortest distance in ns that counts as a jump. """
+
+  HISTORY = 100
+  """Largest number of entries kept in each of back and forward. """
+
+  def __init__(self):
+    """Create an empty snapshot. """
+    self.segments = []
+    self.active_count = 0
+    self.active_size = 0
+    self.last = None
+    self.positions = {}
+    self.back = []
+    self.forward = []
+    self.navigate = None
+    self.coverage = Coverage()
+
+  def update(self,entry):
+    """Include an entry. """
+    self.coverage.update(entry,self.last)
+    if entry.event in ("back","forward"):
+      self.navigate = entry.event
+    elif entry.event in ("seekto","start") and self.last != None:
+      origin = self.last
+      if self.navigate == "back":
+        if len(self.back)>0:
+          self.back.pop()
+        self.forward.append(origin)
+      elif self.navigate == "forward":
+        if len(self.forward)>0:
+          self.forward.pop()
+        self.back.append(origin)
+      elif (origin.filename != entry.filename or
+            abs(origin.position-entry.position) >= self.JUMP):
+        self.back.append(origin)
+        del self.forward[:]
+      self.navigate = None
+      del self.back[:-self.HISTORY]
+      del self.forward[:-self.HISTORY]
+    self.last = entry
+    self.positions[entry.filename] = entry
+
+  def total(self):
+    """Number of entries in the playlog.
+
+    Returns:  The number of entries.
+    """
+    return sum(count for (_,count,_) in self.segments) + self.active_count
+
+  @staticmethod
+  def load(path):
+    """Read a snapshot from file.
+
+    Arguments:
+      path    The file to read.
+
+    Returns:  The snapshot, or None if it could not be read.
+    """
+    try:
+      with open(path,'rb') as f:
+        lines = f.read().splitlines()
+    except IOError:
+      return None
+    if len(lines)==0 or lines[0] != Snapshot.MAGIC or lines[-1] != "end":
+      return None
+    snapshot = Snapshot()
+    try:
+      for line in lines[1:-1]:
+        (kind,_,data) = line.partition(" ")
+        if kind == "segment":
+          snapshot.segments.append(tuple(map(int,data.split(" "))))
+        elif kind == "active":
+          (snapshot.active_count,snapshot.active_size) = map(int,data.split(" "))
+        elif kind == "last":
+          snapshot.last = LogEntry.parse(data)
+        elif kind == "position":
+          entry = LogEntry.parse(data)
+          if entry != None:
+            snapshot.positions[entry.filename] = entry
+        elif kind == "back" or kind == "forward":
+          entry = LogEntry.parse(data)
+          if entry != None:
+            getattr(snapshot,kind).append(entry)
+        elif kind == "navigate":
+          snapshot.navigate = data
+        else:
+          snapshot.coverage.parse(kind,data)
+    except ValueError:
+      return None
+    return snapshot
+
+  def save(self,path):
+    """Write the snapshot to file, replacing the old one atomically.
+
+    Arguments:
+      path    The file to write.
+
+    Exceptions:
+      IOError, OSError  If the file could not be written.
+    """
+    lines = [Snapshot.MAGIC]
+    for segment in self.segments:
+      lines.append("segment {0} {1} {2}".format(*segment))
+    lines.append("active {0} {1}".format(self.active_count,self.active_size))
+    if self.last != None:
+      lines.append("last {0}".format(self.last))
+    for entry in self.positions.itervalues():
+      lines.append("position {0}".format(entry))
+    for entry in self.back:
+      lines.append("back {0}".format(entry))
+    for entry in self.forward:
+      lines.append("forward {0}".format(entry))
+    if self.navigate != None:
+      lines.append("navigate {0}".format(self.navigate))
+    lines.extend(self.coverage.lines())
+    lines.append("end")
+
+    dirpath = dirname(path)
+    if not isdir(dirpath) and dirpath!='':
+      os.makedirs(dirpath,mode=0700)
+    tmppath = path+".tmp"
+    with open(tmppath,'wb') as f:
+      f.write("\n".join(lines)+"\n")
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmppath,path)
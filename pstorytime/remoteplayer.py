@@ -0,0 +1,638 @@
+# -*- coding: utf-8 -*-
+"""Player that runs gstreamer in a separate process."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+from os.path import abspath, dirname
+import cPickle as pickle
+import mmap
+import os
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import Queue
+import fcntl
+import glib
+import gobject
+
+import pstorytime
+from pstorytime.backend import PositionSnapshot, GstProperties
+import pstorytime.backend
+from pstorytime.misc import withdoc
+
+__all__ = [
+  'RemotePlayer',
+  'SharedState',
+  ]
+
+class SharedState(object):
+  """Position and eos state of a player in a small shared memory region.
+
+  There is a single writer, and readers never wait for it: a sequence
+  number is made odd while the state is written and even when it is done,
+  and readers retry until they have read the state between two equal even
+  sequence numbers.
+  """
+  _HEADER = struct.Struct("<Q")
+  _STATE = struct.Struct("<qqddBBi")
+  _NAME_SIZE = 4096
+  SIZE = _HEADER.size + _STATE.size + _NAME_SIZE
+  """Size of the region in bytes. """
+
+  def __init__(self,region):
+    """Use a region.
+
+    Arguments:
+      region  A writable mmap of at least SIZE bytes, that is zero filled if
+              nothing has been written to it.
+    """
+    self._lock = threading.Lock()
+    self._region = region
+
+  def write(self,snapshot,eos):
+    """Publish a new state. Only one process may write.
+
+    Arguments:
+      snapshot  PositionSnapshot of the player.
+      eos       True if the player is at the end of a stream.
+    """
+    with self._lock:
+      if snapshot.filename == None:
+        name = ""
+        length = -1
+      else:
+        name = snapshot.filename[:self._NAME_SIZE]
+        length = len(name)
+      state = self._STATE.pack(snapshot.position, snapshot.duration,
+                               snapshot.clock, snapshot.rate,
+                               snapshot.playing, eos, length)
+      (seq,) = self._HEADER.unpack_from(self._region, 0)
+      self._region[0:self._HEADER.size] = self._HEADER.pack(seq+1)
+      start = self._HEADER.size
+      self._region[start:start+len(state)+len(name)] = state + name
+      self._region[0:self._HEADER.size] = self._HEADER.pack(seq+2)
+
+  def read(self):
+    """Read the latest state, without waiting for the writer.
+
+    Returns:  (snapshot,eos)
+    """
+    while True:
+      (before,) = self._HEADER.unpack_from(self._region, 0)
+      if before % 2 == 0:
+        data = self._region[0:self.SIZE]
+        (after,) = self._HEADER.unpack_from(self._region, 0)
+        if before == after:
+          break
+      # The writer is busy, let it finish.
+      time.sleep(0)
+    (position, duration, clock, rate, playing, eos, length) = \
+      self._STATE.unpack_from(data, self._HEADER.size)
+    if length < 0:
+      filename = None
+    else:
+      start = self._HEADER.size + self._STATE.size
+      filename = data[start:start+length]
+    snapshot = PositionSnapshot(filename, position, duration, clock, rate, bool(playing))
+    return (snapshot, bool(eos))
+
+class _GstProxy(GstProperties):
+  """Stand-in for the gstreamer pipeline of a remote player, that forwards
+  changes of the volume and mute properties. """
+  def __init__(self,player):
+    """Create the proxy.
+
+    Arguments:
+      player  The RemotePlayer to send changes to.
+    """
+    GstProperties.__init__(self)
+    self._player = player
+
+  def do_set_property(self,prop,value):
+    GstProperties.do_set_property(self,prop,value)
+    self._player._send(("property", prop.name, value))
+
+class RemotePlayer(gobject.GObject):
+  """Works the same as a backend, see pstorytime.backend, but runs the
+  backend in a separate process.
+
+  Gstreamer and its threads do not share a process, and the interpreter
+  lock, with the user interface. Calls are made over a pipe, while the
+  position is published by the worker in shared memory, so position_snapshot(),
+  duration() and filename() never wait for the worker.
+
+  The gst object only supports the volume and mute properties.
+
+  Signals:
+    switched    Contains the new filename. Emitted in gapless mode when
+                playback has continued into the next file without stopping
+    stopped     Emitted when playback could not be started.
+  """
+  SECOND = pstorytime.backend.SECOND
+  """A second according to gstreamer. """
+
+  __gsignals__ = {
+    'switched' : ( gobject.SIGNAL_RUN_LAST,
+                   gobject.TYPE_NONE,
+                   (gobject.TYPE_STRING,)),
+    'stopped' : ( gobject.SIGNAL_RUN_LAST,
+                  gobject.TYPE_NONE,
+                  tuple())
+  }
+
+  # Calls that clear eos in the worker. Eos events that were sent before the
+  # latest of these are stale.
+  _CLEARS = ("load", "play", "pause", "seek")
+
+  # How many files ahead to tell the worker about for gapless playback.
+  _AHEAD = 2
+
+  # How long to wait for the worker to answer a call, in seconds. The player
+  # operations have shorter timeouts of their own, so this is only reached if
+  # the worker is stuck.
+  _CALL_TIMEOUT = 30.0
+
+  @withdoc(gobject.property)
+  def eos(self):
+    """If the player is currently at the end of a stream."""
+    return self._eos
+
+  def __init__(self,bus,directory,next_file=None,pool_size=0,timeouts=None,async_state=False,backend="gst"):
+    """Start the worker process. See Player for the arguments.
+
+    The next_file function is called in this process, and the worker is told
+    which files follow the current one.
+
+    Arguments:
+      backend   Name of the backend to run in the worker. It must be one
+                that is registered by name in pstorytime.backend. (Optional,
+                defaults to "gst".)
+    """
+    gobject.GObject.__init__(self)
+    self._lock = threading.RLock()
+    self._send_lock = threading.Lock()
+    self._bus = bus
+    self._next_file = next_file
+    self._eos = False
+    self._clears = 0
+    self._results = Queue.Queue()
+    self._call_id = 0
+    self._dead = False
+
+    (fd, path) = tempfile.mkstemp(prefix="pstorytime-player-")
+    try:
+      os.ftruncate(fd, SharedState.SIZE)
+      self._region = mmap.mmap(fd, SharedState.SIZE)
+    finally:
+      os.close(fd)
+    self._state = SharedState(self._region)
+
+    (child_read, parent_write) = os.pipe()
+    (parent_read, child_write) = os.pipe()
+    env = dict(os.environ)
+    paths = [dirname(dirname(abspath(pstorytime.__file__)))]
+    if env.get("PYTHONPATH"):
+      paths.append(env["PYTHONPATH"])
+    env["PYTHONPATH"] = os.pathsep.join(paths)
+    with open(os.devnull,'r+') as devnull:
+      self._process = subprocess.Popen(
+        [ sys.executable, "-m", "pstorytime.remoteplayer",
+          str(child_read), str(child_write), path ],
+        stdin=devnull,
+        stdout=devnull,
+        env=env,
+        preexec_fn=lambda: _close_on_exec((child_read, child_write)))
+    os.close(child_read)
+    os.close(child_write)
+    self._write = os.fdopen(parent_write, 'wb')
+    self._read = os.fdopen(parent_read, 'rb')
+
+    self._reader = threading.Thread(target=self._receive, name="RemotePlayer")
+    self._reader.daemon = True
+    self._reader.start()
+
+    self.gst = _GstProxy(self)
+    try:
+      self._call("init", (backend, directory, pool_size, timeouts, async_state, next_file != None))
+    finally:
+      # The worker has opened the shared memory by now, or failed to.
+      os.unlink(path)
+
+  def _send(self,message):
+    """Send a message to the worker.
+
+    Returns:  True if successful.
+    """
+    with self._send_lock:
+      if self._dead:
+        return False
+      try:
+        pickle.dump(message, self._write, pickle.HIGHEST_PROTOCOL)
+        self._write.flush()
+        return True
+      except (IOError, OSError):
+        return False
+
+  def _receive(self):
+    """Background thread that receives the messages of the worker. """
+    while True:
+      try:
+        message = pickle.load(self._read)
+      except (EOFError, IOError, OSError, pickle.UnpicklingError):
+        break
+      if message[0] == "event":
+        gobject.idle_add(self._on_event, *message[1:])
+      else:
+        self._results.put(message)
+    self._dead = True
+    self._results.put(("exception", None, "Player process stopped."))
+
+  def _on_event(self,name,args,clears):
+    """Handle an event from the worker in the main loop.
+
+    Arguments:
+      name    Name of the event.
+      args    Tuple of arguments.
+      clears  How many calls that clear eos the worker had received.
+
+    Returns:  False, so that it is only run once.
+    """
+    if name == "error":
+      self._bus.emit("error",*args)
+    elif name == "eos":
+      (eos,) = args
+      # Does not take the lock, so that the main loop is not held up while a
+      # call is waited for.
+      if eos and clears != self._clears:
+        # Something else has been done since the stream ended.
+        return False
+      self._eos = eos
+      self.notify("eos")
+    elif name == "switched":
+      (filename,) = args
+      self._hint(filename)
+      self.emit("switched",filename)
+    elif name == "stopped":
+      self.emit("stopped")
+    return False
+
+  def _call(self,name,args=(),default=None):
+    """Call a method of the player in the worker and wait for the result.
+
+    Arguments:
+      name      Name of the method.
+      args      Tuple of arguments. (Optional, defaults to no arguments.)
+      default   What to return if the worker could not be used. (Optional,
+                defaults to None.)
+
+    Returns:  What the method returned.
+    """
+    with self._lock:
+      if name in self._CLEARS:
+        self._clears += 1
+      self._call_id += 1
+      if not self._send(("call", self._call_id, name, args)):
+        return default
+      deadline = time.time() + self._CALL_TIMEOUT
+      while True:
+        try:
+          (kind,call_id,value) = self._results.get(timeout=max(0,deadline-time.time()))
+        except Queue.Empty:
+          self._bus.emit("error","Player process did not answer {0} within {1} s.".format(
+            name, self._CALL_TIMEOUT))
+          return default
+        # Answers to earlier calls that were given up on are dropped. The
+        # answer without id is that the worker has stopped.
+        if call_id == None or call_id == self._call_id:
+          break
+      if kind == "exception":
+        self._bus.emit("error","Player process: {0}".format(value))
+        return default
+      return value
+
+  def _hint(self,filename):
+    """Tell the worker which files follow the given one, for gapless
+    playback.
+
+    Arguments:
+      filename  The file that is playing.
+    """
+    with self._lock:
+      if self._next_file == None:
+        return
+      hints = {}
+      for _ in xrange(0,self._AHEAD):
+        following = self._next_file(filename)
+        if following == None:
+          break
+        hints[filename] = following
+        filename = following
+      self._send(("hints", hints))
+
+  def load(self,filename):
+    """Load the given file.
+
+    Arguments:
+      filename  The file to load.
+
+    Returns:    True if the load was successfull, otherwise False.
+    """
+    with self._lock:
+      self._eos = False
+      self._hint(filename)
+      return self._call("load", (filename,), False)
+
+  def prefetch(self,filenames):
+    """See Player.prefetch(). It is only a hint, so it is sent without
+    waiting for the worker. """
+    self._send(("prefetch", filenames))
+
+  def pool_stats(self):
+    """See Player.pool_stats(). """
+    return self._call("pool_stats", default={})
+
+  def state_stats(self):
+    """See Player.state_stats(). """
+    return self._call("state_stats", default={})
+
+  def probe(self,filename):
+    """See Player.probe(). """
+    return self._call("probe", (filename,))
+
+  def play(self):
+    """Start playing at the current position."""
+    self._call("play")
+
+  def pause(self):
+    """Pause playback."""
+    with self._lock:
+      self._eos = False
+      self._call("pause")
+
+  def seek(self,time_ns):
+    """Seek to the given position in the current file.
+
+    Arguments:
+      time_ns   The position to seek to in nanoseconds.
+    """
+    with self._lock:
+      self._eos = False
+      self._call("seek", (time_ns,))
+
+  def position(self):
+    """Get the current playback position, as given by gstreamer.
+
+    Returns:  (filename,position,duration)
+    """
+    result = self._call("position")
+    if result == None:
+      return self.position_snapshot().extrapolate()
+    return result
+
+  def position_snapshot(self):
+    """Get the last position published by the worker, without waiting for
+    it.
+
+    Returns:  PositionSnapshot.
+    """
+    return self._state.read()[0]
+
+  def duration(self):
+    """Duration of the current file.
+
+    Returns: Duration
+    """
+    return self.position_snapshot().duration
+
+  def filename(self):
+    """Get the current file that is loaded.
+
+    Returns: Filename as string.
+    """
+    return self.position_snapshot().filename
+
+  def quit(self):
+    """Shut down the player and the worker process."""
+    with self._lock:
+      self._call("quit")
+      self._dead = True
+      try:
+        self._write.close()
+      except (IOError, OSError):
+        pass
+      # Give the worker a moment to shut down gstreamer.
+      deadline = time.time() + 5
+      while self._process.poll() == None and time.time() < deadline:
+        time.sleep(0.05)
+      if self._process.poll() == None:
+        self._process.kill()
+        self._process.wait()
+
+def _close_on_exec(keep):
+  """Make all open file descriptors except the given ones and the standard
+  ones close when a new program is started, so that the worker does not hold
+  on to the files of the user interface, such as the lock of the playlog.
+  Called in the child process before the worker is started.
+
+  Arguments:
+    keep  File descriptors to keep.
+  """
+  try:
+    fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+  except OSError:
+    try:
+      fds = range(0, os.sysconf("SC_OPEN_MAX"))
+    except (ValueError, OSError):
+      fds = range(0, 256)
+  for fd in fds:
+    if fd > 2 and fd not in keep:
+      try:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+      except (IOError, OSError):
+        pass
+
+class _Forward(object):
+  """Bus for the player in the worker, that sends its errors to the parent. """
+  def __init__(self,worker):
+    self._worker = worker
+
+  def emit(self,name,*args):
+    self._worker.event(name,args)
+
+class _Worker(object):
+  """The worker process side of a RemotePlayer. """
+  def __init__(self,read,write,state):
+    """Create the worker.
+
+    Arguments:
+      read    File to read calls from.
+      write   File to write results and events to.
+      state   SharedState to publish the position in.
+    """
+    self._lock = threading.Lock()
+    self._read = read
+    self._write = write
+    self._state = state
+    self._player = None
+    self._hints = {}
+    # Calls that clear eos that have returned, and the count when eos was
+    # last announced to the parent. Protected by _eos_lock.
+    self._eos_lock = threading.Lock()
+    self._clears = 0
+    self._announced = None
+    self._eos = False
+
+  def _send(self,message):
+    """Send a message to the parent. """
+    with self._lock:
+      pickle.dump(message, self._write, pickle.HIGHEST_PROTOCOL)
+      self._write.flush()
+
+  def event(self,name,args):
+    """Send an event to the parent.
+
+    Arguments:
+      name  Name of the event.
+      args  Tuple of arguments.
+    """
+    self._send(("event", name, args, self._clears))
+
+  def _publish(self):
+    """Publish the position of the player.
+
+    Returns:  True, so that it can be used as a repeating timer.
+    """
+    if self._player != None:
+      self._state.write(self._player.position_snapshot(), self._eos)
+    return True
+
+  def _on_eos(self,player,prop):
+    with self._eos_lock:
+      self._eos = player.eos
+      self._publish()
+      if self._eos:
+        if self._announced == self._clears:
+          return
+        self._announced = self._clears
+      self.event("eos",(self._eos,))
+
+  def _cleared(self):
+    """A call that clears eos has returned. The parent drops eos events that
+    were sent before that, since they may be from before eos was cleared, so
+    announce it again if the stream has ended since. """
+    with self._eos_lock:
+      self._clears += 1
+      if self._player != None and self._player.eos:
+        self._eos = True
+        self._announced = self._clears
+        self.event("eos",(True,))
+
+  def _on_switched(self,player,filename):
+    self._publish()
+    self.event("switched",(filename,))
+
+  def _on_stopped(self,player):
+    self._publish()
+    self.event("stopped",())
+
+  def _init(self,backend,directory,pool_size,timeouts,async_state,gapless):
+    """Create the player. """
+    if gapless:
+      next_file = lambda filename: self._hints.get(filename)
+    else:
+      next_file = None
+    create = pstorytime.backend.factory(backend)
+    self._player = create(_Forward(self), directory, next_file, pool_size,
+                          timeouts, async_state)
+    self._player.connect("notify::eos",self._on_eos)
+    self._player.connect("switched",self._on_switched)
+    self._player.connect("stopped",self._on_stopped)
+    self._publish()
+
+  def run(self):
+    """Serve calls until told to quit or the parent goes away. """
+    gobject.threads_init()
+    loop = glib.MainLoop()
+    thread = threading.Thread(target=loop.run, name="GobjectLoop")
+    thread.daemon = True
+    thread.start()
+    glib.timeout_add(100, self._publish)
+
+    running = True
+    while running:
+      try:
+        message = pickle.load(self._read)
+      except (EOFError, IOError, OSError, pickle.UnpicklingError):
+        break
+      kind = message[0]
+      if kind == "call":
+        (_, call_id, name, args) = message
+        try:
+          if name == "init":
+            result = self._init(*args)
+          elif name == "quit":
+            running = False
+            result = self._player.quit() if self._player != None else None
+          else:
+            result = getattr(self._player,name)(*args)
+        except Exception as e:
+          self._send(("exception", call_id, "{0}: {1}".format(type(e).__name__, e)))
+        else:
+          self._send(("result", call_id, result))
+        if name in RemotePlayer._CLEARS:
+          self._cleared()
+        self._publish()
+      elif kind == "property":
+        (_, name, value) = message
+        if self._player != None:
+          self._player.gst.set_property(name, value)
+      elif kind == "hints":
+        self._hints.update(message[1])
+      elif kind == "prefetch":
+        if self._player != None:
+          try:
+            self._player.prefetch(message[1])
+          except Exception as e:
+            self.event("error",("Player process: {0}: {1}".format(type(e).__name__, e),))
+
+    if running and self._player != None:
+      self._player.quit()
+    loop.quit()
+
+def main(argv=None):
+  """Entry point of the worker process. """
+  if argv == None:
+    argv = sys.argv[1:]
+  # Interrupts are for the user interface, which quits the worker.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  (read, write, path) = argv
+  with open(path, 'r+b') as f:
+    region = mmap.mmap(f.fileno(), SharedState.SIZE)
+  worker = _Worker(os.fdopen(int(read), 'rb'),
+                   os.fdopen(int(write), 'wb'),
+                   SharedState(region))
+  worker.run()
+
+if __name__ == "__main__":
+  main()
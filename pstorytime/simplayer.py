@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+"""Simulated player backend that runs on a virtual clock."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import heapq
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+import glib
+import gobject
+
+from pstorytime.backend import SECOND, PositionSnapshot, GstProperties
+from pstorytime.misc import withdoc
+import pstorytime.backend
+
+__all__ = [
+  'VirtualClock',
+  'WallClock',
+  'SimPlayer',
+  'synthetic_duration',
+  ]
+
+def synthetic_duration(filename):
+  """Make up a duration for a file, the same every time for the same name.
+
+  Arguments:
+    filename  The file.
+
+  Returns:  Duration in ns, between 10 and 60 minutes.
+  """
+  minutes = 10 + (zlib.crc32(filename) & 0xffffffff) % 50
+  return minutes*60*SECOND
+
+class VirtualClock(object):
+  """Clock whose time only moves when it is told to. Functions can be
+  scheduled to be called at a time, and are called by advance(). """
+  def __init__(self,start=0.0):
+    """Create the clock.
+
+    Arguments:
+      start   Time to start at, in seconds. (Optional, defaults to 0.0.)
+    """
+    self._lock = threading.RLock()
+    self._now = start
+    # (time,seq,function) heap of scheduled calls.
+    self._calls = []
+    self._cancelled = set()
+    self._seq = 0
+
+  def now(self):
+    """Get the current time.
+
+    Returns:  Time in seconds.
+    """
+    with self._lock:
+      return self._now
+
+  def call_at(self,when,function):
+    """Schedule a function to be called.
+
+    Arguments:
+      when      Time in seconds to call it at.
+      function  The function, which is called without arguments.
+
+    Returns:  Handle that can be given to cancel().
+    """
+    with self._lock:
+      self._seq += 1
+      heapq.heappush(self._calls, (when, self._seq, function))
+      return self._seq
+
+  def cancel(self,handle):
+    """Forget a scheduled call.
+
+    Arguments:
+      handle  What call_at() returned.
+    """
+    with self._lock:
+      self._cancelled.add(handle)
+
+  def next(self):
+    """Get when the next scheduled call is.
+
+    Returns:  Time in seconds, or None if nothing is scheduled.
+    """
+    with self._lock:
+      while len(self._calls)>0 and self._calls[0][1] in self._cancelled:
+        (_,seq,_) = heapq.heappop(self._calls)
+        self._cancelled.discard(seq)
+      if len(self._calls)==0:
+        return None
+      return self._calls[0][0]
+
+  def advance(self,seconds):
+    """Move time forward, calling what is scheduled on the way, in order.
+    Functions are called without holding the lock, so they may schedule more
+    calls.
+
+    Arguments:
+      seconds   How far to move time.
+    """
+    with self._lock:
+      end = self._now + seconds
+    while True:
+      with self._lock:
+        when = self.next()
+        if when == None or when > end:
+          self._now = max(self._now, end)
+          return
+        (when,_,function) = heapq.heappop(self._calls)
+        self._now = max(self._now, when)
+      function()
+
+class WallClock(object):
+  """Clock that follows real time, with calls scheduled in the gobject main
+  loop. It lets the simulated player be used interactively. """
+  def now(self):
+    """Get the current time.
+
+    Returns:  Time in seconds.
+    """
+    return time.time()
+
+  def call_at(self,when,function):
+    """Schedule a function to be called.
+
+    Arguments:
+      when      Time in seconds to call it at.
+      function  The function, which is called without arguments.
+
+    Returns:  Handle that can be given to cancel().
+    """
+    def call():
+      function()
+      return False
+    return glib.timeout_add(max(0, int((when-time.time())*1000)), call)
+
+  def cancel(self,handle):
+    """Forget a scheduled call.
+
+    Arguments:
+      handle  What call_at() returned.
+    """
+    glib.source_remove(handle)
+
+class SimPlayer(gobject.GObject):
+  """Player backend that plays nothing, see pstorytime.backend. Time is kept
+  by a clock, so with a VirtualClock playback can be run much faster than
+  real time, and files end and are continued into the next one just like
+  with a real player.
+
+  Signals:
+    switched    Contains the new filename. Emitted in gapless mode when
+                playback has continued into the next file without stopping
+    stopped     Never emitted, since simulated playback always starts.
+  """
+  SECOND = SECOND
+  """A second, the same as for gstreamer. """
+
+  __gsignals__ = {
+    'switched' : ( gobject.SIGNAL_RUN_LAST,
+                   gobject.TYPE_NONE,
+                   (gobject.TYPE_STRING,)),
+    'stopped' : ( gobject.SIGNAL_RUN_LAST,
+                  gobject.TYPE_NONE,
+                  tuple())
+  }
+
+  @withdoc(gobject.property)
+  def eos(self):
+    """If the player is currently at the end of a stream."""
+    with self._lock:
+      return self._eos
+
+  def __init__(self,bus,directory,next_file=None,pool_size=0,timeouts=None,async_state=False,clock=None,durations=None):
+    """Create the simulated player. The arguments are the same as for
+    pstorytime.player.Player, and pool_size, timeouts and async_state are
+    ignored.
+
+    Arguments:
+      clock       Clock to play by, such as a VirtualClock. (Optional,
+                  defaults to a WallClock.)
+      durations   Function that gives the duration in ns of a file, or None
+                  if it can not be played. (Optional, defaults to
+                  synthetic_duration.)
+    """
+    gobject.GObject.__init__(self)
+    self._lock = threading.RLock()
+    self._bus = bus
+    self._directory = directory
+    self._next_file = next_file
+    self._clock = clock if clock != None else WallClock()
+    self._durations = durations if durations != None else synthetic_duration
+
+    self._filename = None
+    self._duration = 0
+    # Position at the clock time _since, playing on from there if playing.
+    self._position = 0
+    self._since = self._clock.now()
+    self._playing = False
+    self._eos = False
+    self._end = None
+    self._operations = dict((op,0) for op in ["load","play","pause","seek"])
+
+    self.gst = GstProperties()
+
+  def _current(self):
+    """Get the current position in ns. """
+    with self._lock:
+      if not self._playing:
+        return self._position
+      elapsed = int((self._clock.now()-self._since)*SECOND)
+      return min(self._position+elapsed, self._duration)
+
+  def _move(self,position,playing):
+    """Set the position and playing state, and schedule the end of the file.
+
+    Arguments:
+      position  New position in ns.
+      playing   True if playing.
+    """
+    with self._lock:
+      if self._end != None:
+        self._clock.cancel(self._end)
+        self._end = None
+      self._position = max(0, min(position, self._duration))
+      self._since = self._clock.now()
+      self._playing = playing
+      if playing:
+        remaining = float(self._duration - self._position)/SECOND
+        self._end = self._clock.call_at(self._since+remaining, self._on_end)
+
+  def _on_end(self):
+    """The end of the file was reached. """
+    with self._lock:
+      self._end = None
+      if not self._playing:
+        return
+      following = None
+      if self._next_file != None:
+        following = self._next_file(self._filename)
+      duration = self._durations(following) if following != None else None
+      if duration == None:
+        self._move(self._duration, False)
+        switched = False
+      else:
+        self._filename = following
+        self._duration = duration
+        self._move(0, True)
+        switched = True
+    if switched:
+      self.emit("switched",following)
+    else:
+      self._set_eos(True)
+
+  def _set_eos(self,eos):
+    """Change the eos property. """
+    with self._lock:
+      self._eos = eos
+      self.notify("eos")
+
+  def load(self,filename):
+    """Load the given file.
+
+    Arguments:
+      filename  The file to load.
+
+    Returns:    True if the load was successfull, otherwise False.
+    """
+    with self._lock:
+      self._operations["load"] += 1
+      self._set_eos(False)
+      self._filename = filename
+      duration = self._durations(filename)
+      self._duration = duration if duration != None else 0
+      self._move(0, False)
+      return duration != None
+
+  def prefetch(self,filenames):
+    """Does nothing, there is nothing to preroll. """
+    pass
+
+  def pool_stats(self):
+    """Get statistics of the pool, which is always empty.
+
+    Returns:  See PipelinePool.stats().
+    """
+    return { "hits" : 0, "misses" : 0, "hit_rate" : 0.0, "pooled" : 0,
+             "hit_latency" : 0.0, "hit_latency_max" : 0.0,
+             "miss_latency" : 0.0, "miss_latency_max" : 0.0 }
+
+  def state_stats(self):
+    """Get statistics of player operations, which take no time.
+
+    Returns:  See Player.state_stats().
+    """
+    with self._lock:
+      return dict((op, { "count" : count, "latency" : 0.0, "latency_max" : 0.0,
+                         "timeouts" : 0, "failures" : 0 })
+                  for (op,count) in self._operations.items())
+
+  def probe(self,filename):
+    """Find the duration of a file.
+
+    Arguments:
+      filename  The file to probe.
+
+    Returns:    Duration in ns, or None if it could not be found.
+    """
+    return self._durations(filename)
+
+  def play(self):
+    """Start playing at the current position."""
+    with self._lock:
+      self._operations["play"] += 1
+      if self._eos:
+        self._set_eos(True)
+      elif self._filename != None:
+        self._move(self._current(), True)
+
+  def pause(self):
+    """Pause playback."""
+    with self._lock:
+      self._operations["pause"] += 1
+      self._set_eos(False)
+      self._move(self._current(), False)
+
+  def seek(self,time_ns):
+    """Seek to the given position in the current file.
+
+    Arguments:
+      time_ns   The position to seek to in nanoseconds.
+    """
+    with self._lock:
+      self._operations["seek"] += 1
+      self._set_eos(False)
+      self._move(time_ns, self._playing)
+
+  def position(self):
+    """Get the current playback position.
+
+    Returns:  (filename,position,duration)
+    """
+    with self._lock:
+      return (self._filename, self._current(), self._duration)
+
+  def position_snapshot(self):
+    """Get the current position as a snapshot. Its clock is the current
+    walltime, so that it can be extrapolated like that of any player.
+
+    Returns:  PositionSnapshot.
+    """
+    with self._lock:
+      return PositionSnapshot(self._filename, self._current(), self._duration,
+                              time.time(), 1.0, self._playing)
+
+  def duration(self):
+    """Duration of the current file.
+
+    Returns: Duration
+    """
+    with self._lock:
+      return self._duration
+
+  def filename(self):
+    """Get the current file that is loaded.
+
+    Returns: Filename as string.
+    """
+    with self._lock:
+      return self._filename
+
+  def quit(self):
+    """Shut down the player."""
+    with self._lock:
+      self._move(self._current(), False)
+
+def benchmark(files=20,seeks=10000,seed=0):
+  """Play a made up audiobook on a virtual clock, seeking around randomly and
+  listening through the ends of files, and measure how fast it runs.
+
+  Arguments:
+    files   Number of files in the audiobook. (Optional, defaults to 20.)
+    seeks   Number of seeks to make. (Optional, defaults to 10000.)
+    seed    Seed of the random numbers. (Optional, defaults to 0.)
+
+  Returns:  Dictionary with the number of seeks, files played to the end,
+            times the end of the book was reached, playlog entries, virtual
+            seconds played and the real time it took in seconds.
+  """
+  # Imported here since the audiobook pulls in the rest of pstorytime.
+  from pstorytime.audiobook import AudioBook
+  from pstorytime.audiobookargs import audiobookargs
+
+  directory = tempfile.mkdtemp(prefix="pstorytime-sim-")
+  try:
+    for i in xrange(0,files):
+      open(os.path.join(directory,"{0:03d}.mp3".format(i)),'w').close()
+    conf = audiobookargs.parse_args([])
+    conf.playlog_file = os.path.join(directory,".playlog")
+    conf.backend = "bench"
+    conf.seek_window = 0
+    conf.backtrack = 0
+    conf.log_durability = "buffered"
+
+    clock = VirtualClock(time.time())
+    file_ends = [0]
+    ends = [0]
+    def on_eos(player,prop):
+      if player.eos:
+        file_ends[0] += 1
+    def create(*args):
+      player = SimPlayer(*args, clock=clock)
+      player.connect("notify::eos",on_eos)
+      return player
+    pstorytime.backend.register("bench",create)
+    rnd = random.Random(seed)
+
+    start = time.time()
+    ab = AudioBook(conf,directory)
+    eob = [False]
+    def on_eob(ab,prop):
+      if ab.eob and not eob[0]:
+        ends[0] += 1
+      eob[0] = ab.eob
+    ab.connect("notify::eob",on_eob)
+    ab.play()
+    for _ in xrange(0,seeks):
+      ab.dseek(rnd.randint(-600,600)*SECOND)
+      # Listen for a while, sometimes past the end of the file.
+      clock.advance(rnd.randint(1,1800))
+      if not ab.playing:
+        ab.play(ab.list_files()[0],0)
+    elapsed = time.time() - start
+    played = clock.now() - start
+    entries = len(ab.playlog)
+    ab.quit()
+    return { "seeks" : seeks, "file_ends" : file_ends[0], "ends" : ends[0],
+             "entries" : entries, "played" : played, "elapsed" : elapsed }
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+def main(argv=None):
+  """Command line interface. """
+  parser = argparse.ArgumentParser(
+    prog="pstorytime-simplayer",
+    description="Benchmark the audiobook logic on a simulated player with a virtual clock.")
+  parser.add_argument("--files", type=int, default=20,
+    help="Number of files in the made up audiobook. (Default: %(default)s)")
+  parser.add_argument("--seeks", type=int, default=10000,
+    help="Number of random seeks. (Default: %(default)s)")
+  parser.add_argument("--seed", type=int, default=0,
+    help="Seed of the random numbers. (Default: %(default)s)")
+  args = parser.parse_args(argv)
+  result = benchmark(args.files, args.seeks, args.seed)
+  print "{seeks} seeks, {file_ends} files played to the end, {ends} ends of the book, {entries} playlog entries".format(**result)
+  print "{0:.0f} s played in {1:.2f} s, {2:.0f} times real time".format(
+    result["played"], result["elapsed"], result["played"]/max(result["elapsed"],1e-9))
+
+if __name__ == "__main__":
+  main()
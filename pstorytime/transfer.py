@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+"""Export and import of playlogs as JSON Lines and CSV."""
+
+#
+# Copyright (C) 2011 Anders Engström <ankan@ankan.eu>
+#
+# This file is part of pstorytime.
+#
+# pstorytime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pstorytime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pstorytime.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from os.path import dirname
+from itertools import islice
+from operator import itemgetter
+import argparse
+import codecs
+import csv
+import heapq
+import json
+import marshal
+import os
+import re
+import sys
+import tempfile
+import time
+
+from pstorytime.playlog import segment_files
+from pstorytime.logcheck import strip_checksum, add_checksum
+from pstorytime.audiobookargs import Boolean
+from pstorytime.misc import FileLock, LockedException
+
+__all__ = [
+  'FORMATS',
+  'FIELDS',
+  'parse_line',
+  'format_line',
+  'playlog_records',
+  'export_records',
+  'parse_stream',
+  'sort_records',
+  'merge_records',
+  'import_records',
+  ]
+
+FORMATS = ["jsonl", "csv"]
+"""Supported formats. """
+
+FIELDS = ["walltime", "event", "filename", "position", "duration"]
+"""Fields of a record, in order. """
+
+CHUNK = 100000
+"""Number of records to sort in memory at a time when importing. """
+
+def _escape_bytes(error):
+  """Decoding error handler that turns each invalid byte into a lone
+  surrogate from U+DC80 to U+DCFF, so that the bytes can be restored. """
+  bad = error.object[error.start:error.end]
+  return (u"".join(unichr(0xdc00+ord(c)) for c in bad), error.end)
+
+codecs.register_error("pstorytime-escape", _escape_bytes)
+
+_ESCAPED = re.compile(u"[\udc80-\udcff]")
+
+def _json_string(data):
+  """Format a string of bytes as a JSON string. Bytes that are not valid
+  UTF-8 are written as escaped lone surrogates, see _unescape(). """
+  try:
+    return json.encoder.encode_basestring_ascii(data)
+  except UnicodeDecodeError:
+    return json.encoder.encode_basestring_ascii(data.decode("utf-8","pstorytime-escape"))
+
+def _unescape(text):
+  """Encode a string read from JSON as UTF-8, turning lone surrogates from
+  U+DC80 to U+DCFF back into the bytes they were made from. """
+  if _ESCAPED.search(text) == None:
+    return text.encode("utf-8")
+  parts = []
+  for c in text:
+    code = ord(c)
+    if 0xdc80 <= code <= 0xdcff:
+      parts.append(chr(code-0xdc00))
+    else:
+      parts.append(c.encode("utf-8"))
+  return "".join(parts)
+
+def parse_line(line):
+  """Parse a line of a playlog into a record. Lines are understood exactly
+  like LogEntry.parse does, but records are plain tuples, which is much
+  faster when handling millions of them.
+
+  Arguments:
+    line    The line.
+
+  Returns:  (walltime,event,filename,position,duration), or None if the line
+            is invalid.
+  """
+  if line[:1] == "@":
+    line = strip_checksum(line)
+    if line == None:
+      return None
+  elif line.endswith("\n"):
+    line = line[:-1]
+  data = line.split(' ')
+  if len(data) < 5:
+    return None
+  try:
+    return (int(data[0]), data[1], " ".join(data[2:-2]), int(data[-2]), int(data[-1]))
+  except ValueError:
+    return None
+
+def format_line(record):
+  """Format a record as a line of a playlog, like str() of a LogEntry.
+
+  Arguments:
+    record  The record.
+
+  Returns:  The line, including the newline.
+  """
+  return "%d %s %s %d %d\n" % record
+
+def playlog_records(playlog_file):
+  """Read all valid records of a playlog, including its sealed segments, one
+  at a time.
+
+  Arguments:
+    playlog_file  Path to the playlog.
+
+  Returns:        Iterator over records, in order.
+  """
+  paths = [path for (_,path) in segment_files(playlog_file)] + [playlog_file]
+  for path in paths:
+    try:
+      f = open(path,'rb')
+    except IOError:
+      continue
+    with f:
+      for line in f:
+        record = parse_line(line)
+        if record != None:
+          yield record
+
+def export_records(records,out,fmt="jsonl"):
+  """Write records to a file.
+
+  Arguments:
+    records   Iterable of records.
+    out       File object to write to.
+    fmt       One of FORMATS. (Optional, defaults to "jsonl".)
+
+  Returns:    Number of records written.
+  """
+  count = 0
+  if fmt == "jsonl":
+    dumps = _json_string
+    write = out.write
+    # Formatted by hand to keep the fields in order, which is also faster.
+    line = '{{"walltime": {0}, "event": {1}, "filename": {2}, "position": {3}, "duration": {4}}}\n'.format
+    for (walltime,event,filename,position,duration) in records:
+      write(line(walltime, dumps(event), dumps(filename), position, duration))
+      count += 1
+  elif fmt == "csv":
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    for record in records:
+      writer.writerow(record)
+      count += 1
+  else:
+    raise ValueError("Unknown format: {0}".format(fmt))
+  return count
+
+def _record(walltime,event,filename,position,duration):
+  """Create a record from imported fields.
+
+  Returns:  The record.
+
+  Exceptions:
+    ValueError  If the fields can not be written to a playlog.
+  """
+  if isinstance(event,unicode):
+    event = _unescape(event)
+  if isinstance(filename,unicode):
+    filename = _unescape(filename)
+  if event == "" or " " in event or "\n" in event or "\r" in event:
+    raise ValueError("Invalid event name.")
+  if "\n" in filename or "\r" in filename:
+    raise ValueError("Invalid filename.")
+  return (int(walltime), event, filename, int(position), int(duration))
+
+def parse_stream(inp,fmt="jsonl",errors=None):
+  """Read records from a file, skipping invalid ones.
+
+  Arguments:
+    inp       File object to read from.
+    fmt       One of FORMATS. (Optional, defaults to "jsonl".)
+    errors    List that the line numbers of invalid records are appended to,
+              or None. (Optional, defaults to None.)
+
+  Returns:    Iterator over records, in the order they are read.
+  """
+  if fmt == "jsonl":
+    loads = json.loads
+    for (number,line) in enumerate(inp,1):
+      try:
+        if line.strip() == "":
+          continue
+        data = loads(line)
+        yield _record(data["walltime"], data["event"], data["filename"],
+                      data["position"], data["duration"])
+      except (ValueError, KeyError, TypeError):
+        if errors != None:
+          errors.append(number)
+  elif fmt == "csv":
+    reader = csv.reader(inp)
+    for row in reader:
+      try:
+        if row == FIELDS or len(row) == 0:
+          continue
+        if len(row) != len(FIELDS):
+          raise ValueError("Wrong number of fields.")
+        yield _record(*row)
+      except ValueError:
+        if errors != None:
+          errors.append(reader.line_num)
+  else:
+    raise ValueError("Unknown format: {0}".format(fmt))
+
+def sort_records(records,chunk=CHUNK):
+  """Sort records by walltime, keeping the order of records with the same
+  walltime. At most chunk records are kept in memory, the rest is sorted in
+  temporary files which are merged.
+
+  Arguments:
+    records   Iterable of records.
+    chunk     Number of records to sort in memory at a time. (Optional,
+              defaults to CHUNK.)
+
+  Returns:    Iterator over the records in order.
+  """
+  records = iter(records)
+  walltime = itemgetter(0)
+  runs = []
+  try:
+    while True:
+      block = list(islice(records,chunk))
+      if len(block)==0:
+        break
+      # sort() is stable, so records with the same walltime keep their order.
+      block.sort(key=walltime)
+      if len(runs)==0 and len(block) < chunk:
+        # Everything fit in memory.
+        for record in block:
+          yield record
+        return
+      run = tempfile.TemporaryFile()
+      for i in xrange(0,len(block),_BATCH):
+        marshal.dump(block[i:i+_BATCH],run)
+      run.seek(0)
+      runs.append(run)
+
+    streams = [_decorate(i,_read_run(run)) for (i,run) in enumerate(runs)]
+    for (_,_,_,record) in heapq.merge(*streams):
+      yield record
+  finally:
+    for run in runs:
+      run.close()
+
+_BATCH = 1024
+
+def _read_run(run):
+  """Read the records of a sorted run written by sort_records. """
+  while True:
+    try:
+      batch = marshal.load(run)
+    except EOFError:
+      return
+    for record in batch:
+      yield record
+
+def _decorate(stream,records):
+  """Make records comparable for heapq.merge, in order of walltime, then
+  stream and then order within the stream. """
+  n = 0
+  for record in records:
+    yield (record[0],stream,n,record)
+    n += 1
+
+def merge_records(*streams):
+  """Merge streams of records that are in order of walltime, dropping
+  duplicates. Records are duplicates if they have the same walltime, event,
+  filename and position.
+
+  Arguments:
+    streams   Iterables of records, in order of walltime. Records from
+              earlier streams go first when walltimes are equal.
+
+  Returns:    Iterator over (record,stream) where stream is the index of the
+              stream that the record came from.
+  """
+  walltime = None
+  seen = set()
+  decorated = [_decorate(i,records) for (i,records) in enumerate(streams)]
+  for (w,stream,_,record) in heapq.merge(*decorated):
+    if w != walltime:
+      # Only records with the current walltime can be duplicates.
+      walltime = w
+      seen.clear()
+    key = record[1:4]
+    if key in seen:
+      continue
+    seen.add(key)
+    yield (record,stream)
+
+def import_records(playlog_file,records,chunk=CHUNK,checksums=False):
+  """Merge records into a playlog in order of walltime, dropping duplicates.
+
+  The playlog is rewritten as a single file, and its sealed segments and
+  snapshot are removed, so the snapshot is rebuilt the next time it is
+  opened. The playlog must not be in use.
+
+  Arguments:
+    playlog_file  Path to the playlog.
+    records       Iterable of records, in any order.
+    chunk         Number of records to sort in memory at a time. (Optional,
+                  defaults to CHUNK.)
+    checksums     True to write a checksum with each line, like
+                  --log-checksums. (Optional, defaults to False.)
+
+  Returns:        (added,total) where added is the number of records that
+                  were added and total is the number of records in the new
+                  playlog.
+
+  Exceptions:
+    IOError, OSError  If the playlog could not be written.
+  """
+  dirpath = dirname(playlog_file)
+  if not os.path.isdir(dirpath) and dirpath!='':
+    os.makedirs(dirpath,mode=0700)
+
+  tmpfile = playlog_file+".import"
+  added = 0
+  total = 0
+  with open(tmpfile,'wb') as out:
+    write = out.write
+    merged = merge_records(playlog_records(playlog_file),
+                           sort_records(records,chunk))
+    for (record,stream) in merged:
+      if checksums:
+        write(add_checksum("%d %s %s %d %d" % record)+"\n")
+      else:
+        write("%d %s %s %d %d\n" % record)
+      total += 1
+      added += stream
+    out.flush()
+    os.fsync(out.fileno())
+
+  # The old playlog is only removed once the new one is in place. If this is
+  # interrupted after the rename, old segments may be left, and their entries
+  # are then repeated. Removing the snapshot first makes sure that it is
+  # rebuilt from what is on disk.
+  if os.path.isfile(playlog_file+".snapshot"):
+    os.remove(playlog_file+".snapshot")
+  os.rename(tmpfile,playlog_file)
+  for (_,path) in segment_files(playlog_file):
+    os.remove(path)
+  return (added,total)
+
+def _format(path,fmt):
+  """Pick the format from the option or the extension of the path. """
+  if fmt != None:
+    return fmt
+  if path.endswith(".csv"):
+    return "csv"
+  return "jsonl"
+
+def benchmark(entries,out=sys.stdout):
+  """Time export and import of a synthetic playlog.
+
+  Arguments:
+    entries   Number of entries.
+    out       Where to print. (Optional, defaults to stdout.)
+  """
+  tmpdir = tempfile.mkdtemp()
+  try:
+    playlog_file = os.path.join(tmpdir,".playlog")
+    with open(playlog_file,'wb') as f:
+      for i in xrange(0,entries):
+        f.write("{0} start {1:03d}.mp3 {2} 3600000000000\n".format(
+          1300000000+i*10, i/1000, (i%1000)*10**9))
+
+    for fmt in FORMATS:
+      exported = os.path.join(tmpdir,"export."+fmt)
+      start = time.time()
+      with open(exported,'wb') as f:
+        export_records(playlog_records(playlog_file),f,fmt)
+      elapsed = time.time() - start
+      out.write("export {0}: {1} entries in {2:.2f} s, {3:.0f} entries/s\n".format(
+        fmt, entries, elapsed, entries/max(elapsed,1e-9)))
+
+      # Import into the same playlog, so everything is a duplicate.
+      start = time.time()
+      with open(exported,'rb') as f:
+        (added,total) = import_records(playlog_file,parse_stream(f,fmt))
+      elapsed = time.time() - start
+      out.write("import {0}: {1} entries in {2:.2f} s, {3:.0f} entries/s, {4} added\n".format(
+        fmt, entries, elapsed, entries/max(elapsed,1e-9), added))
+  finally:
+    for name in os.listdir(tmpdir):
+      os.remove(os.path.join(tmpdir,name))
+    os.rmdir(tmpdir)
+
+def main(argv=None):
+  """Command line interface. """
+  parser = argparse.ArgumentParser(
+    prog="pstorytime-transfer",
+    description="%(prog)s exports and imports pstorytime playlogs.")
+  sub = parser.add_subparsers(dest="command")
+
+  exp = sub.add_parser("export", help="Write a playlog as JSON Lines or CSV.")
+  exp.add_argument("playlog", help="Path to the playlog.")
+  exp.add_argument("output", nargs="?", default="-", help="File to write to. (Default: stdout)")
+  exp.add_argument("--format", choices=FORMATS, default=None, help="Format to write. (Default: from the extension of the output, otherwise jsonl)")
+
+  imp = sub.add_parser("import", help="Merge JSON Lines or CSV files into a playlog.")
+  imp.add_argument("playlog", help="Path to the playlog.")
+  imp.add_argument("input", nargs="+", help="File to read, or - for stdin.")
+  imp.add_argument("--format", choices=FORMATS, default=None, help="Format to read. (Default: from the extension of the input, otherwise jsonl)")
+  imp.add_argument("--log-checksums", action=Boolean, default=False, help="Write a checksum with each line of the playlog. Use the same setting as the player. (Default: %(default)s)")
+
+  bench = sub.add_parser("benchmark", help="Time export and import of a synthetic playlog.")
+  bench.add_argument("--entries", type=int, default=1000000, help="Number of entries. (Default: %(default)s)")
+
+  conf = parser.parse_args(argv)
+
+  if conf.command == "export":
+    fmt = _format(conf.output,conf.format)
+    if conf.output == "-":
+      export_records(playlog_records(conf.playlog),sys.stdout,fmt)
+    else:
+      with open(conf.output,'wb') as out:
+        export_records(playlog_records(conf.playlog),out,fmt)
+
+  elif conf.command == "import":
+    errors = []
+    def records():
+      for path in conf.input:
+        fmt = _format(path,conf.format)
+        if path == "-":
+          for record in parse_stream(sys.stdin,fmt,errors):
+            yield record
+        else:
+          with open(path,'rb') as inp:
+            for record in parse_stream(inp,fmt,errors):
+              yield record
+    try:
+      with FileLock(conf.playlog+".lock"):
+        (added,total) = import_records(conf.playlog,records(),
+                                       checksums=conf.log_checksums)
+    except LockedException:
+      print("Error: The playlog is in use.")
+      sys.exit(1)
+    print("Added {0} entries, the playlog now has {1}. Skipped {2} invalid entries.".format(
+      added, total, len(errors)))
+
+  else:
+    benchmark(conf.entries)
+
+if __name__ == '__main__':
+  main()